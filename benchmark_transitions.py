@@ -0,0 +1,70 @@
+"""
+Measures how transition-matrix construction scales with the number of threads on a single long trip.
+
+Example usage:
+  python benchmark_transitions.py                      # a synthetic trip of at least 75,000 feet
+  python benchmark_transitions.py probe_data.csv       # the first trip of a file in the data subdirectory
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import map_match.scoring_fns
+import util.artificial_paths
+import util.m_tree.tree
+import util.Shapes
+import util.utils
+from constructNetwork import TrafficNetwork
+from map_match.transitions import TransitionTable
+from mapMatch import MapMatch
+
+THREAD_COUNTS = [1, 2, 4, 8, 16]
+
+
+def long_trip(network, filename=None):
+    """
+    :return: The first trip of filename, or a synthetic trip if no filename is given.
+    """
+    if filename is None:
+        return util.artificial_paths.generate_path(network, min_path_length=75000, max_path_length=150000)[0]
+    data = util.Shapes.DataPoint.convert_dataset(filename)
+    return data[0] if isinstance(data[0], list) else data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filename', nargs='?', help='a probe data file in the data subdirectory')
+    parser.add_argument('--repeat', type=int, default=3, help='the number of timed runs for each thread count')
+    args = parser.parse_args()
+
+    junction_map, section_map = util.utils.decode_json()
+    network = TrafficNetwork(junction_map, section_map)
+    print('network constructed. number of nodes:', network.equalize_node_density(200, 15, greedy=True))
+
+    mm = MapMatch.without_evaluation(network, util.m_tree.tree.MTree)
+    trip = long_trip(network, args.filename)
+    scores = [map_match.scoring_fns.exp_distance_heading(i, trip, mm.find_knn, network) for i in range(len(trip))]
+    searches = sum(len(candidate_map) for candidate_map in scores[:-1])
+    print('trip of {0} points, {1} one-to-many searches per run'.format(len(trip), searches))
+
+    print('threads\tseconds\tspeedup')
+    baseline = None
+    reference = None
+    for threads in THREAD_COUNTS:
+        with ThreadPoolExecutor(threads) as executor:
+            timings = []
+            for _ in range(args.repeat):
+                transitions = TransitionTable(network, scores, executor=executor if threads > 1 else None)
+                start = time.perf_counter()
+                transitions.prefetch()
+                timings.append(time.perf_counter() - start)
+
+        assert reference is None or transitions.table == reference, 'results differ with {0} threads'.format(threads)
+        reference = transitions.table
+        best = min(timings)
+        baseline = baseline or best
+        print('{0}\t{1:.3f}\t{2:.2f}x'.format(threads, best, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
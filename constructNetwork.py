@@ -1,12 +1,19 @@
+import hashlib
 import math
 
+from bisect import bisect_right
 from itertools import groupby
 
 from graph_tool.all import *
+import numpy as np
 
 from util import Shapes as shapes
 from util import utils
-from util.export import build_linestring
+from util.distance_cache import DistanceCache
+from util.instrumentation import NULL_METRICS
+from util.projection import LocalProjection
+from util.parser import get_script_path, separator
+from util.export import linestrings_wkb
 
 SHORT_DISTANCE = 0.0000001
 
@@ -21,6 +28,12 @@ class TrafficNetwork:
             - node_id, the id of the section to which the node belongs
         - sections, a dictionary mapping an Aimsun section ID to the sequence of nodes representing that section
         - junctions, a set of nodes representing the meeting point between sections
+        - vertex_sections, a dictionary mapping each vertex to its section ID and position within the section
+        - section_offsets, a dictionary mapping a section ID to the distance of each of its nodes from its first node
+        - snapshot_version, a digest of the graph which identifies results computed on it, built on demand by snapshot
+        - distance_cache, optionally, a DistanceCache of shortest path results, enabled by enable_distance_cache
+        - projection, optionally, a LocalProjection of the network onto a plane in feet, enabled by enable_projection
+        - planar_locations, the projected [x, y] of each vertex, as an array indexed by vertex ID
     """
 
     def __init__(self, junction_map, section_map):
@@ -37,6 +50,12 @@ class TrafficNetwork:
         self.junctions = self.graph.new_vertex_property("bool")
 
         self.sections = dict()
+        self.vertex_sections = None  # Built on demand by index_sections, since the sections change while building.
+        self.section_offsets = None
+        self.snapshot_version = None
+        self.distance_cache = None
+        self.projection = None
+        self.planar_locations = None  # Built by project_vertices, whenever the projection or the vertices change.
 
         self.road_types = {'street': 1,
                            'freeway hov lane': 0,
@@ -265,6 +284,9 @@ class TrafficNetwork:
                         self.edge_weights[self.graph.add_edge(previous_vertex, target)] = new_edge_distance
                 list(map(self.graph.remove_edge, edges_to_remove))  # Remove all relevant edges
             self.sections[section_id] = current_section  # Update the section with the new vertices
+        self.vertex_sections = self.section_offsets = None  # The section index no longer matches the sections.
+        self.snapshot_version = None
+        self.project_vertices()
 
     def merge_edges(self, section, maximum_distance, maximum_angle_delta, greedy=True):
         """
@@ -443,8 +465,27 @@ class TrafficNetwork:
             self.sections[section_id] = [find_vertex(self.graph, original_indices, v)[0] for v in
                                          self.sections[section_id]]
 
+        self.vertex_sections = self.section_offsets = None  # The section index no longer matches the sections.
+        self.snapshot_version = None
+        self.project_vertices()
         return self.graph.num_vertices()
 
+    def snapshot(self):
+        """
+        Computes a digest of the vertices, locations, section IDs and weighted edges of the network. Results computed on
+        the network, such as matched trips, are only valid on a network with the same snapshot. The digest is computed
+        once, and again after split_edges or equalize_node_density change the network.
+        :return: a hexadecimal string
+        """
+        if self.snapshot_version is None:
+            digest = hashlib.sha1()
+            for vertex in self.graph.vertices():
+                digest.update(repr((int(vertex), tuple(self.node_locations[vertex]), self.node_id[vertex])).encode())
+            for edge in self.graph.edges():
+                digest.update(repr((int(edge.source()), int(edge.target()), self.edge_weights[edge])).encode())
+            self.snapshot_version = digest.hexdigest()
+        return self.snapshot_version
+
     def find_section_path(self, section_id1, section_id2):
         """
         Find a path between two sections.
@@ -470,14 +511,24 @@ class TrafficNetwork:
 
         return result
 
-    def find_vertex_path(self, vertex_id1, vertex_id2, as_network_object):
+    def find_vertex_path(self, vertex_id1, vertex_id2, as_network_object, metrics=NULL_METRICS):
         """
         Find the vertices and edges in a path between two vertices.
         :param vertex_id1:
         :param vertex_id2:
         :param as_network_object: whether or not the returned values should be integers or vertex/edge objects
+        :param metrics: optionally, Metrics which count shortest path searches and distance cache hits
         :return:
         """
+        cache = self.current_distance_cache()
+        if cache is not None and not as_network_object:
+            cached = self.cached_vertex_path(cache, int(vertex_id1), int(vertex_id2))
+            if cached is not None:
+                metrics.count('distance_cache_hits')
+                return cached
+            metrics.count('distance_cache_misses')
+
+        metrics.count('dijkstra_calls')
         v1 = self.graph.vertex(vertex_id1)
         v2 = self.graph.vertex(vertex_id2)
         vertices, edges = graph_tool.topology.shortest_path(self.graph, v1, v2, weights=self.edge_weights)
@@ -486,6 +537,12 @@ class TrafficNetwork:
         if not as_network_object:
             vertices = [self.graph.vertex_index[vertex] for vertex in vertices]
             edges = [self.graph.edge_index[edge] for edge in edges]
+            if cache is not None and v1 != v2 and vertices:
+                """ Store each vertex of the path, so that the path can be rebuilt from the cache next time. """
+                distance = 0
+                for predecessor, vertex in zip(vertices, vertices[1:]):
+                    distance += self.edge_weights[self.graph.edge(predecessor, vertex)]
+                    cache.store(vertices[0], vertex, distance, predecessor)
 
         return vertices, edges
 
@@ -494,6 +551,173 @@ class TrafficNetwork:
             return SHORT_DISTANCE
         return graph_tool.topology.shortest_distance(self.graph, v1, v2, weights=self.edge_weights)
 
+    def shortest_distances_from_vertex(self, source, targets, max_distance=None, metrics=NULL_METRICS):
+        """
+        Computes the shortest distance from one vertex to each of many vertices with a single search. If the distance
+        cache is enabled, only the targets which it cannot answer are searched for, and the results are stored.
+        :param source: a vertex id
+        :param targets: a sequence of vertex ids
+        :param max_distance: optionally, the distance in feet beyond which the search stops
+        :param metrics: optionally, Metrics which count shortest path searches and distance cache hits
+        :return: a list of distances in feet, aligned with targets. Unreachable targets, and targets further than
+                 max_distance, have an infinite distance.
+        """
+        if not targets:
+            return []
+        cache = self.current_distance_cache()
+        if cache is None:
+            metrics.count('dijkstra_calls')
+            distances = graph_tool.topology.shortest_distance(self.graph, source, target=list(targets),
+                                                              weights=self.edge_weights, max_dist=max_distance)
+            return [SHORT_DISTANCE if target == source else float(distance)
+                    for target, distance in zip(targets, distances)]
+
+        source = int(source)
+        known = {int(target): cache.distance(source, int(target), max_distance) for target in targets}
+        missing = [target for target, distance in known.items() if distance is None]
+        metrics.count('distance_cache_hits', len(known) - len(missing))
+        if missing:
+            metrics.count('distance_cache_misses', len(missing))
+            metrics.count('dijkstra_calls')
+            distances, predecessors = graph_tool.topology.shortest_distance(
+                self.graph, source, target=missing, weights=self.edge_weights, max_dist=max_distance, pred_map=True)
+            for target, distance in zip(missing, distances):
+                distance = float(distance)
+                reached = not math.isinf(distance)
+                cache.store(source, target, distance, int(predecessors[target]) if reached else None, max_distance)
+                known[target] = distance
+        return [SHORT_DISTANCE if target == source else known[int(target)] for target in targets]
+
+    def enable_distance_cache(self, max_size=1000000):
+        """
+        Caches the results of shortest path searches between vertices, so that a transition which has been searched
+        for once, by any trip, is not searched for again. The cache belongs to the current snapshot of the network,
+        and is emptied if the network changes.
+        :param max_size: the number of (source, target) entries held before the least recently used is evicted. None
+                         disables the cache.
+        """
+        self.distance_cache = None if max_size is None else DistanceCache(self.snapshot(), max_size)
+
+    def current_distance_cache(self):
+        """
+        :return: The distance cache, emptied first if the network has changed since it was filled, or None if it is not
+                 enabled.
+        """
+        if self.distance_cache is not None and self.distance_cache.snapshot != self.snapshot():
+            self.distance_cache = DistanceCache(self.snapshot(), self.distance_cache.max_size)
+        return self.distance_cache
+
+    def cached_vertex_path(self, cache, source, target):
+        """
+        Rebuilds the shortest path from source to target from the predecessors held by the cache.
+        :return: The vertex ids and edge ids of the path, as returned by find_vertex_path, or None if the cache does not
+                 hold every hop of the path.
+        """
+        if source == target:
+            return None
+        vertices = [target]
+        while vertices[-1] != source:
+            predecessor = cache.predecessor(source, vertices[-1])
+            if predecessor is None or len(vertices) > self.graph.num_vertices():
+                return None
+            vertices.append(predecessor)
+        vertices.reverse()
+        edges = [self.graph.edge_index[self.graph.edge(v1, v2)] for v1, v2 in zip(vertices, vertices[1:])]
+        return vertices, edges
+
+    def save_distance_cache(self, filename='distance_cache.pickle', subdirectory='exports'):
+        """
+        Saves the distance cache, so that a later run on the same network can start with it.
+        """
+        self.distance_cache.save(get_script_path(subdirectory) + separator() + filename)
+
+    def load_distance_cache(self, filename='distance_cache.pickle', subdirectory='exports'):
+        """
+        Loads a distance cache saved by save_distance_cache. A cache saved from a different snapshot of the network is
+        ignored.
+        :return: True if the cache was loaded, otherwise False
+        """
+        cache = DistanceCache.load(get_script_path(subdirectory) + separator() + filename)
+        if cache.snapshot != self.snapshot():
+            print('network: distance cache is from a different network snapshot, ignoring it')
+            return False
+        self.distance_cache = cache
+        print('network: loaded {0} cached distances'.format(len(cache)))
+        return True
+
+    def index_sections(self):
+        """
+        Records the section and position of each vertex, and the distance along its section from the first vertex of
+        the section to each vertex. Every vertex belongs to exactly one section, including junction vertices.
+        """
+        self.vertex_sections = {}
+        self.section_offsets = {}
+        for section_id, section in self.sections.items():
+            offsets = [0]
+            for source, target in zip(section, section[1:]):
+                offsets.append(offsets[-1] + self.edge_weights[self.graph.edge(source, target)])
+            self.section_offsets[section_id] = offsets
+            for position, vertex in enumerate(section):
+                self.vertex_sections[int(vertex)] = (section_id, position)
+
+    def section_position(self, vertex):
+        """
+        :param vertex: a vertex id
+        :return: a tuple of (section ID, position of the vertex within the section)
+        """
+        if self.vertex_sections is None:
+            self.index_sections()
+        return self.vertex_sections[int(vertex)]
+
+    def section_length(self, section_id):
+        """
+        :return: The distance in feet from the first to the last vertex of a section.
+        """
+        if self.section_offsets is None:
+            self.index_sections()
+        return self.section_offsets[section_id][-1]
+
+    def section_offset(self, location, vertex):
+        """
+        Projects a location onto the section of a vertex, using the edges of the section on either side of the vertex.
+        :param location: a list in the form [lon, lat]
+        :param vertex: a vertex id
+        :return: a tuple of (section ID, distance in feet along the section to the projected location)
+        """
+        section_id, position = self.section_position(vertex)
+        section = self.sections[section_id]
+        offsets = self.section_offsets[section_id]
+
+        best = None
+        for start in (position - 1, position):
+            if start < 0 or start + 1 >= len(section):
+                continue
+            fraction, distance = utils.project_to_segment(location, self.node_locations[section[start]],
+                                                          self.node_locations[section[start + 1]])
+            if best is None or distance < best[0]:
+                best = (distance, offsets[start] + fraction * (offsets[start + 1] - offsets[start]))
+
+        return section_id, offsets[position] if best is None else best[1]
+
+    def section_vertices(self, section_id, low, high):
+        """
+        :return: The vertex ids of a section which are further than low and at most high feet along the section.
+        """
+        if self.section_offsets is None:
+            self.index_sections()
+        offsets = self.section_offsets[section_id]
+        return [int(vertex) for vertex in
+                self.sections[section_id][bisect_right(offsets, low):bisect_right(offsets, high)]]
+
+    def section_vertex_at(self, section_id, offset):
+        """
+        :return: The id of the last vertex of a section which is at most offset feet along the section.
+        """
+        if self.section_offsets is None:
+            self.index_sections()
+        position = max(bisect_right(self.section_offsets[section_id], offset) - 1, 0)
+        return int(self.sections[section_id][position])
+
     def get_exit_junction(self, id):
         """
         Given a section ID, returns the exit junction. 
@@ -517,9 +741,84 @@ class TrafficNetwork:
 
     def vertex_distance(self, v1, v2):
         """
-        Computes the real distance between two vertices, given their vertex IDs.
+        Computes the real distance between two vertices, given their vertex IDs. Either vertex may instead be a
+        location, as returned by locate, so that a spatial index can be searched for a location which is not a vertex.
+        If a projection is enabled, the distance is planar, within the error bound of the projection, and a location is
+        (x, y) in feet, which is only read, not projected.
+        """
+        if self.projection is not None:
+            x1, y1 = v1 if isinstance(v1, tuple) else self.planar_locations[int(v1)]
+            x2, y2 = v2 if isinstance(v2, tuple) else self.planar_locations[int(v2)]
+            return math.hypot(x2 - x1, y2 - y1)
+        l1 = v1 if isinstance(v1, tuple) else self.node_locations[v1]
+        l2 = v2 if isinstance(v2, tuple) else self.node_locations[v2]
+        return utils.real_distance(l1, l2)
+
+    def enable_projection(self, origin=None):
+        """
+        Projects the network onto a plane, in feet, so that vertex_distance, and the spatial index and score functions
+        which use it, compute distances with planar arithmetic rather than the Haversine Formula. See LocalProjection
+        for the error bound, which is 1e-5 for a network within 25 miles of the origin. Edge weights, and so shortest
+        paths, are unchanged.
+        :param origin: optionally, the (lon, lat) where the plane touches the world. Defaults to the center of the
+                       network.
+        :return: the LocalProjection
+        """
+        if origin is None:
+            locations = self.node_locations.get_2d_array([0, 1])
+            self.projection = LocalProjection.centered_on(locations[0], locations[1])
+        else:
+            self.projection = LocalProjection(*origin)
+        self.project_vertices()
+        return self.projection
+
+    def disable_projection(self):
+        """
+        Returns vertex_distance to the Haversine Formula.
+        """
+        self.projection = self.planar_locations = None
+
+    def project_vertices(self):
+        """
+        Builds planar_locations, the projected [x, y] of each vertex indexed by vertex ID, if a projection is enabled.
+        Called whenever the projection or the vertices change, so that vertex_distance only reads it.
+        """
+        if self.projection is None:
+            self.planar_locations = None
+            return
+        locations = self.node_locations.get_2d_array([0, 1])
+        self.planar_locations = np.column_stack(self.projection.forward(locations[0], locations[1]))
+
+    def locate(self, point):
+        """
+        Finds the location of a data point which vertex_distance accepts in place of a vertex. Locate a data point once,
+        and pass its location to every distance.
+        :param point: A DataPoint, or a list in the form [lon, lat] or [lon, lat, heading].
+        :return: A tuple of (x, y) in feet if a projection is enabled, otherwise of (lon, lat).
+        """
+        lon, lat = (point.lon, point.lat) if hasattr(point, 'lon') else point[:2]
+        return (lon, lat) if self.projection is None else self.projection.project(lon, lat)
+
+    def locate_data(self, data):
+        """
+        Finds the location of every data point of a trip at once, as locate does.
+        :param data: A sequence of DataPoints, or a Trip.
+        :return: A list of tuples.
+        """
+        if self.projection is None:
+            return [(point.lon, point.lat) for point in data]
+        x, y = self.project_data(data)
+        return list(zip(x.tolist(), y.tolist()))
+
+    def project_data(self, data):
+        """
+        Projects data points with the projection of the network.
+        :param data: A sequence of DataPoints, or a Trip.
+        :return: A tuple of (an array of x, an array of y) in feet.
         """
-        return utils.real_distance(self.node_locations[v1], self.node_locations[v2])
+        if hasattr(data, 'records'):
+            return self.projection.forward(data.records['lon'], data.records['lat'])
+        return self.projection.forward([point.lon for point in data], [point.lat for point in data])
 
     def export_nodes(self):
         """
@@ -532,16 +831,20 @@ class TrafficNetwork:
                  'heading': self.node_heading[v]} for v in self.graph.vertices()]
 
     def export_edges(self):
+        edges = self.graph.get_edges([self.edge_weights])
+        locations = self.node_locations.get_2d_array([0, 1])
+        sources, targets = edges[:, 0].astype(int), edges[:, 1].astype(int)
+        lons1, lats1 = locations[0][sources].tolist(), locations[1][sources].tolist()
+        lons2, lats2 = locations[0][targets].tolist(), locations[1][targets].tolist()
         return ['lon1', 'lat1', 'lon2', 'lat2', 'weight', 'line_geom'], \
-               [{'lon1': self.node_locations[e.source()][0],
-                 'lat1': self.node_locations[e.source()][1],
-                 'lon2': self.node_locations[e.target()][0],
-                 'lat2': self.node_locations[e.target()][1],
-                 'weight': self.edge_weights[e],
-                 'line_geom': build_linestring(
-                     shapes.Point.from_list(self.node_locations[e.source()]).as_geometry(),
-                     shapes.Point.from_list(self.node_locations[e.target()]).as_geometry())
-                 } for e in self.graph.edges()]
+               [{'lon1': lon1,
+                 'lat1': lat1,
+                 'lon2': lon2,
+                 'lat2': lat2,
+                 'weight': weight,
+                 'line_geom': line_geom
+                 } for lon1, lat1, lon2, lat2, weight, line_geom in zip(
+                   lons1, lats1, lons2, lats2, edges[:, 2].tolist(), linestrings_wkb(lons1, lats1, lons2, lats2))]
 
     def to_sections(self, path):
         """
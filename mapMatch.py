@@ -1,6 +1,96 @@
+import functools
+import hashlib
+import inspect
+import multiprocessing
+import multiprocessing.util
+import os
+import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from map_match.candidate_cache import CandidateCache
+from map_match.evaluation_fns import LatticeBreak
+from map_match.result_cache import ResultCache
+from map_match.transitions import SectionState, SectionTransitionTable, TransitionMemo, TransitionTable, \
+    elapsed_seconds, reachable_distances
+from util.SearchArea import SearchArea
 from util.Shapes import Point
-from util.export import export as file_export, build_linestring
-import datetime
+from util.instrumentation import Instrumentation, Metrics, NULL_METRICS
+from util.export import BATCH_WRITERS, as_rows, export_columns, export_path, linestrings_wkb, points_wkb
+from util.parser import get_script_path, separator
+from util.utils import real_distances
+
+""" A run of consecutive data points, data[start:stop], which was decoded independently into the path result. """
+Segment = namedtuple('Segment', ['start', 'stop', 'result'])
+
+""" The outcome of a trip of a batch: the filename it was exported to, or the reason that it was not. """
+BatchResult = namedtuple('BatchResult', ['trip', 'filename', 'error'])
+
+""" The MapMatch and trips of the running parallel batch, inherited by forked worker processes. """
+_batch_matcher = None
+_batch_trips = None
+
+
+def _init_batch_worker():
+    """
+    Runs once in each worker process. Threads do not survive a fork, so the transition thread pool is replaced.
+    """
+    if _batch_matcher.transition_executor is not None:
+        _batch_matcher.transition_executor = ThreadPoolExecutor(_batch_matcher.transition_workers)
+    if _batch_matcher.batch_writer is not None:
+        """ Write the rows still buffered when the worker exits. """
+        multiprocessing.util.Finalize(_batch_matcher.batch_writer, _batch_matcher.batch_writer.close, exitpriority=10)
+
+
+def _process_batch_trip(trip, date, min_path):
+    """
+    Processes a trip of the running parallel batch in a worker process.
+    :return: a tuple of (BatchResult, the Metrics of the trip or None)
+    """
+    result = _batch_matcher.process_trip(trip, _batch_trips[trip], date, min_path)
+    return result, (_batch_matcher.metrics if _batch_matcher.instrumentation is not None else None)
+
+
+def stable_repr(value):
+    """
+    Describes a configuration value by text which is the same in every process, for trip_key. Functions are described
+    by their module and name, and a function without a unique name, such as a lambda, also by its code, defaults and
+    closure. A functools.partial is described by its function and arguments.
+    :return: a string
+    :raises ValueError: if value has no stable description, such as an object whose repr holds its memory address
+    """
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return repr(value)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [stable_repr(item) for item in value]
+        return '{0}({1})'.format(type(value).__name__, ', '.join(sorted(items) if isinstance(value, (set, frozenset))
+                                                                  else items))
+    if isinstance(value, dict):
+        return 'dict({0})'.format(', '.join(sorted('{0}: {1}'.format(stable_repr(key), stable_repr(item))
+                                                   for key, item in value.items())))
+    if isinstance(value, np.ndarray):
+        return 'array({0}, {1})'.format(stable_repr(value.tolist()), value.dtype)
+    if isinstance(value, functools.partial):
+        return 'partial({0}, {1}, {2})'.format(stable_repr(value.func), stable_repr(value.args),
+                                               stable_repr(value.keywords))
+    if isinstance(value, types.CodeType):
+        return 'code({0}, {1}, {2})'.format(value.co_code.hex(), stable_repr(value.co_consts),
+                                            stable_repr(value.co_names))
+    if callable(value) and hasattr(value, '__qualname__'):
+        name = '{0}.{1}'.format(getattr(value, '__module__', None), value.__qualname__)
+        if isinstance(value, types.FunctionType) and ('<lambda>' in name or '<locals>' in name):
+            """ Such a name may belong to many functions, so the function itself is described. """
+            closure = [cell.cell_contents for cell in value.__closure__ or ()]
+            return '{0}({1}, {2}, {3}, {4})'.format(name, stable_repr(value.__code__), stable_repr(value.__defaults__),
+                                                     stable_repr(value.__kwdefaults__), stable_repr(closure))
+        return name
+    text = repr(value)
+    if ' at 0x' in text or text.startswith('<'):
+        raise ValueError('{0} has no stable repr, so it cannot be part of a result cache key'.format(text))
+    return text
+
 
 class MapMatch:
     def __init__(self, network, tree, score, evaluation, data):
@@ -20,7 +110,27 @@ class MapMatch:
         self.data = data
         self.score_args = None
         self.evaluation_args = None
+        self.pruning_args = None
+        self.segmentation_args = None
+        self.segment_workers = 1
+        self.transition_workers = 1
+        self.prefetch_transitions = False
+        self.transition_executor = None
+        self.section_states = False
+        self.num_candidates = 20
+        self.search_area_args = None
+        self.result_cache = None
+        self.candidate_cache = None
+        self.batch_writer = None
+        self.instrumentation = None
+        self.metrics = NULL_METRICS
+        self.memo_data = None  # The data which the candidate and transition memos belong to.
+        self.locations = None  # The location of each data point, as network.locate finds it, by (lon, lat).
+        self.knn_memo = None
+        self.transition_memo = None
         self.matches = None
+        self.lattice = None
+        self.segments = None
         self.result = None
 
     @classmethod
@@ -45,60 +155,391 @@ class MapMatch:
         self.score_args = score_args
         self.evaluation_args = evaluation_args
 
+    def specify_pruning(self, tolerance=1.5, minimum_speed=40, slack=1000):
+        """
+        Bounds the network distance of each transition by how far a vehicle could travel between two consecutive data
+        points, given their timestamps and speeds. Transitions beyond the bound are treated as impossible, and are
+        never searched. The evaluation function must accept a transitions argument, like viterbi.
+        :param tolerance: a multiplier on the distance travelled at the reported speed. None disables pruning.
+        :param minimum_speed: the speed in km/h assumed for a vehicle which reports a lower speed
+        :param slack: a distance in feet added to every bound, to allow for GPS noise
+        """
+        self.pruning_args = None if tolerance is None else (tolerance, minimum_speed, slack)
+
+    def specify_segmentation(self, max_gap=300, tolerance=3, minimum_speed=40, slack=1000, workers=1):
+        """
+        Specifies where a trip is split into sub-trips which are decoded independently. A trip is always split at a
+        data point which has no candidates, and wherever the evaluation function raises a LatticeBreak. Splitting at
+        time gaps and jumps is disabled until this is called.
+        :param max_gap: the longest time in seconds between consecutive data points of a sub-trip. None disables.
+        :param tolerance: a data point which is further in a straight line from the previous data point than it could
+                          have travelled (see reachable_distances) begins a new sub-trip. None disables.
+        :param minimum_speed: the speed in km/h assumed for a vehicle which reports a lower speed
+        :param slack: a distance in feet added to the distance that a vehicle could have travelled
+        :param workers: the number of sub-trips to decode in parallel
+        """
+        self.segmentation_args = (max_gap, tolerance, minimum_speed, slack)
+        self.segment_workers = workers
+
+    def specify_transition_workers(self, workers=1, prefetch=False):
+        """
+        Specifies the number of threads used to search for transition distances. The evaluation function must accept
+        a transitions argument, like viterbi.
+        :param workers: the size of the thread pool. 1 runs every search on the calling thread.
+        :param prefetch: whether the transitions of every column should be computed at once, before decoding. Suits
+                         viterbi, which visits the whole lattice, but not viterbi_optimized.
+        """
+        if self.transition_executor is not None:
+            self.transition_executor.shutdown()
+            self.transition_executor = None
+        self.transition_workers = workers
+        self.prefetch_transitions = prefetch
+        if workers > 1:
+            self.transition_executor = ThreadPoolExecutor(workers)
+
+    def specify_section_states(self, enabled=True):
+        """
+        Specifies whether the path is decoded over section states rather than candidate vertices. The candidates of a
+        data point are reduced to one per section, the highest scoring, and the data point is projected onto that
+        section. Transitions along a section are then computed without a search. The evaluation function must accept
+        a transitions argument, like viterbi. The exported matches are still the scored candidate vertices.
+        :param enabled: True to decode over section states, False to decode over vertices
+        """
+        self.section_states = enabled
+
+    def specify_result_cache(self, filename='result_cache.sqlite', subdirectory='exports'):
+        """
+        Specifies a store of matched trips for batch_process. A trip which has already been matched with the same
+        data points, network snapshot and configuration is loaded from the store rather than matched, and is not
+        exported again if its files still exist. Trips are stored as they finish, so a batch which stopped part of the
+        way through resumes where it stopped.
+        :param filename: the name of the SQLite file of the store. None disables the store.
+        :param subdirectory: the directory of the store
+        """
+        self.result_cache = None if filename is None else \
+            ResultCache(get_script_path(subdirectory) + separator() + filename)
+
+    def specify_candidate_count(self, num_results=20):
+        """
+        Specifies the number of candidates found for each data point when the score function does not ask for a number.
+        :param num_results: the number of nearest vertices searched for
+        """
+        self.num_candidates = num_results
+
+    def specify_search_area(self, distance=500, width=50, fanout=90):
+        """
+        Restricts the candidates of each data point with a bearing to those within a SearchArea aligned with the
+        bearing: a band of width feet on either side of the data point, reaching distance feet ahead of and behind it,
+        and widening by the fanout angle. A data point with no candidates within its area keeps all of them.
+        :param distance: the length in feet of the area ahead of and behind the data point. None disables.
+        :param width: the distance in feet from the data point to either side of the area, beside the data point
+        :param fanout: the angle between each side of the area and the perpendicular to the bearing. 90 gives a
+                       rectangle.
+        """
+        self.search_area_args = None if distance is None else (distance, width, fanout)
+
+    def restrict_to_search_area(self, point, candidates):
+        """
+        :param point: A DataPoint.
+        :param candidates: A list of vertices.
+        :return: The candidates within the search area of the data point, or every candidate if none are within it or
+                 the data point has no bearing.
+        """
+        if not candidates or getattr(point, 'bearing', None) is None:
+            return candidates
+        area = SearchArea(Point(point.lon, point.lat, point.bearing), *self.search_area_args)
+        locations = [self.network.node_locations[vertex] for vertex in candidates]
+        inside = area.contains_many([location[0] for location in locations], [location[1] for location in locations])
+        restricted = [vertex for vertex, keep in zip(candidates, inside) if keep]
+        return restricted or candidates
+
+    def specify_candidate_cache(self, cell_size=10, max_size=100000):
+        """
+        Specifies a cache of the candidates found by find_knn, shared by every trip. A location within cell_size feet
+        of a location which was already searched, in the same cell, reuses its candidates rather than searching the
+        tree. Worker processes of a parallel batch each fill their own copy of the cache.
+        :param cell_size: the width in feet of a cell. None disables the cache.
+        :param max_size: the number of cells held before the least recently used is evicted
+        """
+        self.candidate_cache = None if cell_size is None else CandidateCache(cell_size, max_size)
+
+    def specify_batch_output(self, output_format=None, filename='batch', buffer_rows=100000):
+        """
+        Specifies how batch_process exports its trips. By default, each trip is exported to its own pair of CSVs.
+        Otherwise, the matches and paths of every trip are written to a single output, with a trip column holding the
+        number used in the CSV filenames, and rows are written in blocks.
+        :param output_format: None for CSVs, 'sqlite' for the tables matches and path in ~/exports/<filename>.sqlite,
+                              or 'parquet' for the datasets ~/exports/<filename>/matches/ and ~/exports/<filename>/path/
+                              (requires pyarrow). Any existing output of the same name is replaced by the next batch.
+        :param filename: the name of the output, without an extension
+        :param buffer_rows: the number of rows buffered before they are written
+        """
+        self.batch_writer = None if output_format is None else \
+            BATCH_WRITERS[output_format](filename, buffer_rows)
+
+    def specify_instrumentation(self, enabled=True):
+        """
+        Specifies whether the time and number of calls of each stage (see util.instrumentation.STAGES), and counters
+        such as shortest path searches and cache hits, are recorded. Single matches are recorded in self.metrics.
+        batch_process records each trip in self.instrumentation, and prints the totals at the end of the batch.
+        Transition searches are only recorded if the evaluation function accepts a transitions argument, like viterbi.
+        :param enabled: True to record, False to record nothing
+        """
+        self.instrumentation = Instrumentation() if enabled else None
+        self.metrics = Metrics() if enabled else NULL_METRICS
+
+    def trip_key(self, data):
+        """
+        Computes the key under which the result of a trip is stored, from its data points, the network snapshot, the
+        functions and arguments used for scoring and evaluation, the pruning, segmentation and section state
+        configuration, the projection of the network, the number of candidates of each data point, and the cells of
+        the candidate cache, if there is one. The configuration is described by stable_repr, so that the key is the
+        same in every process.
+        :param data: the data of the trip
+        :return: a hexadecimal string
+        :raises ValueError: if the configuration holds a value with no stable description
+        """
+        configuration = (self.score, self.score_args, self.evaluation, self.evaluation_args,
+                         self.pruning_args, self.segmentation_args, self.section_states, self.search_area_args,
+                         getattr(self.network, 'projection', None), self.num_candidates)
+        if self.candidate_cache is not None:
+            """ A cached location stands for every location in its cell, so the cells change the candidates. """
+            configuration += (self.candidate_cache.cell_size,)
+        digest = hashlib.sha1()
+        digest.update(self.network.snapshot().encode())
+        digest.update(stable_repr(configuration).encode())
+        for point in data:
+            digest.update(repr((point.lon, point.lat, point.bearing, point.speed, point.timestamp)).encode())
+        return digest.hexdigest()
+
     def match(self):
         """
         Matches each point in data to a position in network using a map matching algorithm
-        defined by the score and evaluation functions.
+        defined by the score and evaluation functions. The candidates and transitions found for the data are kept, so
+        matching the same data again, such as after update_fn or specify_configuration, only repeats the scoring and
+        decoding arithmetic.
         :return: The result, in the form of the return of evaluation.
         """
+        self.prepare_memo()
         print('mm: finding/scoring candidates...')
-        if self.score_args:
-            self.matches = [self.score(i, self.data, self.find_knn, self.network, *self.score_args)
-                            for i in range(len(self.data))]
-        else:
-            self.matches = [self.score(i, self.data, self.find_knn, self.network) for i in range(len(self.data))]
+        self.score_data(self.remembered_knn)
 
         print('mm: searching for correct path...')
-        if self.evaluation_args:
-            self.result = self.evaluation(self.network, self.matches, *self.evaluation_args)
-        else:
-            self.result = self.evaluation(self.network, self.matches)
+        self.infer_path()
 
         return self.matches, self.result
 
-    def find_knn(self, point, num_results=20):
+    def prepare_memo(self):
         """
-        Given a point p, search for the k points nearest to p.
-        :param point: A list in the form, [lon, lat]
-        :param num_results: The number of neighbors to be found
-        :return: A list of node IDs
+        Empties the candidate and transition memos if the data has changed since they were filled.
+        """
+        if self.memo_data is not self.data:
+            self.memo_data = self.data
+            self.knn_memo = {}
+            self.transition_memo = TransitionMemo()
+
+    def remembered_knn(self, point, num_results=None):
+        """
+        Finds the candidates of a location with find_knn, unless they were already found for the current data.
+        """
+        num_results = self.num_candidates if num_results is None else num_results
+        key = (tuple(point), num_results)
+        if key not in self.knn_memo:
+            self.knn_memo[key] = self.find_knn(point, num_results)
+        return list(self.knn_memo[key])
+
+    def score_data(self, find_candidates):
+        """
+        Scores the candidates of each data point, and builds the lattice which infer_path decodes.
+        :param find_candidates: A function which maps a location in the form [lon, lat] to a list of candidate vertices,
+                                such as find_knn.
         """
-        """ Add point to the logical network, perform the k-nn search in the tree, and then remove the
-        point from the logical network. """
-        #print('')
+        if self.search_area_args is not None:
+            """ Score functions pass only the location of a data point, so the data point, and its bearing, is found
+            by its location. """
+            points = {}
+            for point in self.data:
+                points.setdefault(tuple(point.as_list()), point)
+            unrestricted = find_candidates
 
-        #start=datetime.datetime.now()
-        v = self.network.graph.add_vertex()
-        self.network.node_locations[v] = point
-        #print('cost of adding: {0}'.format(datetime.datetime.now() - start))
+            def find_candidates(location, num_results=None):
+                candidates = unrestricted(location, num_results)
+                point = points.get(tuple(location))
+                return candidates if point is None else self.restrict_to_search_area(point, candidates)
+
+        self.locate_data(self.data)
+        with self.metrics.time('scoring'):
+            self.matches = [self.score(i, self.data, find_candidates, self.network, *(self.score_args or ()))
+                            for i in range(len(self.data))]
 
-        #start=datetime.datetime.now()
-        search_result = self.tree.search(v, limit=num_results)
-        #print('cost of searching: {0}'.format(datetime.datetime.now() - start))
+        # The candidates and scores to decode: the scored vertices, or one state per section.
+        if self.section_states:
+            self.lattice = [self.to_section_states(i) for i in range(len(self.data))]
+        else:
+            self.lattice = self.matches
 
+    def infer_path(self):
+        """
+        Splits the scored data into runs, and decodes the most probable path through each run.
+        :return: The result, the concatenated path of every segment.
+        """
+        self.prepare_memo()
+        with self.metrics.time('decoding'):
+            ranges = self.split_trip()
+            if self.segment_workers > 1 and len(ranges) > 1:
+                with ThreadPoolExecutor(self.segment_workers) as executor:
+                    decoded = list(executor.map(lambda bounds: self.decode(*bounds), ranges))
+            else:
+                decoded = [self.decode(start, stop) for start, stop in ranges]
 
-        #start=datetime.datetime.now()
-        result = [item for item in search_result] #[item for item in search_result] #
-        #print('cost of materializing: {0}'.format(datetime.datetime.now() - start))
+        self.segments = [segment for segments in decoded for segment in segments]
+        self.result = [vertex for segment in self.segments for vertex in segment.result]
+        return self.result
 
-        #start=datetime.datetime.now()
-        self.network.graph.remove_vertex(v, fast=True)
-        #print('cost of removing: {0}'.format(datetime.datetime.now() - start))
+    def split_trip(self):
+        """
+        Splits the data into runs of consecutive data points that can be decoded independently. A run ends before a
+        data point without candidates, which is left out, and before a time gap or a jump which is longer than
+        allowed by the segmentation configuration, if one has been specified.
+        :return: A list of (start, stop) pairs, such that data[start:stop] is a run.
+        """
+        max_gap, tolerance, minimum_speed, slack = self.segmentation_args or (None, None, None, None)
+        jump_distances = reachable_distances(self.data, tolerance, minimum_speed, slack) if tolerance else None
+        if jump_distances is not None and len(self.data) > 1:
+            """ The straight line distance between each pair of consecutive data points, all at once. """
+            lons = np.array([point.lon for point in self.data])
+            lats = np.array([point.lat for point in self.data])
+            jumps = real_distances(lons[:-1], lats[:-1], lons[1:], lats[1:])
+
+        def is_break(index):
+            """
+            :return: True if data[index] cannot follow data[index - 1] in the same run.
+            """
+            previous, current = self.data[index - 1], self.data[index]
+            elapsed = elapsed_seconds(previous, current)
+            if max_gap is not None and elapsed is not None and elapsed > max_gap:
+                return True
+            return jump_distances is not None and jumps[index - 1] > jump_distances[index - 1]
+
+        ranges = []
+        start = None
+        for index, candidates in enumerate(self.matches):
+            if not candidates:
+                if start is not None:
+                    ranges.append((start, index))
+                start = None
+            elif start is None:
+                start = index
+            elif is_break(index):
+                ranges.append((start, index))
+                start = index
+        if start is not None:
+            ranges.append((start, len(self.matches)))
+        return ranges
+
+    def decode(self, start, stop):
+        """
+        Finds the most probable path through the candidates of data[start:stop] using the evaluation function. If the
+        evaluation function raises a LatticeBreak, the path before the break is kept, and decoding restarts at the
+        first data point which could not be reached.
+        :return: A list of Segments.
+        """
+        segments = []
+        while start < stop:
+            scores = self.lattice[start:stop]
+            evaluation_kwargs = {}
+            transitions = self.transition_table(start, stop)
+            if transitions is not None:
+                evaluation_kwargs['transitions'] = transitions
+
+            try:
+                result = self.evaluation(self.network, scores, *(self.evaluation_args or ()), **evaluation_kwargs)
+            except LatticeBreak as lattice_break:
+                if lattice_break.path:
+                    path = transitions.vertices(lattice_break.path) if transitions else lattice_break.path
+                    segments.append(Segment(start, start + lattice_break.index, path))
+                start += max(lattice_break.index, 1)  # A break at the first data point leaves it out.
+                continue
+
+            segments.append(Segment(start, stop, transitions.vertices(result) if transitions else result))
+            break
+        return segments
+
+    def transition_table(self, start, stop):
+        """
+        Builds the TransitionTable for the candidates of data[start:stop], using the pruning, transition worker and
+        instrumentation configuration. The table reads and writes the transition memo of the current data.
+        :return: A TransitionTable, or None if the evaluation function does not accept one and the configuration does
+                 not need one.
+        """
+        if not self.pruning_args and self.transition_executor is None and not self.section_states and \
+                'transitions' not in inspect.signature(self.evaluation).parameters:
+            return None
+
+        max_distances = reachable_distances(self.data[start:stop], *self.pruning_args) if self.pruning_args else None
+        table = SectionTransitionTable if self.section_states else TransitionTable
+        transitions = table(self.network, self.lattice[start:stop], max_distances, self.transition_executor,
+                            self.metrics, self.transition_memo, start)
+        if self.prefetch_transitions:
+            transitions.prefetch()
+        return transitions
+
+    def to_section_states(self, index):
+        """
+        Reduces the scored candidates of a data point to the highest scoring candidate of each section, and projects
+        the data point onto each of those sections.
+        :param index: The index of a data point.
+        :return: A dictionary mapping SectionStates to scores.
+        """
+        best = {}
+        for vertex, score in self.matches[index].items():
+            section_id = self.network.section_position(vertex)[0]
+            if section_id not in best or score > best[section_id][1]:
+                best[section_id] = (vertex, score)
+
+        location = self.data[index].as_list()
+        states = {}
+        for vertex, score in best.values():
+            section_id, offset = self.network.section_offset(location, vertex)
+            states[SectionState(section_id, offset, vertex)] = score
+        return states
+
+    def locate_data(self, data):
+        """
+        Locates every data point of a trip at once with network.locate_data, so that find_knn searches for each data
+        point without projecting it again.
+        """
+        self.locations = dict(zip(((point.lon, point.lat) for point in data), self.network.locate_data(data)))
+
+    def find_knn(self, point, num_results=None):
+        """
+        Given a point p, search for the k points nearest to p.
+        :param point: A list in the form, [lon, lat], or [lon, lat, heading]
+        :param num_results: The number of neighbors to be found. Defaults to the candidate count.
+        :return: A list of node IDs
+        """
+        num_results = self.num_candidates if num_results is None else num_results
+        key = None
+        if self.candidate_cache is not None:
+            key = self.candidate_cache.key(point, num_results)
+            cached = self.candidate_cache.get(key)
+            self.metrics.count('candidate_cache_hits' if cached is not None else 'candidate_cache_misses')
+            if cached is not None:
+                return list(cached)
+
+        """ Search the tree with the location itself, which network.vertex_distance accepts in place of a vertex.
+        The network is not modified, so searches may run alongside other searches and shortest path queries. """
+        location = self.locations.get(tuple(point[:2])) if self.locations else None
+        with self.metrics.time('knn'):
+            result = list(self.tree.search(location or self.network.locate(point), limit=num_results))
+        if key is not None:
+            self.candidate_cache.put(key, result)
         return result
 
     def update_fn(self, score=None, evaluation=None):
         """
-        Updates the functions used in the map matching algorithm and calls match again.
+        Updates the functions used in the map matching algorithm and calls match again. The candidates and transitions
+        of the current data are reused.
         :param score: a score function
         :param evaluation: an evaluation function
         """
@@ -113,97 +554,274 @@ class MapMatch:
         self.data = data
         return self.match()
 
-    def batch_process(self, data_items, date="", score=None, evaluation=None, min_path=15):
+    def batch_process(self, data_items, date="", score=None, evaluation=None, min_path=15, processes=1):
         """
+        Matches each trip of data_items, and exports the matches and path of each trip to its own pair of files.
         :param data_items: a list of data
         :param date: optionally, a date string which will be prepended to the filename
+        :param score: optionally, the score function to use for the batch
+        :param evaluation: optionally, the evaluation function to use for the batch
+        :param min_path: trips with fewer data points are skipped
+        :param processes: the number of worker processes. Workers are forked after the network and tree are built, so
+                          they share them copy-on-write. Requires a platform which can fork.
+        If a result cache has been specified, trips which it holds are not matched again (see specify_result_cache).
+        :return: a list of BatchResults, ordered by trip
         """
-        cache_data = self.data, self.matches, self.result, self.score, self.evaluation  # Save current information
+        cache_data = self.data, self.matches, self.lattice, self.segments, self.result, self.score, self.evaluation, \
+            self.metrics
         if score:
             self.score = score
         if evaluation:
             self.evaluation = evaluation
 
-        num_trips = 0
-
+        results = []
         if self.score and self.evaluation:
             print('beginning batch process on {0} data sets...'.format(len(data_items)))
-            for trip, data in enumerate(data_items):
-                num_trips +=1
-                if not data:
-                    print("no data being passed in ")
-                    print("trip: ", trip)
-                    break
-                if len(data) < min_path:
-                    print("too few points in trip", trip)
-                    continue
-                try:
-                    self.update_data(data)
-                    filename = "trip_" + str(num_trips) + "_" + date + "_" + self.network.node_id[self.result[0]] + "_to_" + self.network.node_id[self.result[-1]]
-                except:
-                    print("excepted out")
-                    print(self.data)
-                    continue
-                # if len(self.result) == 0:
-                #     print(self.data)
-                file_export(*self.export_matches(), filename + "_matches")
-                file_export(*self.export_path(), filename + "_path")
-                print('\tfinished {0}...'.format(filename))
-                print('completed {0} trips'.format(num_trips))
-        self.data, self.matches, self.result, self.score, self.evaluation = cache_data  # Restore at end
-
-    def export_matches(self):
+            if self.batch_writer is not None:
+                self.batch_writer.start()
+            if processes > 1:
+                results = self.parallel_batch(data_items, date, min_path, processes)
+            else:
+                for trip, data in enumerate(data_items):
+                    if not data:
+                        print("no data being passed in ")
+                        print("trip: ", trip)
+                    results.append(self.process_trip(trip, data, date, min_path))
+                    print('completed {0} trips'.format(trip + 1))
+            if self.batch_writer is not None:
+                self.batch_writer.close()
+            if self.result_cache is not None:
+                print('result cache holds {0} trips'.format(len(self.result_cache)))
+            if self.candidate_cache is not None and processes <= 1:
+                print('candidate cache: {0}'.format(self.candidate_cache.stats()))
+            if self.instrumentation is not None:
+                self.instrumentation.print_report()
+        self.data, self.matches, self.lattice, self.segments, self.result, self.score, self.evaluation, \
+            self.metrics = cache_data
+        return results
+
+    def process_trip(self, trip, data, date, min_path):
+        """
+        Matches a single trip of a batch and exports its matches and path. The filename depends only on the position
+        of the trip in the batch and its path, so it does not depend on the order in which trips are processed.
+        :param trip: the index of the trip in the batch
+        :param data: the data of the trip
+        :param date: a date string which will be prepended to the filename
+        :param min_path: trips with fewer data points are skipped
+        :return: a BatchResult
+        """
+        """ Start the metrics of the trip before any early return, so that a skipped trip does not report the metrics
+        of the trip before it. """
+        if self.instrumentation is not None:
+            self.metrics = self.instrumentation.trip(trip)
+        if not data:
+            return BatchResult(trip, None, 'no data')
+        if len(data) < min_path:
+            print("too few points in trip", trip)
+            return BatchResult(trip, None, 'too few points')
+        key = self.trip_key(data) if self.result_cache is not None else None
+        try:
+            restored, exported = self.restore_result(key, data) if key else (False, None)
+            if not restored:
+                self.update_data(data)
+                if key:
+                    self.store_result(key)
+            else:
+                """ The trip was matched by an earlier run. Skip the export too if its files are still there. """
+                filename = self.exported_filename(trip, date, exported)
+                if filename is not None:
+                    print('\talready exported {0}...'.format(filename))
+                    return BatchResult(trip, filename, None)
+
+            result = self.export_trip(trip, date)
+            if key and result.filename:
+                self.result_cache.record_export(key, result.filename)
+            return result
+        except Exception as exception:
+            print("excepted out")
+            print(self.data)
+            return BatchResult(trip, None, repr(exception))
+
+    def restore_result(self, key, data):
+        """
+        Restores the result of a trip from the result cache, if the cache holds it.
+        :param key: the key of the trip, from trip_key
+        :param data: the data of the trip
+        :return: A tuple of (whether the result was restored, the filename it was last exported to, or None)
+        """
+        cached = self.result_cache.get(key)
+        self.metrics.count('result_cache_hits' if cached is not None else 'result_cache_misses')
+        if cached is None:
+            return False, None
+        (matches, segments), exported = cached
+        self.load_result(data, matches, [Segment(*segment) for segment in segments])
+        return True, exported
+
+    def store_result(self, key):
+        """
+        Stores the result of the current data in the result cache.
+        :param key: the key of the trip, from trip_key
+        """
+        self.result_cache.put(key, (self.matches, [tuple(segment) for segment in self.segments]))
+
+    def exported_filename(self, trip, date, exported):
+        """
+        :param exported: the filename which the trip was last exported to, as returned by restore_result
+        :return: The filename of the current result if its files were already exported and are still there, otherwise
+                 None.
+        """
+        filename = self.trip_filename(trip, date)
+        if self.batch_writer is None and filename is not None and filename == exported and \
+                os.path.exists(export_path(filename + "_matches")) and os.path.exists(export_path(filename + "_path")):
+            return filename
+        return None
+
+    def export_trip(self, trip, date):
+        """
+        Exports the matches and path of the current data, once it has been matched, as a trip of a batch. The trip is
+        written to the batch output if one has been specified, and is otherwise exported to its own pair of files.
+        :param trip: the index of the trip in the batch
+        :param date: a date string which will be prepended to the filename
+        :return: a BatchResult
+        """
+        filename = self.trip_filename(trip, date)
+        if filename is None:
+            print("no path found in trip", trip)
+            return BatchResult(trip, None, 'no path found')
+        with self.metrics.time('export'):
+            if self.batch_writer is not None:
+                self.batch_writer.write_columns('matches', *self.export_matches(as_columns=True), trip=trip + 1)
+                self.batch_writer.write_columns('path', *self.export_path(as_columns=True), trip=trip + 1)
+            else:
+                export_columns(*self.export_matches(as_columns=True), filename + "_matches")
+                export_columns(*self.export_path(as_columns=True), filename + "_path")
+        print('\tfinished {0}...'.format(filename))
+        return BatchResult(trip, filename, None)
+
+    def trip_filename(self, trip, date):
+        """
+        :param trip: the index of the trip in the batch
+        :param date: a date string which will be prepended to the filename
+        :return: The name under which export_trip exports the current result, or None if there is no path.
+        """
+        if not self.result:
+            return None
+        return "trip_" + str(trip + 1) + "_" + date + "_" + self.network.node_id[self.result[0]] + "_to_" + \
+               self.network.node_id[self.result[-1]]
+
+    def load_result(self, data, matches, segments):
+        """
+        Restores the matches and path of a trip which was matched earlier, so that it can be exported without being
+        matched again.
+        :param data: the data of the trip
+        :param matches: the scored candidates of each data point
+        :param segments: a list of Segments
+        """
+        self.data = data
+        self.matches = matches
+        self.lattice = None
+        self.segments = segments
+        self.result = [vertex for segment in segments for vertex in segment.result]
+
+    def parallel_batch(self, data_items, date, min_path, processes):
+        """
+        Processes the trips of a batch on a pool of forked worker processes. Trips are handed out one at a time,
+        longest first, so that a long trip is not left until the end.
+        :return: a list of BatchResults, ordered by trip
+        """
+        global _batch_matcher, _batch_trips
+        _batch_matcher, _batch_trips = self, data_items
+        order = sorted(range(len(data_items)), key=lambda trip: len(data_items[trip] or ()), reverse=True)
+
+        results = []
+        try:
+            with multiprocessing.get_context('fork').Pool(processes, initializer=_init_batch_worker) as pool:
+                for result, metrics in pool.imap_unordered(
+                        functools.partial(_process_batch_trip, date=date, min_path=min_path), order):
+                    if metrics is not None:
+                        self.instrumentation.add(result.trip, metrics)
+                    results.append(result)
+                    print('completed {0} of {1} trips'.format(len(results), len(data_items)))
+                """ Let the workers exit on their own, rather than be terminated, so that they flush their output. """
+                pool.close()
+                pool.join()
+        finally:
+            _batch_matcher, _batch_trips = None, None
+
+        failures = [result for result in results if result.error is not None]
+        print('batch finished: {0} exported, {1} failed'.format(len(results) - len(failures), len(failures)))
+        return sorted(results)
+
+    def export_matches(self, as_columns=False):
         """
         Export the GPS point, and the geoposition and ID of the node which it was matched to a format suitable for
         util.export.export.
-        :return: (list of string, list of dictionaries)
+        :param as_columns: whether to return the rows as columns, in a format suitable for util.export.export_columns,
+                           rather than build a dictionary per row
+        :return: (list of string, list of dictionaries), or (list of string, dictionary of lists) with as_columns
         """
         assert self.matches is not None
         header = ['gps_lon', 'gps_lat', 'gps_heading', 'match_lon', 'match_lat', 'match_heading', 'timestamp', 'score',
-                  'gps_point', 'match_point', 'line_geom']
-        result = []
-        for probe_data, candidate in zip(self.data, self.matches):
-            result.extend({'gps_lon': probe_data.as_list()[0],
-                           'gps_lat': probe_data.as_list()[1],
-                           'gps_heading': probe_data.bearing,
-                           'match_lon': self.network.node_locations[v_id][0],
-                           'match_lat': self.network.node_locations[v_id][1],
-                           'match_heading': self.network.node_heading[v_id],
-                           'timestamp': probe_data.timestamp,
-                           'score': score,
-                           'gps_point': probe_data.as_geometry(),
-                           'match_point': Point.from_list(self.network.node_locations[v_id]).as_geometry(),
-                           'line_geom': build_linestring(
-                               probe_data.as_geometry(),
-                               Point.from_list(self.network.node_locations[v_id]).as_geometry())
-                           } for v_id, score in candidate.items())
-
-        return header, result
-
-    def export_path(self):
+                  'segment', 'gps_point', 'match_point', 'line_geom']
+
+        # The index of the segment which each data point belongs to, or None if it was left out of every segment.
+        segment_ids = [None] * len(self.data)
+        for segment_id, segment in enumerate(self.segments or []):
+            segment_ids[segment.start:segment.stop] = [segment_id] * (segment.stop - segment.start)
+
+        """ Gather each column of every row, one candidate of one data point per row. """
+        points = [(probe_data, v_id, score, segment_id)
+                  for probe_data, candidate, segment_id in zip(self.data, self.matches, segment_ids)
+                  for v_id, score in candidate.items()]
+        columns = {'gps_lon': [probe_data.lon for probe_data, _, _, _ in points],
+                   'gps_lat': [probe_data.lat for probe_data, _, _, _ in points],
+                   'gps_heading': [probe_data.bearing for probe_data, _, _, _ in points],
+                   'match_lon': [self.network.node_locations[v_id][0] for _, v_id, _, _ in points],
+                   'match_lat': [self.network.node_locations[v_id][1] for _, v_id, _, _ in points],
+                   'match_heading': [self.network.node_heading[v_id] for _, v_id, _, _ in points],
+                   'timestamp': [probe_data.timestamp for probe_data, _, _, _ in points],
+                   'score': [score for _, _, score, _ in points],
+                   'segment': [segment_id for _, _, _, segment_id in points]}
+
+        """ Encode the geometry of every row at once. """
+        columns['gps_point'] = points_wkb(columns['gps_lon'], columns['gps_lat'])
+        columns['match_point'] = points_wkb(columns['match_lon'], columns['match_lat'])
+        columns['line_geom'] = linestrings_wkb(columns['gps_lon'], columns['gps_lat'],
+                                               columns['match_lon'], columns['match_lat'])
+
+        return header, columns if as_columns else as_rows(header, columns)
+
+    def export_path(self, as_columns=False):
+        """
+        Export each edge of the inferred path, labelled with the segment it belongs to, in a format suitable for
+        util.export.export. Edges never join the end of one segment to the start of the next.
+        :param as_columns: whether to return the rows as columns, in a format suitable for util.export.export_columns,
+                           rather than build a dictionary per row
+        :return: (list of string, list of dictionaries), or (list of string, dictionary of lists) with as_columns
+        """
         assert self.result is not None
         # print("result: ", [self.network.node_id[v_id] for v_id in self.result])
-        header = ['lon1', 'lat1', 'id1', 'lon2', 'lat2', 'id2', 'line_geom']
+        header = ['lon1', 'lat1', 'id1', 'lon2', 'lat2', 'id2', 'segment', 'line_geom']
         if len(self.result) == 0:
             print(self.data)
             print("no result")
-            return header, [{'lon1': None,
-                             'lat1': None,
-                             'lon2': None,
-                             'lat2': None,
-                             'line_geom': None}]
+            columns = {column: [None] for column in header}
+            return header, columns if as_columns else as_rows(header, columns)
         if len(self.result) == 1:
             print(self.data)
             print("result length of 1")
 
-        path = [{'lon1': first[0][0],
-                 'lat1': first[0][1],
-                 'id1': self.network.node_id[first[1]],
-                 'lon2': second[0][0],
-                 'lat2': second[0][1],
-                 'id2': self.network.node_id[second[1]],
-                 'line_geom': build_linestring(Point.from_list(first[0]).as_geometry(),
-                                               Point.from_list(second[0]).as_geometry())
-                 } for first, second in zip(((self.network.node_locations[v_id1], v_id1) for v_id1 in self.result[:-1]),
-                                            ((self.network.node_locations[v_id2], v_id2) for v_id2 in self.result[1:]))]
-        return header, path
+        segments = self.segments if self.segments is not None else [Segment(0, len(self.data), self.result)]
+        edges = [(v_id1, v_id2, segment_id) for segment_id, segment in enumerate(segments)
+                 for v_id1, v_id2 in zip(segment.result[:-1], segment.result[1:])]
+        columns = {'lon1': [self.network.node_locations[v_id1][0] for v_id1, _, _ in edges],
+                   'lat1': [self.network.node_locations[v_id1][1] for v_id1, _, _ in edges],
+                   'id1': [self.network.node_id[v_id1] for v_id1, _, _ in edges],
+                   'lon2': [self.network.node_locations[v_id2][0] for _, v_id2, _ in edges],
+                   'lat2': [self.network.node_locations[v_id2][1] for _, v_id2, _ in edges],
+                   'id2': [self.network.node_id[v_id2] for _, v_id2, _ in edges],
+                   'segment': [segment_id for _, _, segment_id in edges]}
+
+        """ Encode the geometry of every edge at once. """
+        columns['line_geom'] = linestrings_wkb(columns['lon1'], columns['lat1'], columns['lon2'], columns['lat2'])
+        return header, columns if as_columns else as_rows(header, columns)
@@ -0,0 +1,82 @@
+import math
+import threading
+from collections import OrderedDict
+
+FEET_PER_DEGREE_LATITUDE = 364000  # Approximately, near the latitude of Los Angeles.
+
+
+class CandidateCache:
+    """
+    Remembers the candidates found for a location, so that a later search from nearly the same location can skip the
+    spatial index. Locations are quantized into square cells of cell_size feet, and the candidates found for the first location searched in a cell are returned for every location in the cell.
+    A cell which is small compared to the spacing of the network's vertices changes the candidates only at the edge of
+    the k nearest.
+
+    The cache holds at most max_size cells, and evicts the least recently used. Safe to use from several threads.
+    """
+
+    def __init__(self, cell_size=10, max_size=100000):
+        """
+        :param cell_size: the width in feet of a cell
+        :param max_size: the number of cells held before the least recently used is evicted
+        """
+        self.cell_size = cell_size
+        self.max_size = max_size
+        self.cells = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, location, num_results):
+        """
+        :param location: A list in the form [lon, lat]. The k-NN search does not depend on a heading, so any further
+                         items are ignored.
+        :param num_results: The number of candidates searched for.
+        :return: The key of the cell which contains the location.
+        """
+        lat_step = self.cell_size / FEET_PER_DEGREE_LATITUDE
+        row = math.floor(location[1] / lat_step)
+        """ A degree of longitude narrows away from the equator, so the width of a cell in degrees depends on its row. """
+        lon_step = lat_step / max(math.cos(math.radians((row + 0.5) * lat_step)), 1e-6)
+        column = math.floor(location[0] / lon_step)
+        return row, column, num_results
+
+    def get(self, key):
+        """
+        :return: The candidates of a cell, or None if they are not held.
+        """
+        with self.lock:
+            candidates = self.cells.get(key)
+            if candidates is None:
+                self.misses += 1
+                return None
+            self.cells.move_to_end(key)
+            self.hits += 1
+            return candidates
+
+    def put(self, key, candidates):
+        """
+        Stores the candidates of a cell, evicting the least recently used cell if the cache is full.
+        """
+        with self.lock:
+            self.cells[key] = tuple(candidates)
+            self.cells.move_to_end(key)
+            while len(self.cells) > self.max_size:
+                self.cells.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+
+    def hit_rate(self):
+        """
+        :return: The fraction of lookups which were answered by the cache, or None if there have been none.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def stats(self):
+        return {'size': len(self.cells), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hit_rate()}
@@ -1,100 +1,141 @@
 import copy
 import math
 import util.utils as utils
-from collections import namedtuple
 from heapq import heapify, heappop as pop, heappush as push
-from functools import reduce
 
+from map_match.transitions import TransitionTable
 
-def viterbi_optimized(network, scores):
+
+class LatticeBreak(Exception):
     """
-    An optimized version of Viterbi. Instead of evaluating the K*O matrix column by column, the single most likely
-    path is evaluated. In the worst case, the full matrix is evaluated which yields the same runtime as the
-    basic Viterbi algorithm, O(K^2 * O). In the best case, only a single path is evaluated, which has a time complexity
-    of Ω(K*O).
-    :param network:
-    :param scores:
-    :return:
+    Raised when no candidate of an observation can be reached from a candidate of the previous observation, so that
+    no path passes through every observation.
     """
-    def normalize_subpath_scores(subpaths):
-        """
-        normalizes the scores of all paths in a subpath
-        :param subpaths:
-        :return:
-        """
-        sum_of_scores = reduce(lambda total, t: total + t.score, subpaths, 0)
-        return [subpath_factory(-(path.score / sum_of_scores), path.length, path.path) for path in subpaths]
+    def __init__(self, index, path):
+        super(LatticeBreak, self).__init__(index)
+        self.index = index  # The first observation which cannot be reached.
+        self.path = path  # The most probable path through the observations before index.
+
 
-    def update(active_subpath):
+def viterbi_optimized(network, scores, distance_score=lambda d: d ** 2, transitions=None):
+    """
+    A best-first (A*) search through the probability lattice. Each state is a (observation, candidate) pair, and the
+    cost of a state is the negative log probability of the most probable path which reaches it, using the same
+    emission and transition terms as viterbi. Because a normalized emission probability is at most 1, the sum of the
+    cheapest emission costs of the remaining observations never overestimates the cost to complete a path, so the
+    first complete path to be popped is the most probable one.
+
+    Heap entries are never rebuilt; a state which is improved is pushed again and its stale entry is skipped when it is
+    popped. Paths are stored as back-pointers, and are only expanded into vertices once the best path is known.
+    When one candidate clearly dominates each observation, roughly one state per observation is expanded, Ω(K*O).
+    In the worst case every state is expanded once, which is the cost of the basic Viterbi algorithm, O(K^2 * O).
+    :param network: a network which can query paths
+    :param scores: a set of candidates and scores for each data point
+    :param distance_score: a function which converts the distance between two candidates to a transition score.
+                           Must be at least 1 for distances of at least 1, so that transition costs are not negative.
+    :param transitions: optionally, a TransitionTable over scores. Candidates which it cannot reach are never expanded.
+    :return: a path
+    :raises LatticeBreak: if there is no path through every observation
+    """
+    if not scores:
+        return []
+    if transitions is None:
+        transitions = TransitionTable(network, scores)
+
+    """ An observation without a scored candidate cannot be part of a path. Decode the observations before it. """
+    for index, candidate_map in enumerate(scores):
+        if not any(score > 0 for score in candidate_map.values()):
+            path = viterbi_optimized(network, scores[:index], distance_score, transitions) if index else []
+            raise LatticeBreak(index, path)
+
+    """ Convert the scores of each observation into emission costs, -log(normalized score). Candidates with no
+    score can never be part of a probable path. """
+    emission_costs = []
+    for candidate_map in scores:
+        sum_of_scores = sum(candidate_map.values())
+        emission_costs.append({candidate: -math.log(score / sum_of_scores)
+                               for candidate, score in candidate_map.items() if score > 0})
+
+    """ remaining[i] is a lower bound on the cost of extending a path which ends at observation i to a complete path:
+    every later observation costs at least its cheapest emission, and transitions never have a negative cost. """
+    last = len(scores) - 1
+    remaining = [0] * len(scores)
+    for index in range(last - 1, -1, -1):
+        remaining[index] = remaining[index + 1] + min(emission_costs[index + 1].values(), default=math.inf)
+
+    best_cost = {(0, candidate): cost for candidate, cost in emission_costs[0].items()}
+    back_pointers = {(0, candidate): None for candidate in emission_costs[0]}
+    active_states = [(cost + remaining[0], cost, 0, candidate) for candidate, cost in emission_costs[0].items()]
+    heapify(active_states)
+    expanded = set()
+    deepest = None  # The cheapest expanded state of the latest observation reached so far.
+
+    def expand_path(state):
         """
-        Given a single active path, find the most probable next candidate and add it to the path.
-        :param active_subpath: a named tuple with fields score, length, path
-        :return: an active subpath with the most probable candidate appended to it
+        Follows the back-pointers from a state to recover its candidate sequence, then expands it into a path.
+        :param state: a tuple of (observation, candidate)
+        :return: a list of vertex IDs
         """
-
-        def update_pr(candidate):
-            """
-            Finds the probability of an active path if the candidate is added to it.
-            Score = Probability of active path * Probability of candidate / Distance(old path -> candidate)
-            :param candidate: tuple of (id of candidate vertex, score)
-            :return: score
-            """
-            candidate_probability = candidate[1]
-            distance = 1 + network.shortest_distance_between_vertices(active_subpath.path[-1], candidate[0])
-            #print('[candidate: {0}], [active_subpath: {1}], [distance: {2}]'.format(candidate, active_subpath, distance))
-            return active_subpath.score * candidate_probability / distance ** 1.5
-
-        def update_path(candidate):
-            """
-            Given an active path, finds the most probable path with the candidate added to it.
-            :param candidate: tuple of (id of candidate vertex, score)
-            :return: A list of vertex IDs
-            """
-            return active_subpath.path[:-1] + network.find_vertex_path(active_subpath.path[-1], candidate[0], False)[0]
-
-        active_candidates = list(scores[active_subpath.length].items())
-        best_candidate = min(active_candidates, key=update_pr)
-        # print('best candidate for {0} is {1} with score {2}'.format(active_subpath, best_candidate, update_path(best_candidate)))
-        return subpath_factory(update_pr(best_candidate), active_subpath.length + 1, update_path(best_candidate))
-
-    subpath_factory = namedtuple('Subpath', ['score', 'length', 'path'])
-
-    """ At the first observation, the possible paths are the candidates, and their emission probabilities. 
-    Score is multiplied by -1 because heapq is a min heap. """
-    active_subpaths = [subpath_factory(-score, 1, [candidate]) for candidate, score in scores[0].items()]
-    heapify(active_subpaths)
-
-    """ Add the most probable candidate to the most probable path, until a complete path is found. """
-    best_subpath = pop(active_subpaths)
-    while best_subpath.length < len(scores):
-        print('active_subpaths: {0}, best_subpath: {1}, {2}'.format(len(active_subpaths)+1, best_subpath.score, best_subpath.length))
-        best_subpath = update(best_subpath)
-        if best_subpath.score == 0:
-            print('warning: best_subpath_score is {0}'.format(best_subpath.score))
-        push(active_subpaths, best_subpath)
-        active_subpaths = normalize_subpath_scores(active_subpaths)
-        best_subpath = pop(active_subpaths)
-
-    """ Return the most probable complete path. """
-    return best_subpath.path
-
-
-def viterbi(network, scores, distance_score=lambda d: d ** 2):
+        candidates = []
+        while state is not None:
+            candidates.append(state[1])
+            state = (state[0] - 1, back_pointers[state]) if back_pointers[state] is not None else None
+        candidates.reverse()
+
+        path = [candidates[0]]
+        for next_candidate in candidates[1:]:
+            path = path[:-1] + transitions.path(path[-1], next_candidate)
+        return path
+
+    while active_states:
+        _, cost, index, candidate = pop(active_states)
+        state = (index, candidate)
+        if state in expanded:  # A cheaper entry for this state has already been expanded.
+            continue
+        expanded.add(state)
+        if deepest is None or index > deepest[0]:
+            deepest = state
+
+        if index == last:
+            return expand_path(state)
+
+        """ Expand the state into every reachable candidate of the next observation. """
+        next_costs = emission_costs[index + 1]
+        for target, distance in transitions.distances(index, candidate).items():
+            if target not in next_costs:
+                continue
+            next_state = (index + 1, target)
+            next_cost = cost + next_costs[target] + math.log(distance_score(1 + distance))
+            if next_cost < best_cost.get(next_state, math.inf):
+                best_cost[next_state] = next_cost
+                back_pointers[next_state] = candidate
+                push(active_states, (next_cost + remaining[index + 1], next_cost, index + 1, target))
+
+    """ Every path ends before the final observation. """
+    raise LatticeBreak(deepest[0] + 1, expand_path(deepest))
+
+
+def viterbi(network, scores, distance_score=lambda d: d ** 2, transitions=None):
     """
     Uses the Viterbi algorithm to find the most probable path. The Viterbi algorithm is a dynamic programming algorithm
     which finds the shortest path through a probability lattice (HMM).
     :param network: a network which can query paths
     :param scores: a set of candidates and scores for each data point
     :param distance_score: a function which converts the distance between two candidates to a transition score
+    :param transitions: optionally, a TransitionTable over scores. Candidates which it cannot reach have a zero
+                        transition probability.
     :return: a path
+    :raises LatticeBreak: if there is no path through every observation
     """
+    if transitions is None:
+        transitions = TransitionTable(network, scores)
 
     def find_next_step(observation_candidate, active_paths):
         """
         Find the best active path leading to the candidate of an observation, and find the probability of the path
         passing through the candidate, and the path that would pass through the candidate.
         :param observation_candidate: a tuple of (candidate, score)
-        :param active_paths: a list of [ ([path], score) ]
+        :param active_paths: a list of [ ([path], score, {reachable candidate: distance}) ]
         :return: a tuple of ([path], score)
         """
 
@@ -102,15 +143,17 @@ def viterbi(network, scores, distance_score=lambda d: d ** 2):
             """
             Finds the probability of an active path if the candidate is added to it.
             Score = Probability of active path * Probability of candidate / Distance(old path -> candidate)
-            :param active_path: tuple of ([path], score)
+            :param active_path: tuple of ([path], score, {reachable candidate: distance})
             :return: score
             """
             if not active_path[0]:  # If there was a path that led to a dead end, the probability is zero.
                 # print('WARNING: found path of length {}'.format(len(active_path)))
                 return 0
+            if observation_candidate[0] not in active_path[2]:  # The candidate cannot be reached from the path.
+                return 0
             pr_active_path = active_path[1]
             pr_candidate = observation_candidate[1]
-            distance = 1 + network.shortest_distance_between_vertices(active_path[0][-1], observation_candidate[0])
+            distance = 1 + active_path[2][observation_candidate[0]]
             return (pr_active_path * pr_candidate) / (distance_score(distance))
 
         def update_path(path):
@@ -119,24 +162,36 @@ def viterbi(network, scores, distance_score=lambda d: d ** 2):
             :param path: A list of vertex IDs
             :return: A list of vertex IDs
             """
-            if not path:  # If there was a path that led to a dead end, return a path with no items.
-                print('WARNING: dead end.')
-                return list()
-            return path[:-1] + network.find_vertex_path(path[-1], observation_candidate[0], False)[0]
+            return path[:-1] + transitions.path(path[-1], observation_candidate[0])
 
         best = max(((active_path[0], update_pr(active_path)) for active_path in active_paths), key=lambda t: t[1])
+        if best[1] == 0:  # No path reaches the candidate, so there is no path to extend.
+            return list(), 0
         return update_path(best[0]), best[1]
 
     """ At the first observation, the possible paths are the candidates, and their emission probabilities. """
     possible_paths = [([candidate], score) for candidate, score in scores[0].items()]
+    if not any(score > 0 for _, score in possible_paths):
+        raise LatticeBreak(0, [])
     utils.print_progress(len(scores), prefix='searching for most probable route')
-    """ For each observation, update the paths and probabilities. """
-    for candidate_map in scores[1:]:
-        utils.print_progress(len(scores), prefix='searching for most probable route')
-        possible_paths = [find_next_step((candidate, score), possible_paths)
+    try:
+        """ For each observation, update the paths and probabilities. """
+        for index, candidate_map in enumerate(scores[1:]):
+            utils.print_progress(len(scores), prefix='searching for most probable route')
+            """ Find the candidates reachable from the end of each path, and their distances. """
+            transitions.column(index, [path[-1] for path, _ in possible_paths if path])
+            possible_paths = [(path, score, transitions.distances(index, path[-1]) if path else {})
+                              for path, score in possible_paths]
+            next_paths = [find_next_step((candidate, score), possible_paths)
                           for candidate, score in candidate_map.items()]
-        sum_of_scores = sum(path[1] for path in possible_paths) + 0.001
-        possible_paths = [(path[0], path[1] / sum_of_scores) for path in possible_paths]
+            if not any(path[1] > 0 for path in next_paths):  # Every path ends at the previous observation.
+                raise LatticeBreak(index + 1, max(possible_paths, key=lambda t: t[1])[0])
+            possible_paths = next_paths
+            sum_of_scores = sum(path[1] for path in possible_paths) + 0.001
+            possible_paths = [(path[0], path[1] / sum_of_scores) for path in possible_paths]
+    finally:
+        """ A LatticeBreak stops the bar part of the way through, so the next lattice starts a new one. """
+        utils.reset_progress()
 
     """ Return the most probable path. """
     return max(possible_paths, key=lambda t: t[1])[0]
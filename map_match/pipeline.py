@@ -0,0 +1,181 @@
+import copy
+import queue
+import threading
+from collections import namedtuple
+
+from mapMatch import BatchResult
+from util.Shapes import DataPoint
+
+STAGES = ['candidates', 'score', 'decode', 'write']
+
+""" A trip as it moves through the pipeline. Each stage fills in a field, or sets error if the trip fails. key is the
+result cache key of the trip, and restored is True if its result was restored from the result cache. A trip whose
+result is set is finished, and passes through the remaining stages untouched. """
+Job = namedtuple('Job', ['trip', 'data', 'candidates', 'matcher', 'result', 'error', 'key', 'restored'])
+
+_DONE = object()  # Tells a worker that no more jobs will arrive.
+
+
+class Pipeline:
+    """
+    Matches a stream of trips in stages which run at the same time, each on its own threads:
+        read -> candidates -> score -> decode -> write
+    Stages are connected by bounded queues. When a stage falls behind, the queue in front of it fills up and the
+    stages before it wait, so only a few trips are held in memory at once however large the input is. Reading happens
+    on the calling thread.
+
+    Each trip is matched on a shallow copy of the MapMatch, which shares its network, tree and
+    configuration, so trips on different threads do not interfere. Trips are exported as batch_process exports them,
+    to the batch output of the MapMatch if it has one, and the result cache of the MapMatch, if it has one, is used
+    as batch_process uses it.
+    """
+
+    def __init__(self, mm, date='', min_path=15, workers=None, queue_size=4, study_area=None):
+        """
+        :param mm: A MapMatch with a network, a tree, a score function and an evaluation function.
+        :param date: optionally, a date string which will be prepended to each filename
+        :param min_path: trips with fewer data points are skipped
+        :param workers: optionally, a dictionary mapping stage names to their number of threads. Defaults to 1.
+        :param queue_size: the number of trips which may wait in front of each stage
+        :param study_area: optionally, a util.clip.StudyArea. Each trip is clipped to it as it is read, before
+                           trips with fewer than min_path points are skipped.
+        """
+        self.mm = mm
+        self.date = date
+        self.min_path = min_path
+        self.workers = {stage: 1 for stage in STAGES}
+        self.workers.update(workers or {})
+        self.queue_size = queue_size
+        self.study_area = study_area
+        self.lock = threading.Lock()
+
+    def run(self, trips):
+        """
+        Matches and exports each trip.
+        :param trips: an iterable of lists of DataPoints, which is read one trip at a time
+        :return: a list of BatchResults, ordered by trip
+        """
+        queues = [queue.Queue(self.queue_size) for _ in STAGES]  # queues[i] holds the jobs waiting for STAGES[i].
+        finished = [0] * len(STAGES)
+        results = []
+
+        threads = [threading.Thread(target=self.work, args=(index, queues, finished, results), daemon=True)
+                   for index, stage in enumerate(STAGES) for _ in range(self.workers[stage])]
+        if self.mm.batch_writer is not None:
+            self.mm.batch_writer.start()
+        for thread in threads:
+            thread.start()
+
+        try:
+            for trip, data in enumerate(trips):
+                if not data:
+                    results.append(BatchResult(trip, None, 'no data'))
+                    continue
+                if self.study_area is not None:
+                    data = self.study_area.clip_trip(data)
+                if len(data) < self.min_path:
+                    results.append(BatchResult(trip, None, 'too few points'))
+                    continue
+                queues[0].put(Job(trip, data, None, None, None, None, None, False))
+        finally:
+            """ If reading fails, the trips already read still finish and are written before the error is raised. """
+            for _ in range(self.workers[STAGES[0]]):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+            if self.mm.batch_writer is not None:
+                self.mm.batch_writer.close()
+        if self.mm.instrumentation is not None:
+            self.mm.instrumentation.print_report()
+        return sorted(results)
+
+    def run_file(self, filename, subdirectory='data', sorted_by_trip=True):
+        """
+        Matches and exports each trip of a CSV of HERE probe data, reading it one trip at a time.
+        :param sorted_by_trip: whether the rows of each trip are consecutive. See DataPoint.iterate_dataset.
+        :return: a list of BatchResults, ordered by trip
+        """
+        return self.run(DataPoint.iterate_dataset(filename, subdirectory, sorted_by_trip))
+
+    def work(self, index, queues, finished, results):
+        """
+        Runs a worker of a stage until the stage has no more jobs. The last worker of a stage to finish tells every
+        worker of the next stage to finish.
+        :param index: the index of the stage in STAGES
+        """
+        stage = STAGES[index]
+        step = getattr(self, stage)
+        while True:
+            job = queues[index].get()
+            if job is _DONE:
+                break
+            if job.error is None and job.result is None:
+                try:
+                    job = step(job)
+                except Exception as exception:
+                    job = job._replace(candidates=None, matcher=None, error=repr(exception))
+
+            if index + 1 < len(STAGES):
+                queues[index + 1].put(job)
+            else:
+                results.append(job.result if job.error is None else BatchResult(job.trip, None, job.error))
+
+        with self.lock:
+            finished[index] += 1
+            last = finished[index] == self.workers[stage]
+        if last and index + 1 < len(STAGES):
+            for _ in range(self.workers[STAGES[index + 1]]):
+                queues[index + 1].put(_DONE)
+
+    def candidates(self, job):
+        """
+        Finds the candidates of each data point of a trip, on a copy of the MapMatch which the later stages use.
+        """
+        matcher = copy.copy(self.mm)
+        if matcher.instrumentation is not None:
+            matcher.metrics = matcher.instrumentation.trip(job.trip)
+        if matcher.result_cache is not None:
+            key = matcher.trip_key(job.data)
+            restored, exported = matcher.restore_result(key, job.data)
+            if restored:
+                """ The trip was matched by an earlier run. Skip the export too if its files are still there. """
+                filename = matcher.exported_filename(job.trip, self.date, exported)
+                if filename is not None:
+                    print('\talready exported {0}...'.format(filename))
+                    return job._replace(result=BatchResult(job.trip, filename, None))
+                return job._replace(matcher=matcher, key=key, restored=True)
+            job = job._replace(key=key)
+        matcher.locate_data(job.data)
+        return job._replace(candidates=[matcher.find_knn(point.as_list()) for point in job.data], matcher=matcher)
+
+    def score(self, job):
+        """
+        Scores the candidates of a trip.
+        """
+        if job.restored:
+            return job
+        matcher = job.matcher
+        matcher.data = job.data
+        found = {tuple(point.as_list()): candidates for point, candidates in zip(job.data, job.candidates)}
+        matcher.score_data(lambda location, num_results=None: found[tuple(location)])
+        return job._replace(candidates=None)
+
+    def decode(self, job):
+        """
+        Finds the most probable path of a trip, and stores it in the result cache.
+        """
+        if job.restored:
+            return job
+        job.matcher.infer_path()
+        if job.key is not None:
+            job.matcher.store_result(job.key)
+        return job
+
+    def write(self, job):
+        """
+        Exports the matches and path of a trip.
+        """
+        result = job.matcher.export_trip(job.trip, self.date)
+        if job.key is not None and result.filename:
+            job.matcher.result_cache.record_export(job.key, result.filename)
+        return job._replace(matcher=None, result=result)
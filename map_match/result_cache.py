@@ -0,0 +1,88 @@
+import os
+import pickle
+import sqlite3
+import threading
+
+
+class ResultCache:
+    """
+    A store of matched trips in a single SQLite file, so that a batch which is run again, or which stopped part of the
+    way through, does not match a trip twice.
+
+    Each trip is stored under a key which identifies everything its result depends on: its data points, the network
+    snapshot and the matching configuration (see MapMatch.trip_key). A trip whose key is found is not matched again.
+    The store also records the file that each trip was last exported to, so that an export which already exists can
+    be skipped.
+
+    A trip is committed as soon as it is stored. Connections are opened per process and thread, so forked batch
+    workers and the threads of a Pipeline can share a cache file.
+    """
+
+    def __init__(self, filepath):
+        """
+        :param filepath: the path of the SQLite file, which is created if it does not exist
+        """
+        self.filepath = filepath
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        """
+        :return: the connection of the current process and thread, opened on first use.
+        """
+        local = self.local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            """ A connection must not be used by a forked child, or by another thread, so each opens its own. """
+            local.connection = sqlite3.connect(self.filepath, timeout=60)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('CREATE TABLE IF NOT EXISTS trips '
+                                     '(key TEXT PRIMARY KEY, result BLOB NOT NULL, filename TEXT)')
+            local.connection.commit()
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key):
+        """
+        :param key: the key of a trip
+        :return: a tuple of (result, filename), or None if the trip has not been stored. The filename is None if the
+                 trip has not been exported.
+        """
+        row = self.connect().execute('SELECT result, filename FROM trips WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0]), row[1]
+
+    def put(self, key, result):
+        """
+        Stores the result of a trip, replacing any stored result and export.
+        :param key: the key of a trip
+        :param result: any picklable object
+        """
+        connection = self.connect()
+        connection.execute('INSERT OR REPLACE INTO trips (key, result, filename) VALUES (?, ?, NULL)',
+                           (key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL)))
+        connection.commit()
+
+    def record_export(self, key, filename):
+        """
+        Records the file that a stored trip was exported to.
+        """
+        connection = self.connect()
+        connection.execute('UPDATE trips SET filename = ? WHERE key = ?', (filename, key))
+        connection.commit()
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM trips').fetchone()[0]
+
+    def __getstate__(self):
+        """ Connections cannot be pickled. The copy opens its own. """
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
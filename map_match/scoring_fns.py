@@ -1,7 +1,6 @@
-import datetime
 import math
 
-from util.utils import real_distance, print_progress
+from util.utils import print_progress
 
 
 def path_score(index, points, find_candidates, network):
@@ -29,11 +28,12 @@ def path_score(index, points, find_candidates, network):
         connectivity_factor = 1
         connectivity_score = lambda a, b, cf: cf + math.log(network.shortest_distance_between_vertices(a, b) + math.e)
         point = points[index]
+        location = network.locate(point)
         scores = {}
 
         for candidate in find_candidates(point.as_list()):
             heading_multiplier = 1 + math.cos(math.radians(point.bearing - network.node_heading[candidate]))
-            distance = 1 / real_distance(point.as_list(), network.node_locations[candidate])
+            distance = 1 / network.vertex_distance(location, candidate)
             width = network.node_width[candidate]
             scores[candidate] = distance * heading_multiplier * width
 
@@ -50,13 +50,14 @@ def path_score(index, points, find_candidates, network):
 
 def simple_distance_heading(index, points, find_candidates, network, score_multiplier=1000):
     point = points[index]
+    location = network.locate(point)
     scores = {}
     for candidate in find_candidates(point.as_list()):
         width = network.node_width[candidate]
         if width == 0:  # Exclude all lanes with zero weight
             continue
         heading_multiplier = 1 + math.cos(math.radians(point.bearing - network.node_heading[candidate]))
-        distance = 1 / (1 + real_distance(point.as_list(), network.node_locations[candidate]))
+        distance = 1 / (1 + network.vertex_distance(location, candidate))
         scores[candidate] = distance * heading_multiplier * width
     sum_of_scores = sum(scores.values())
     return {candidate: (score / sum_of_scores) * score_multiplier for candidate, score in scores.items()}
@@ -65,13 +66,14 @@ def simple_distance_heading(index, points, find_candidates, network, score_multi
 def pow_distance_heading(index, points, find_candidates, network, distance_weight=.75, heading_weight=2,
                          width_weight=1, score_multiplier=100):
     point = points[index]
+    location = network.locate(point)
     scores = {}
     for candidate in find_candidates(point.as_list()):
         width = network.node_width[candidate]
         if width == 0:  # Exclude all lanes with zero weight
             continue
         heading_multiplier = 1 + math.cos(math.radians(point.bearing - network.node_heading[candidate]))
-        distance = 1 / (1 + real_distance(point.as_list(), network.node_locations[candidate]))
+        distance = 1 / (1 + network.vertex_distance(location, candidate))
         scores[candidate] = (distance ** distance_weight) * (heading_multiplier ** heading_weight) * (
                 width ** width_weight)
     sum_of_scores = sum(scores.values())
@@ -80,13 +82,14 @@ def pow_distance_heading(index, points, find_candidates, network, distance_weigh
 
 def log_distance_heading(index, points, find_candidates, network, distance_weight=math.e, score_multiplier=100):
     point = points[index]
+    location = network.locate(point)
     scores = {}
     for candidate in find_candidates(point.as_list()):
         width = network.node_width[candidate]
         if width == 0:  # Exclude all lanes with zero weight
             continue
         heading_multiplier = 1 + math.cos(math.radians(point.bearing - network.node_heading[candidate]))
-        distance = 1 / math.log(distance_weight + real_distance(point.as_list(), network.node_locations[candidate]),
+        distance = 1 / math.log(distance_weight + network.vertex_distance(location, candidate),
                                 distance_weight)
         scores[candidate] = distance * heading_multiplier * width
     sum_of_scores = sum(scores.values())
@@ -96,13 +99,14 @@ def log_distance_heading(index, points, find_candidates, network, distance_weigh
 def exp_distance_heading(index, points, find_candidates, network, exponent=2, score_multiplier=1):
     print_progress(len(points), prefix='scoring candidates of {0}th data point'.format(index))
     point = points[index]
+    location = network.locate(point)
     scores = {}
     for candidate in find_candidates(point.as_list()):
         width = network.node_width[candidate]
         if width == 0:  # Exclude all lanes with zero weight
             continue
         heading_multiplier = 1 + math.cos(math.radians(point.bearing - network.node_heading[candidate]))
-        distance = 1 / (math.log(math.e + real_distance(point.as_list(), network.node_locations[candidate])))
+        distance = 1 / (math.log(math.e + network.vertex_distance(location, candidate)))
         scores[candidate] = (distance * heading_multiplier) ** exponent
     sum_of_scores = sum(scores.values())
     return {candidate: (score / sum_of_scores) * score_multiplier for candidate, score in scores.items()}
@@ -124,6 +128,7 @@ def general_distance_heading(index, points, find_candidates, network,
     """
     print_progress(len(points), prefix='scoring candidates of {0}th data point'.format(index))
     point = points[index]
+    location = network.locate(point)
     scores = {}
     for candidate in find_candidates(point.as_list()):
         width = network.node_width[candidate]
@@ -140,7 +145,7 @@ def general_distance_heading(index, points, find_candidates, network,
             hs = 0
 
         try:
-            ds = distance_score(real_distance(point.as_list(), network.node_locations[candidate]))
+            ds = distance_score(network.vertex_distance(location, candidate))
         except:
             ds = 0
 
@@ -155,26 +160,8 @@ def general_distance_heading(index, points, find_candidates, network,
 
 def one_score(index, points, find_candidates, network, exponent=2, score_multiplier=100):
     """
-    Test scoring function which assigns a score of 1 to every candidate
+    Test scoring function which assigns a score of 1 to every candidate. To time candidate search and scoring, use
+    MapMatch.specify_instrumentation.
     """
-    start = datetime.datetime.now()
     point = points[index]
-    scores = {}
-
-    start = datetime.datetime.now()
-    candidates = find_candidates(point.as_list())
-    print('found candidates', str(datetime.datetime.now() - start))
-
-    start = datetime.datetime.now()
-    for candidate in candidates:
-        a = candidate.__hash__()
-    print('computed hashes', str(datetime.datetime.now() - start))
-
-    start = datetime.datetime.now()
-    for candidate in candidates:
-        scores[candidate] = 1
-    print('assigned score', str(datetime.datetime.now() - start))
-
-    start = datetime.datetime.now()
-    print('')
-    return scores
+    return {candidate: 1 for candidate in find_candidates(point.as_list())}
@@ -0,0 +1,296 @@
+import datetime
+import math
+from collections import namedtuple
+
+from util.instrumentation import NULL_METRICS
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+KPH_TO_FEET_PER_SECOND = 0.911344  # HERE probe speeds are reported in km/h.
+
+""" A position on a section, offset feet from its first vertex. vertex is the candidate vertex it was found from. """
+SectionState = namedtuple('SectionState', ['section', 'offset', 'vertex'])
+
+
+def elapsed_seconds(p1, p2):
+    """
+    Computes the time elapsed between two data points.
+    :param p1: A DataPoint.
+    :param p2: A DataPoint.
+    :return: The number of seconds between the timestamps of p1 and p2, or None if either timestamp cannot be read.
+    """
+    """ A view of a TripBatch holds its time in seconds already. """
+    epoch1, epoch2 = getattr(p1, 'epoch', None), getattr(p2, 'epoch', None)
+    if epoch1 is not None and epoch2 is not None:
+        return float(abs(epoch2 - epoch1))
+    try:
+        t1 = datetime.datetime.strptime(p1.timestamp, TIMESTAMP_FORMAT)
+        t2 = datetime.datetime.strptime(p2.timestamp, TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    return abs((t2 - t1).total_seconds())
+
+
+def reachable_distances(points, tolerance=1.5, minimum_speed=40, slack=1000):
+    """
+    Finds the furthest that a vehicle could plausibly travel through the network between each pair of consecutive
+    data points, given the time that elapsed between them and the speeds that they report.
+    :param points: A sequence of DataPoints.
+    :param tolerance: A multiplier applied to the travelled distance, to allow for acceleration between samples.
+    :param minimum_speed: The speed, in km/h, assumed for a vehicle which reports a lower speed (e.g. when stopped).
+    :param slack: A distance in feet added to every bound, to allow for GPS noise and the spread of candidates.
+    :return: A list of length len(points) - 1 of distances in feet. The distance is infinite if the time between the
+             points is unknown.
+    """
+    distances = []
+    for previous, current in zip(points, points[1:]):
+        elapsed = elapsed_seconds(previous, current)
+        if elapsed is None:
+            distances.append(math.inf)
+            continue
+        speed = max(previous.speed, current.speed, minimum_speed) * KPH_TO_FEET_PER_SECOND
+        distances.append(speed * elapsed * tolerance + slack)
+    return distances
+
+
+class TransitionMemo:
+    """
+    The transitions searched for while decoding a trip: the distances from each candidate of each data point, and the
+    paths between candidates. MapMatch keeps a memo for its current data, so that decoding the data again with
+    different scores, or a different evaluation function, repeats none of the searches.
+    """
+
+    def __init__(self):
+        self.distances = {}  # Maps (data point index, source) to (the targets and bound searched, their distances).
+        self.paths = {}  # Maps (source, target) to a path.
+
+
+class TransitionTable:
+    """
+    Computes and remembers the network distance from a candidate of one observation to the candidates of the next
+    observation. Distances are computed on demand, so a decoder which only expands promising candidates only pays
+    for the searches that it needs.
+
+    If a maximum distance is given for a transition, candidates which are further than that distance in a straight
+    line are skipped without a search, and the search itself stops once it passes the maximum distance.
+
+    Searches only read the network, and graph-tool releases the GIL while it searches, so the searches of a column, or
+    of every column, can be run on a thread pool with column and prefetch.
+    """
+
+    def __init__(self, network, scores, max_distances=None, executor=None, metrics=NULL_METRICS, memo=None, offset=0):
+        """
+        :param network: a network which can query distances and paths
+        :param scores: a set of candidates and scores for each data point
+        :param max_distances: optionally, the maximum distance in feet of the transition following each data point
+        :param executor: optionally, a concurrent.futures.Executor on which column and prefetch run searches
+        :param metrics: optionally, Metrics which record the time of searches and path expansions, the number of
+                        shortest path searches, and how often a transition is found in the table
+        :param memo: optionally, a TransitionMemo which searches are read from and written to
+        :param offset: the index of the data point of scores[0] in the data of the memo
+        """
+        self.network = network
+        self.scores = scores
+        self.max_distances = max_distances
+        self.executor = executor
+        self.metrics = metrics
+        self.memo = memo
+        self.offset = offset
+        self.table = {}
+
+    def max_distance(self, index):
+        """
+        :param index: The index of an observation.
+        :return: The maximum distance of a transition from observation index to the next, or None if unbounded.
+        """
+        if self.max_distances is None or math.isinf(self.max_distances[index]):
+            return None
+        return self.max_distances[index]
+
+    def distances(self, index, source):
+        """
+        Finds the distance from a candidate of an observation to each candidate of the next observation.
+        :param index: The index of the observation to which source belongs.
+        :param source: A candidate of observation index.
+        :return: A dictionary mapping each reachable candidate of observation index + 1 to its distance in feet.
+        """
+        key = (index, source)
+        if key not in self.table:
+            self.metrics.count('transition_table_misses')
+            distances = self.recall(key)
+            if distances is None:
+                distances = self.search(key)
+                self.remember(key, distances)
+            self.table[key] = distances
+        else:
+            self.metrics.count('transition_table_hits')
+        return self.table[key]
+
+    def search(self, key):
+        """
+        Searches the network for the distances of a transition, without reading or updating the table.
+        :param key: A tuple of (index, source), as accepted by distances.
+        :return: A dictionary mapping each reachable candidate of observation index + 1 to its distance in feet.
+        """
+        index, source = key
+        targets = list(self.scores[index + 1])
+        max_distance = self.max_distance(index)
+        if max_distance is not None:
+            targets = [target for target in targets if self.network.vertex_distance(source, target) <= max_distance]
+        with self.metrics.time('transitions'):
+            distances = self.network.shortest_distances_from_vertex(source, targets, max_distance, self.metrics)
+        return {target: distance for target, distance in zip(targets, distances) if not math.isinf(distance)}
+
+    def recall(self, key):
+        """
+        :param key: A tuple of (index, source), as accepted by distances.
+        :return: The distances of the transition held by the memo, or None if the memo does not hold a search for the
+                 same targets with the same bound.
+        """
+        if self.memo is None:
+            return None
+        index, source = key
+        searched = self.memo.distances.get((index + self.offset, source))
+        if searched is None or searched[0] != (frozenset(self.scores[index + 1]), self.max_distance(index)):
+            return None
+        self.metrics.count('transition_memo_hits')
+        return searched[1]
+
+    def remember(self, key, distances):
+        """
+        Stores the distances of a transition in the memo, if there is one.
+        """
+        if self.memo is not None:
+            index, source = key
+            self.memo.distances[(index + self.offset, source)] = \
+                ((frozenset(self.scores[index + 1]), self.max_distance(index)), distances)
+
+    def compute(self, keys):
+        """
+        Fills the table for each (index, source) pair which it does not yet hold, running the searches on the executor
+        if there is one. The table and memo are only updated by the calling thread.
+        :param keys: A sequence of (index, source) pairs.
+        """
+        missing = []
+        for key in dict.fromkeys(key for key in keys if key not in self.table):
+            distances = self.recall(key)
+            if distances is None:
+                missing.append(key)
+            else:
+                self.table[key] = distances
+        if self.executor is None or len(missing) < 2:
+            results = map(self.search, missing)
+        else:
+            results = self.executor.map(self.search, missing)
+        for key, distances in zip(missing, results):
+            self.table[key] = distances
+            self.remember(key, distances)
+
+    def column(self, index, sources=None):
+        """
+        Computes the distances from each source of an observation to the candidates of the next observation.
+        :param index: The index of an observation.
+        :param sources: The sources to compute. Defaults to the candidates of the observation.
+        """
+        sources = self.scores[index] if sources is None else sources
+        self.compute([(index, source) for source in sources])
+
+    def prefetch(self):
+        """
+        Computes the distances from every candidate of every observation at once, so that the searches of different
+        columns run concurrently. Only worthwhile when a decoder will visit most of the lattice, as viterbi does.
+        """
+        self.compute([(index, source) for index in range(len(self.scores) - 1) for source in self.scores[index]])
+
+    def path(self, source, target):
+        """
+        :return: The vertices of the shortest path from source to target, including both.
+        """
+        if self.memo is not None and (source, target) in self.memo.paths:
+            self.metrics.count('transition_memo_hits')
+            return self.memo.paths[(source, target)]
+        with self.metrics.time('path_expansion'):
+            path = self.network.find_vertex_path(source, target, False, self.metrics)[0]
+        if self.memo is not None:
+            self.memo.paths[(source, target)] = path
+        return path
+
+    def vertices(self, path):
+        """
+        Converts a path built from the candidates and paths of this table into a list of vertex ids.
+        """
+        return path
+
+
+class SectionTransitionTable(TransitionTable):
+    """
+    A TransitionTable whose candidates are SectionStates rather than vertices, so that a section contributes a single
+    state to an observation however many of its vertices are near the data point.
+
+    The distance between two states on the same section, where the second is further along, is the difference of
+    their offsets, and needs no search. Otherwise, the distance is the rest of the first section, plus the shortest
+    distance from its last vertex to the first vertex of the second section, plus the offset of the second state.
+    """
+
+    def search(self, key):
+        """
+        Finds the distance of each transition from a state to the states of the next observation.
+        :param key: A tuple of (index, source), as accepted by distances.
+        :return: A dictionary mapping each reachable state of observation index + 1 to its distance in feet.
+        """
+        index, source = key
+        max_distance = self.max_distance(index)
+        remaining = self.network.section_length(source.section) - source.offset
+
+        distances = {}
+        routed = []
+        for target in self.scores[index + 1]:
+            if target.section == source.section and target.offset >= source.offset:
+                distances[target] = target.offset - source.offset
+            else:
+                routed.append(target)
+
+        if max_distance is not None:
+            distances = {target: distance for target, distance in distances.items() if distance <= max_distance}
+            if remaining > max_distance:  # The vehicle could not have left the section.
+                return distances
+
+        if routed:
+            exit_vertex = self.network.sections[source.section][-1]
+            entrances = [self.network.sections[target.section][0] for target in routed]
+            bound = None if max_distance is None else max_distance - remaining
+            with self.metrics.time('transitions'):
+                routed_distances = self.network.shortest_distances_from_vertex(exit_vertex, entrances, bound,
+                                                                               self.metrics)
+            for target, distance in zip(routed, routed_distances):
+                distance = remaining + distance + target.offset
+                if not math.isinf(distance) and (max_distance is None or distance <= max_distance):
+                    distances[target] = distance
+        return distances
+
+    def path(self, source, target):
+        """
+        :return: The source state, the vertices passed between the states, and the target state.
+        """
+        if target.section == source.section and target.offset >= source.offset:
+            return [source] + self.network.section_vertices(source.section, source.offset, target.offset) + [target]
+
+        """ Leave the first section by its last vertex, which is also the first vertex of the route. """
+        exit_vertex = self.network.sections[source.section][-1]
+        entrance = self.network.sections[target.section][0]
+        leaving = self.network.section_vertices(source.section, source.offset,
+                                                self.network.section_length(source.section))[:-1]
+        route = TransitionTable.path(self, exit_vertex, entrance)
+        arriving = self.network.section_vertices(target.section, 0, target.offset)
+        return [source] + leaving + route + arriving + [target]
+
+    def vertices(self, path):
+        """
+        Replaces each state of a path with the last vertex of its section at or before it, and removes repeats.
+        """
+        result = []
+        for item in path:
+            if isinstance(item, SectionState):
+                item = self.network.section_vertex_at(item.section, item.offset)
+            if not result or result[-1] != item:
+                result.append(item)
+        return result
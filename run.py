@@ -1,43 +1,98 @@
+"""
+Matches and exports every trip of one or more probe data files. The network and spatial index are built once, and
+shared by every file.
+
+Example usage:
+  python run.py                                        # every clustered_ file in the data subdirectory
+  python run.py clipped_clustered_45sec_20171001.csv   # a single file
+  python run.py 'clustered_*.csv' --workers 8 --output sqlite
+"""
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+import sys
+
 import mapMatch
 import map_match.evaluation_fns
 import map_match.scoring_fns
 import util.Shapes
+import util.clip
 import util.m_tree.tree
 import util.utils
-import util.export
 from constructNetwork import TrafficNetwork
-import sys, os
 
 WINDOWS_ENCODING = '\\'
 UNIX_ENCODING = '/'
 
 SYSTEM_TYPE = 'linux'
 
-def run(f):
+""" The map matching object of the running command, inherited by forked worker processes. """
+_matcher = None
+
+""" The study area which trips are clipped to, if any, inherited by forked worker processes. """
+_study_area = None
+
 
+def build_matcher(args):
+    """
+    Constructs the network and the map matching object which every file is matched with.
+    """
     # Decode the JSON of junction and section information to construct the network.
     junction_map, section_map = util.utils.decode_json()
     network = TrafficNetwork(junction_map, section_map)
-
-    # Use this to convert a dataset into points that our Map Matcher can use. Place the file of data into the data
-    # subdirectory and change filename to be a string of the name of the file you would like to run.
-    # Example usage:
-    #  data = util.Shapes.DataPoint.convert_dataset(filename='i210_2017_10_22_id960801st_ordered.csv', subdirectory='data')
-
-    data = util.Shapes.DataPoint.convert_dataset(f)
-    print('network constructed. number of nodes:', network.equalize_node_density(200, 15, greedy=True))
-
-    # Call the map matching algorithm on your data. The second argument to batch_process will be the prefix of the
-    # outputted filenames - we recommend changing this to match the filename you passed in above.
+    print('network constructed. number of nodes:',
+          network.equalize_node_density(args.max_distance, args.max_angle, greedy=True))
 
     mm = mapMatch.MapMatch.without_evaluation(network, util.m_tree.tree.MTree)
-    mm.batch_process(data,
-                     f[:-12],
-                     score=map_match.scoring_fns.exp_distance_heading,
-                     evaluation=map_match.evaluation_fns.viterbi,
-                     min_path=2)
-
-    #mm.batch_process(data,'clipped_clustered_45sec_20171001CONSUMER',score=map_match.scoring_fns.exp_distance_heading,evaluation=map_match.evaluation_fns.viterbi)
+    mm.specify_candidate_count(args.k)
+    if args.result_cache:
+        mm.specify_result_cache(args.result_cache)
+    return mm
+
+
+def run(mm, f, args, processes=1):
+    """
+    Matches every trip of a file of probe data, and exports the results under the name of the file.
+    :param mm: the map matching object
+    :param f: the name of a file in the data subdirectory
+    :param args: the parsed command line arguments
+    :param processes: the number of worker processes matching the trips of the file
+    :return: a tuple of (the name of the file, a list of BatchResults)
+    """
+    if args.columnar:
+        data = util.Shapes.TripBatch.cached(f, args.subdirectory)
+    elif f.endswith(('.parquet', '.arrow', '.feather', '.npy')):
+        data = util.Shapes.TripBatch.from_file(f, args.subdirectory)
+    else:
+        data = util.Shapes.DataPoint.convert_dataset(f, args.subdirectory)
+        if data and not isinstance(data[0], list):  # A file without trip ids holds a single trip.
+            data = [data]
+
+    if args.clip:
+        data = _study_area.clip_trips(data)
+        if not isinstance(data, util.Shapes.TripBatch):
+            data = list(data)
+
+    compressed = f.endswith(('.gz', '.zst'))
+    prefix = os.path.splitext(os.path.splitext(f)[0] if compressed else f)[0]
+    if args.output != 'csv':
+        mm.specify_batch_output(args.output, prefix)
+    results = mm.batch_process(data,
+                               prefix,
+                               score=getattr(map_match.scoring_fns, args.score),
+                               evaluation=getattr(map_match.evaluation_fns, args.evaluation),
+                               min_path=args.min_path,
+                               processes=processes)
+    return f, results
+
+
+def _run_file(f, args):
+    """
+    Matches a file in a worker process.
+    """
+    return run(_matcher, f, args)
 
 
 def get_files(path, absolute=False, system_type=SYSTEM_TYPE):
@@ -45,24 +100,91 @@ def get_files(path, absolute=False, system_type=SYSTEM_TYPE):
     # path: the path to the directory
     # absolute: whether or not the filePath should be relative, i.e. ~/myFile.file vs. ~/.../myFile.file
     # system_type: 'windows' or 'unix'
-    def get_script_path(p):
-        return os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + p
-
-    files = [file for file in os.listdir(get_script_path(path)) if 'clustered_' in file]
+    # Columnar caches written by earlier versions of --columnar beside their files are not probe data.
+    files = [file for file in os.listdir(get_script_path(path))
+             if 'clustered_' in file and not file.endswith(('.npy', '.trips.json'))]
     print(files)
     return [get_script_path(path) + separator() + file for file in files] if absolute else files
 
 
-def separator():
-    return WINDOWS_ENCODING if SYSTEM_TYPE == 'windows' else UNIX_ENCODING
+def get_script_path(p):
+    return os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + p
 
 
-def read_all(subdirectory):
-    for file in get_files(subdirectory):
-        print('\tRunning ' + file)
-        run(file)
-        print('\tFinished ' + file)
+def separator():
+    return WINDOWS_ENCODING if SYSTEM_TYPE == 'windows' else UNIX_ENCODING
 
-read_all('data')
 
-# run(sys.argv[1])
\ No newline at end of file
+def resolve_files(patterns, subdirectory):
+    """
+    :param patterns: file names or glob patterns, relative to the subdirectory
+    :return: the sorted names of the matching files, or every clustered file of the subdirectory if there are no
+             patterns
+    """
+    if not patterns:
+        return sorted(get_files(subdirectory))
+    directory = get_script_path(subdirectory)
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(directory + separator() + pattern))
+        if not matches:
+            print('no files match', pattern)
+        files.extend(os.path.relpath(match, directory) for match in matches)
+    return list(dict.fromkeys(files))
+
+
+def main():
+    global _matcher, _study_area
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='file names or glob patterns in the data subdirectory')
+    parser.add_argument('--subdirectory', default='data', help='the directory holding the probe data files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of worker processes. Several files are matched concurrently, one per worker, '
+                             'and the trips of a single file are split between the workers.')
+    parser.add_argument('--k', type=int, default=20, help='the number of candidates of each data point')
+    parser.add_argument('--max-distance', type=float, default=200,
+                        help='the longest edge, in feet, allowed by network.equalize_node_density')
+    parser.add_argument('--max-angle', type=float, default=15,
+                        help='the largest change of heading, in degrees, allowed within a merged edge')
+    parser.add_argument('--score', default='exp_distance_heading', help='a score function of map_match.scoring_fns')
+    parser.add_argument('--evaluation', default='viterbi', help='an evaluation function of map_match.evaluation_fns')
+    parser.add_argument('--min-path', type=int, default=2, help='trips with fewer data points are skipped')
+    parser.add_argument('--output', choices=['csv', 'sqlite', 'parquet'], default='csv',
+                        help='a pair of CSVs per trip, or a single SQLite file or Parquet dataset per input file')
+    parser.add_argument('--columnar', action='store_true',
+                        help='read each file through a memory-mapped columnar cache in the columnar_cache directory '
+                             'beside it, which is written by the '
+                             'first run and reused until the file changes')
+    parser.add_argument('--clip', metavar='BOUNDARY',
+                        help='a shapefile, GeoJSON file or WKT file of polygons. Points outside them are dropped '
+                             'before matching.')
+    parser.add_argument('--result-cache', metavar='FILENAME',
+                        help='a SQLite file in the exports directory which keeps matched trips between runs')
+    args = parser.parse_args()
+
+    files = resolve_files(args.files, args.subdirectory)
+    if not files:
+        parser.error('no input files')
+
+    mm = build_matcher(args)
+    if args.clip:
+        _study_area = util.clip.StudyArea.from_file(args.clip)
+    if args.workers <= 1 or len(files) == 1:
+        for f in files:
+            print('\tRunning ' + f)
+            run(mm, f, args, processes=args.workers)
+            print('\tFinished ' + f)
+        return
+
+    """ Fork after the network and tree are built, so that each worker shares them rather than building its own. """
+    _matcher = mm
+    with multiprocessing.get_context('fork').Pool(min(args.workers, len(files))) as pool:
+        for f, results in pool.imap_unordered(functools.partial(_run_file, args=args), files):
+            failures = sum(result.error is not None for result in results)
+            print('\tFinished {0}: {1} trips, {2} not exported'.format(f, len(results), failures))
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""
+Serves map matching requests over HTTP on localhost, or on a Unix socket, from a network and spatial index which are
+built once when the service starts.
+
+Endpoints:
+  POST /match    a trip, as a JSON list of points, or as a CSV of HERE probe data (Content-Type: text/csv). A JSON point
+                 has the keys timestamp, speed, lon, lat and heading. A CSV may hold several trips, in a TRIP_ID
+                 column. Responds with the matched vertices, sections, scores and segments of each trip.
+  GET  /health   whether the service is ready
+  GET  /metrics  request, batch and stage counters
+
+Example usage:
+  python service.py --port 8080 --workers 4
+  curl -X POST --data-binary @trip.json http://localhost:8080/match
+  curl -X POST -H 'Content-Type: text/csv' --data-binary @data/probe_data.csv http://localhost:8080/match
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mapMatch
+import map_match.evaluation_fns
+import map_match.scoring_fns
+import util.m_tree.tree
+import util.utils
+from constructNetwork import TrafficNetwork
+from util.Shapes import DataPoint
+from util.instrumentation import Metrics
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+MAX_BODY = 64 * 1024 * 1024
+
+""" The map matching object of the service, inherited by forked worker processes. """
+_matcher = None
+
+""" A barrier which every worker process waits at once, so that the pool starts all of its workers at once. """
+_start_barrier = None
+
+
+def _wait_for_workers():
+    """
+    Blocks a worker process until every worker has started.
+    """
+    _start_barrier.wait(60)
+
+
+def _match_trips(trips):
+    """
+    Matches a batch of trips in a worker process.
+    :param trips: a list of lists of DataPoints
+    :return: a list of dictionaries, one per trip, as returned to the client, and the Metrics of the batch or None
+    """
+    metrics = Metrics() if _matcher.instrumentation is not None else None
+    responses = []
+    for data in trips:
+        if metrics is not None:
+            _matcher.metrics = Metrics()
+        try:
+            _matcher.update_data(data)
+            responses.append({'vertices': [int(vertex) for vertex in _matcher.result],
+                              'sections': _matcher.network.to_sections(_matcher.result),
+                              'scores': [{str(vertex): score for vertex, score in candidates.items()}
+                                         for candidates in _matcher.matches],
+                              'segments': [{'start': segment.start, 'stop': segment.stop,
+                                            'vertices': [int(vertex) for vertex in segment.result]}
+                                           for segment in _matcher.segments]})
+        except Exception as exception:
+            responses.append({'error': repr(exception)})
+        if metrics is not None:
+            metrics.merge(_matcher.metrics)
+    return responses, metrics
+
+
+def parse_trips(body, content_type):
+    """
+    :param body: the bytes of a request
+    :param content_type: the Content-Type header of the request
+    :return: a list of lists of DataPoints. The rows of a CSV are grouped by TRIP_ID, whether or not the rows of each
+             trip are consecutive, and trips are in the order of their first rows.
+    :raises ValueError: if the body is not a trip
+    """
+    text = body.decode('utf-8')
+    if 'csv' in content_type:
+        trips = {}
+        for line in csv.DictReader(io.StringIO(text)):
+            trips.setdefault(line.get('TRIP_ID'), []).append(DataPoint.from_row(line))
+        return list(trips.values())
+
+    points = json.loads(text)
+    if isinstance(points, dict):
+        points = points['points']
+    return [[DataPoint.from_dict(point) for point in points]]
+
+
+class MatchService:
+    """
+    An asyncio front end which reads requests, and a pool of worker processes which match them. Trips which arrive
+    within batch_window seconds of each other are sent to a worker together, up to batch_size trips, so that a burst of
+    small requests costs fewer round trips to the pool.
+    """
+
+    def __init__(self, mm, workers=2, batch_size=16, batch_window=0.01):
+        """
+        :param mm: a map matching object with a score and an evaluation function
+        :param workers: the number of worker processes
+        :param batch_size: the largest number of trips sent to a worker at once
+        :param batch_window: the number of seconds to wait for more trips before sending a batch
+        """
+        self.mm = mm
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.pool = None
+        self.queue = None
+        self.pending = set()
+        self.started = time.time()
+        self.metrics = Metrics()
+
+    async def start(self, host='127.0.0.1', port=8080, socket_path=None):
+        """
+        Starts the worker pool and the server.
+        :param socket_path: optionally, the path of a Unix socket to serve on instead of a TCP port
+        :return: an asyncio Server
+        """
+        global _matcher, _start_barrier
+        _matcher = self.mm
+        """ Fork every worker now, after the network and tree are built so that each worker shares them, and before
+        the server opens any socket which a worker would inherit and hold open. A pool only starts a worker when no
+        idle one can take a job, so a job which waits for every other worker is sent to each of them. """
+        context = multiprocessing.get_context('fork')
+        _start_barrier = context.Barrier(self.workers)
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(self.pool, _wait_for_workers)
+                               for _ in range(self.workers)))
+        self.queue = asyncio.Queue()
+        self.pending.add(asyncio.ensure_future(self.dispatch()))
+        if socket_path is not None:
+            return await asyncio.start_unix_server(self.handle, path=socket_path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self):
+        for task in self.pending:
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    async def match(self, trips):
+        """
+        Queues trips to be matched, and waits for their results.
+        :return: a list of dictionaries, one per trip
+        """
+        futures = []
+        for trip in trips:
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((trip, future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    async def dispatch(self):
+        """
+        Collects queued trips into batches and sends each batch to the pool. Several batches may be in the pool at once.
+        """
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    async def run_batch(self, batch):
+        """
+        Matches a batch of trips in the pool, and passes each result to the request which is waiting for it.
+        """
+        self.metrics.count('batches')
+        self.metrics.count('batched_trips', len(batch))
+        try:
+            with self.metrics.time('worker'):
+                responses, metrics = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, _match_trips, [trip for trip, _ in batch])
+        except Exception as exception:
+            responses, metrics = [{'error': repr(exception)}] * len(batch), None
+        if metrics is not None:
+            self.metrics.merge(metrics)
+        for (_, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+    async def handle(self, reader, writer):
+        """
+        Reads an HTTP request from a connection, and writes the response.
+        """
+        try:
+            status, response = await self.respond(reader)
+        except Exception as exception:
+            status, response = 500, {'error': repr(exception)}
+        body = json.dumps(response).encode('utf-8')
+        writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, STATUS_TEXT[status], len(body)).encode('ascii') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, reader):
+        """
+        :return: a tuple of (the HTTP status, a response which can be encoded as JSON)
+        """
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return 400, {'error': 'malformed request line'}
+        method, path = request_line[0], request_line[1].split('?')[0]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if path == '/health':
+            return 200, {'status': 'ok', 'workers': self.workers, 'uptime': time.time() - self.started}
+        if path == '/metrics':
+            return 200, self.metrics.as_dict()
+        if path != '/match':
+            return 404, {'error': 'unknown path ' + path}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            return 413, {'error': 'request body too large'}
+        body = await reader.readexactly(length)
+
+        self.metrics.count('requests')
+        try:
+            trips = parse_trips(body, headers.get('content-type', ''))
+        except (ValueError, KeyError, TypeError, AssertionError) as exception:
+            self.metrics.count('bad_requests')
+            return 400, {'error': repr(exception)}
+
+        with self.metrics.time('request'):
+            results = await self.match(trips)
+        self.metrics.count('trips', len(trips))
+        self.metrics.count('failed_trips', sum('error' in result for result in results))
+        return 200, {'trips': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='the address to serve on')
+    parser.add_argument('--port', type=int, default=8080, help='the port to serve on')
+    parser.add_argument('--socket', help='the path of a Unix socket to serve on instead of a port')
+    parser.add_argument('--workers', type=int, default=2, help='the number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=16, help='the largest number of trips matched as a batch')
+    parser.add_argument('--batch-window', type=float, default=0.01,
+                        help='the number of seconds to wait for more trips before matching a batch')
+    parser.add_argument('--k', type=int, default=20, help='the number of candidates of each data point')
+    parser.add_argument('--max-distance', type=float, default=200,
+                        help='the longest edge, in feet, allowed by network.equalize_node_density')
+    parser.add_argument('--max-angle', type=float, default=15,
+                        help='the largest change of heading, in degrees, allowed within a merged edge')
+    parser.add_argument('--score', default='exp_distance_heading', help='a score function of map_match.scoring_fns')
+    parser.add_argument('--evaluation', default='viterbi', help='an evaluation function of map_match.evaluation_fns')
+    parser.add_argument('--instrument', action='store_true', help='report stage timings on /metrics')
+    args = parser.parse_args()
+
+    junction_map, section_map = util.utils.decode_json()
+    network = TrafficNetwork(junction_map, section_map)
+    print('network constructed. number of nodes:',
+          network.equalize_node_density(args.max_distance, args.max_angle, greedy=True))
+    mm = mapMatch.MapMatch(network, util.m_tree.tree.MTree, getattr(map_match.scoring_fns, args.score),
+                           getattr(map_match.evaluation_fns, args.evaluation), [])
+    mm.specify_candidate_count(args.k)
+    mm.specify_instrumentation(args.instrument)
+
+    service = MatchService(mm, args.workers, args.batch_size, args.batch_window)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(service.start(args.host, args.port, args.socket))
+    print('serving on', args.socket or '{0}:{1}'.format(args.host, args.port))
+    try:
+        loop.run_until_complete(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        service.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
+import numpy as np
+
 from util.utils import offset_point
 
 class SearchArea:
     def __init__(self, initial_point, distance, initial_width, fanout=90):
         """
-        :param initial_point: A Point object from which the search originates
+        :param initial_point: A Point object from which the search originates, with a bearing.
         :param distance: The maximum distance from the original point.
         :param initial_width: The initial width at the angle orthogonal to the initial point.
         :param fanout: The fanout angle. The default parameter gives a rectangle.
@@ -14,56 +16,61 @@ class SearchArea:
         self.fanout = fanout
         self.search_area = self.construct_hourglass()
 
+        """ The vertices of the area as arrays, with each longitude within 180 degrees of the initial point, so that an
+        area which crosses the antimeridian is not torn in two. """
+        self.lons = self.unwrap(np.array([p.lon for p in self.search_area]))
+        self.lats = np.array([p.lat for p in self.search_area])
+
     def construct_hourglass(self):
         """
-        Constructs a search area by fanning out in either direction of the bearing of the point.
+        Constructs a search area by fanning out in either direction of the bearing of the point, ahead of it and behind
+        it, from a waist of initial_width on either side of the point.
         :return: a list of Points, whose edges define a search area.
         """
         offset_to_fanout = 90 - self.fanout
+        bearing = self.initial_point.bearing
 
-        left_offset = offset_point(self.initial_point, self.initial_width, 90)
-        left_positive_fanout = offset_point(left_offset, self.distance, -offset_to_fanout)
-        left_negative_fanout = offset_point(left_offset, self.distance, offset_to_fanout)
-        right_offset = offset_point(self.initial_point, self.initial_width, -90)
-        right_positive_fanout = offset_point(right_offset, self.distance, offset_to_fanout)
-        right_negative_fanout = offset_point(right_offset, self.distance, -offset_to_fanout)
+        left_offset = offset_point(self.initial_point, self.initial_width, bearing - 90)
+        left_positive_fanout = offset_point(left_offset, self.distance, bearing - offset_to_fanout)
+        left_negative_fanout = offset_point(left_offset, self.distance, bearing + 180 + offset_to_fanout)
+        right_offset = offset_point(self.initial_point, self.initial_width, bearing + 90)
+        right_positive_fanout = offset_point(right_offset, self.distance, bearing + offset_to_fanout)
+        right_negative_fanout = offset_point(right_offset, self.distance, bearing + 180 - offset_to_fanout)
 
         return [left_offset, left_positive_fanout, right_positive_fanout,
                 right_offset, right_negative_fanout, left_negative_fanout]
 
+    def unwrap(self, lons):
+        """
+        :return: The longitudes, each shifted by a multiple of 360 degrees to within 180 degrees of the initial point.
+        """
+        return lons - 360 * np.round((lons - self.initial_point.lon) / 360)
+
     def contains(self, point):
         """
         Determines if the search area contains a point.
         :param point:
         :return:
         """
-        last_point = self.search_area[-1]
-        is_inside = False
-
-        for p in self.search_area:
-            dx = p.lon - last_point.lon
+        return bool(self.contains_many([point.lon], [point.lat])[0])
 
-            if abs(dx) > 180:
-                # Crossed Prime Meridian
-                if point.lon > 0:
-                    while last_point.lon < 0:
-                        last_point.lon += 360
-                    while p.lon < 0:
-                        p.lon += 360
-                else:
-                    while last_point.lon > 0:
-                        last_point.lon -= 360
-                    while p.lon > 0:
-                        p.lon -= 360
-
-                dx = p.lon - last_point.lon
-
-            if (last_point.lon <= point.lon < p.lon) or (p.lon < point.lon <= last_point.lon):
-                gradient = (p.lat - last_point.lat) / dx
-                intersection_at_lat = last_point.lat + ((point.lon - last_point.lon) * gradient)
-
-                if intersection_at_lat > point.lat:
-                    is_inside = not is_inside
-            last_point = p
+    def contains_many(self, lons, lats):
+        """
+        Determines which of many points the search area contains, by casting a ray north from each point and counting
+        the edges of the area it crosses. Every point is tested against every edge at once.
+        :param lons: A sequence of longitudes.
+        :param lats: A sequence of latitudes.
+        :return: A boolean array, True for each point within the area.
+        """
+        lons = self.unwrap(np.asarray(lons, dtype=float))[:, np.newaxis]
+        lats = np.asarray(lats, dtype=float)[:, np.newaxis]
 
-        return is_inside
+        """ Each edge runs from the previous vertex to the next. """
+        start_lons, start_lats = np.roll(self.lons, 1), np.roll(self.lats, 1)
+        end_lons, end_lats = self.lons, self.lats
+        spans = ((start_lons <= lons) & (lons < end_lons)) | ((end_lons < lons) & (lons <= start_lons))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gradients = (end_lats - start_lats) / (end_lons - start_lons)
+            intersection_at_lat = start_lats + (lons - start_lons) * gradients
+        crossings = spans & (intersection_at_lat > lats)
+        return np.count_nonzero(crossings, axis=1) % 2 == 1
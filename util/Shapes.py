@@ -1,7 +1,13 @@
+import datetime
+import json
+import os
+from itertools import chain, groupby
 from math import radians
-import shapely.geometry as geom
 
-from util.parser import read_csv
+import numpy as np
+
+from util.export import point_wkb
+from util.parser import data_path, read_csv, read_csv_columns, read_csv_sorted, separator
 
 
 class Point:
@@ -59,7 +65,7 @@ class Point:
         return {'lon': self.lon, 'lat': self.lat, 'bearing': self.bearing}
 
     def as_geometry(self):
-        return geom.Point(self.as_list()).wkb_hex
+        return point_wkb(self.lon, self.lat)
 
 class DataPoint(Point):
     """
@@ -78,6 +84,17 @@ class DataPoint(Point):
         """
         return cls(d['timestamp'], d['speed'], d['lon'], d['lat'], d['heading'])
 
+    @classmethod
+    def from_row(cls, line):
+        """
+        :param line: A row of a CSV of HERE probe data, with the entries SAMPLE_DATE, SPEED, LON, LAT, HEADING
+        """
+        return cls(timestamp=line['SAMPLE_DATE'],
+                   speed=line['SPEED'],
+                   lon=line['LON'],
+                   lat=line['LAT'],
+                   bearing=line['HEADING'])
+
     def as_dict(self):
         """
         Returns a dictionary containing the attributes of the DataPoint. Not yet used.
@@ -89,31 +106,370 @@ class DataPoint(Point):
     @staticmethod
     def convert_dataset(filename, subdirectory='data'):
         """
-        Converts a CSV of HERE probe data into a list of DataPoints.
+        Converts a CSV of HERE probe data into a list of DataPoints. The file is read once.
         :param subdirectory:
         :param filename:
         :return: a list of DataPoints representing a path if there is only a single path in the file, or a
                  list of paths if there are many paths in the file.
         """
+        rows = read_csv(filename, subdirectory)
+        first = next(rows, None)
+        if first is None:
+            return []
+        rows = chain([first], rows)
+
         """ Single path case. """
-        if 'TRIP_ID' not in next(read_csv(filename, subdirectory)):
-            return [DataPoint(timestamp=line['SAMPLE_DATE'],
-                              speed=line['SPEED'],
-                              lon=line['LON'],
-                              lat=line['LAT'],
-                              bearing=line['HEADING']) for line in read_csv(filename, subdirectory)]
+        if 'TRIP_ID' not in first:
+            return [DataPoint.from_row(line) for line in rows]
 
         """ Multiple path case. """
         paths = {}
-        for line in read_csv(filename, subdirectory):
-            next_point = DataPoint(timestamp=line['SAMPLE_DATE'],
-                                   speed=line['SPEED'],
-                                   lon=line['LON'],
-                                   lat=line['LAT'],
-                                   bearing=line['HEADING'])
+        for line in rows:
+            next_point = DataPoint.from_row(line)
             try:
                 paths[line['TRIP_ID']].append(next_point)
             except KeyError:
                 paths[line['TRIP_ID']] = [next_point]
 
         return list(paths.values())
+
+    @staticmethod
+    def iterate_dataset(filename, subdirectory='data', sorted_by_trip=True, chunk_rows=1000000):
+        """
+        Reads a CSV of HERE probe data one trip at a time, without holding the whole file in memory. Each trip is
+        yielded as soon as its last row has been read. A file without a TRIP_ID column is a single trip.
+        :param subdirectory:
+        :param filename:
+        :param sorted_by_trip: whether the rows of each trip are consecutive. If not, the rows are sorted by TRIP_ID
+                               first, by spilling sorted runs of chunk_rows rows to temporary files and merging them,
+                               and trips are yielded in order of TRIP_ID.
+        :param chunk_rows: the number of rows sorted in memory at once, if the file is not sorted
+        :return: a generator of lists of DataPoints, one per trip
+        """
+        rows = read_csv(filename, subdirectory) if sorted_by_trip else \
+            read_csv_sorted(filename, subdirectory, 'TRIP_ID', chunk_rows)
+        for _, trip in groupby(rows, key=lambda line: line.get('TRIP_ID')):
+            yield [DataPoint.from_row(line) for line in trip]
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+MISSING_TIME = np.iinfo(np.int64).min  # The epoch time of a data point whose timestamp could not be read.
+
+""" The columns of a TripBatch. time is in seconds since the epoch, and trip is the position of the trip in the batch. """
+TRIP_DTYPE = np.dtype([('lon', 'f8'), ('lat', 'f8'), ('bearing', 'f4'), ('speed', 'f4'), ('time', 'i8'),
+                       ('trip', 'i8')])
+
+""" The columns of a file of HERE probe data which a TripBatch reads. """
+PROBE_COLUMNS = ['LON', 'LAT', 'HEADING', 'SPEED', 'SAMPLE_DATE', 'TRIP_ID']
+
+
+def parse_timestamps(timestamps):
+    """
+    Converts timestamps in the form '%Y-%m-%d %H:%M:%S' to seconds since the epoch, all at once.
+    :param timestamps: A sequence of strings.
+    :return: An int64 array. A timestamp which cannot be read becomes MISSING_TIME.
+    """
+    strings = np.asarray(timestamps, dtype=str)
+    try:
+        return strings.astype('datetime64[s]').astype('i8')
+    except ValueError:
+        """ At least one timestamp is malformed, so convert them one at a time. """
+        times = np.empty(len(strings), dtype='i8')
+        for index, timestamp in enumerate(strings):
+            try:
+                times[index] = np.datetime64(timestamp, 's').astype('i8')
+            except ValueError:
+                times[index] = MISSING_TIME
+        return times
+
+
+class DataPointView:
+    """
+    A read-only view of a data point of a TripBatch, which can be used wherever a DataPoint is expected. Attributes are
+    read from the batch when they are accessed.
+    """
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    @property
+    def lon(self):
+        return float(self.record['lon'])
+
+    @property
+    def lat(self):
+        return float(self.record['lat'])
+
+    @property
+    def bearing(self):
+        return float(self.record['bearing'])
+
+    @property
+    def speed(self):
+        return float(self.record['speed'])
+
+    @property
+    def lon_as_rad(self):
+        return radians(self.lon)
+
+    @property
+    def lat_as_rad(self):
+        return radians(self.lat)
+
+    @property
+    def epoch(self):
+        """
+        :return: The time of the data point in seconds since the epoch, or None if it is unknown.
+        """
+        time = int(self.record['time'])
+        return None if time == MISSING_TIME else time
+
+    @property
+    def timestamp(self):
+        epoch = self.epoch
+        if epoch is None:
+            return None
+        return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=epoch)).strftime(TIMESTAMP_FORMAT)
+
+    def __repr__(self):
+        return '{0},{1} @ {2}\n'.format(self.lon, self.lat, self.bearing)
+
+    def as_list(self):
+        return [self.lon, self.lat]
+
+    def as_tuple(self):
+        return self.lon, self.lat, self.bearing
+
+    def as_dict(self):
+        return {'timestamp': self.timestamp, 'speed': self.speed, 'lon': self.lon, 'lat': self.lat,
+                'bearing': self.bearing}
+
+    def as_geometry(self):
+        return point_wkb(self.lon, self.lat)
+
+    def to_datapoint(self):
+        return DataPoint(self.timestamp, self.speed, self.lon, self.lat, self.bearing)
+
+
+class Trip:
+    """
+    The data points of one trip of a TripBatch. A sequence of DataPointViews, which can be passed to MapMatch in place of
+    a list of DataPoints. A slice of a Trip is a Trip.
+    """
+
+    def __init__(self, records, trip_id=None):
+        """
+        :param records: A structured array with the dtype TRIP_DTYPE.
+        :param trip_id: optionally, the TRIP_ID of the trip in its source file
+        """
+        self.records = records
+        self.trip_id = trip_id
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Trip(self.records[index], self.trip_id)
+        return DataPointView(self.records[index])
+
+    def __iter__(self):
+        return (DataPointView(record) for record in self.records)
+
+    def __bool__(self):
+        return len(self.records) > 0
+
+    def to_datapoints(self):
+        """
+        :return: A list of DataPoints.
+        """
+        return [view.to_datapoint() for view in self]
+
+
+class TripBatch:
+    """
+    The data points of many trips, stored in a single structured array with the columns of TRIP_DTYPE rather than as a
+    Python object per data point. A batch is a sequence of Trips, so it can be passed to MapMatch.batch_process in place
+    of a list of lists of DataPoints.
+
+    The records of each trip are contiguous, in the order in which they were given. trip_ids holds the TRIP_ID of each
+    trip in its source file.
+    """
+
+    def __init__(self, records, trip_ids=None):
+        """
+        :param records: A structured array with the dtype TRIP_DTYPE, whose trip column numbers the trips from 0. The
+                        records are sorted by trip, keeping the order of the records of each trip.
+        :param trip_ids: optionally, the TRIP_ID of each trip
+        """
+        if len(records) and np.any(np.diff(records['trip']) < 0):
+            records = records[np.argsort(records['trip'], kind='stable')]
+        self.records = records
+        self.trip_count = int(records['trip'].max()) + 1 if len(records) else 0
+        if trip_ids is not None:
+            self.trip_count = max(self.trip_count, len(trip_ids))
+        self.offsets = np.searchsorted(records['trip'], np.arange(self.trip_count + 1))
+        self.trip_ids = list(trip_ids) if trip_ids is not None else list(range(self.trip_count))
+
+    @classmethod
+    def from_columns(cls, lon, lat, bearing, speed, time, trip=None, trip_ids=None):
+        """
+        Builds a batch from a sequence of values for each column.
+        :param time: seconds since the epoch, or timestamps in the form '%Y-%m-%d %H:%M:%S'
+        :param trip: optionally, the position of the trip of each data point. Defaults to a single trip.
+        :raises ValueError: if a location is not a valid GPS location
+        """
+        records = np.empty(len(lon), dtype=TRIP_DTYPE)
+        records['lon'] = lon
+        records['lat'] = lat
+        records['bearing'] = bearing
+        records['speed'] = speed
+        time = np.asarray(time)
+        records['time'] = time if np.issubdtype(time.dtype, np.number) else parse_timestamps(time)
+        records['trip'] = 0 if trip is None else trip
+
+        valid = (-90 < records['lat']) & (records['lat'] < 90) & (-180 < records['lon']) & (records['lon'] < 180)
+        if not np.all(valid):
+            index = int(np.argmin(valid))
+            raise ValueError('invalid location: {0}, {1}'.format(records['lon'][index], records['lat'][index]))
+        return cls(records, trip_ids)
+
+    @classmethod
+    def from_datapoints(cls, trips):
+        """
+        :param trips: A list of lists of DataPoints.
+        """
+        points = [(point, trip) for trip, data in enumerate(trips) for point in data]
+        return cls.from_columns(lon=[point.lon for point, _ in points],
+                                lat=[point.lat for point, _ in points],
+                                bearing=[point.bearing for point, _ in points],
+                                speed=[point.speed for point, _ in points],
+                                time=[point.timestamp for point, _ in points],
+                                trip=[trip for _, trip in points])
+
+    @classmethod
+    def from_probe_columns(cls, columns):
+        """
+        :param columns: A dictionary mapping the columns of HERE probe data, LON, LAT, HEADING, SPEED, SAMPLE_DATE and
+                        optionally TRIP_ID, to sequences of values. Without TRIP_ID, the data points are a single trip.
+        """
+        trip_numbers = {}
+        if 'TRIP_ID' in columns:
+            trips = [trip_numbers.setdefault(trip_id, len(trip_numbers)) for trip_id in columns['TRIP_ID']]
+        else:
+            trips, trip_numbers = None, {None: 0}
+        time = np.asarray(columns['SAMPLE_DATE'])
+        if np.issubdtype(time.dtype, np.datetime64):
+            time = time.astype('datetime64[s]').astype('i8')
+        return cls.from_columns(lon=np.asarray(columns['LON'], dtype='f8'),
+                                lat=np.asarray(columns['LAT'], dtype='f8'),
+                                bearing=np.asarray(columns['HEADING'], dtype='f4'),
+                                speed=np.asarray(columns['SPEED'], dtype='f4'),
+                                time=time,
+                                trip=trips,
+                                trip_ids=list(trip_numbers))
+
+    @classmethod
+    def from_csv(cls, filename, subdirectory='data'):
+        """
+        Reads a CSV of HERE probe data, which may be compressed with gzip (.gz) or zstd (.zst). A file without a TRIP_ID
+        column is a single trip.
+        """
+        return cls.from_probe_columns(read_csv_columns(filename, subdirectory, PROBE_COLUMNS))
+
+    @classmethod
+    def from_arrow(cls, filename, subdirectory='data'):
+        """
+        Reads a Parquet (.parquet) or Arrow IPC (.arrow, .feather) file of HERE probe data, with the columns of the CSV.
+        Requires pyarrow.
+        """
+        import pyarrow.feather
+        import pyarrow.parquet
+        filepath = data_path(filename, subdirectory)
+        if filename.endswith('.parquet'):
+            names = pyarrow.parquet.read_schema(filepath).names
+            table = pyarrow.parquet.read_table(filepath, columns=[name for name in PROBE_COLUMNS if name in names])
+        else:
+            table = pyarrow.feather.read_table(filepath)
+        return cls.from_probe_columns({name: table.column(name).to_numpy() for name in PROBE_COLUMNS
+                                       if name in table.column_names})
+
+    @classmethod
+    def from_file(cls, filename, subdirectory='data'):
+        """
+        Reads a file of HERE probe data of any supported format, by its extension: a CSV, optionally compressed, a
+        Parquet or Arrow file, or a columnar cache written by save.
+        """
+        if filename.endswith('.npy'):
+            return cls.load(filename, subdirectory)
+        if filename.endswith(('.parquet', '.arrow', '.feather')):
+            return cls.from_arrow(filename, subdirectory)
+        return cls.from_csv(filename, subdirectory)
+
+    def save(self, filename, subdirectory='data'):
+        """
+        Writes the batch as a columnar cache: the records as a .npy file, which load can map into memory rather than
+        read, and the trip ids as a JSON file beside it.
+        :param filename: the name of the cache, ending in .npy
+        """
+        filepath = data_path(filename, subdirectory)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        np.save(filepath + '.tmp.npy', self.records, allow_pickle=False)
+        with open(filepath + '.trips.json.tmp', 'w') as trip_file:
+            """ Trip ids read from Parquet or Arrow are numpy scalars, which JSON cannot encode. """
+            json.dump([trip_id.item() if isinstance(trip_id, np.generic) else trip_id for trip_id in self.trip_ids],
+                      trip_file)
+        """ Both files are written in full before either replaces the old cache, and the records are replaced last, as
+        cached checks only their modification time. """
+        os.replace(filepath + '.trips.json.tmp', filepath + '.trips.json')
+        os.replace(filepath + '.tmp.npy', filepath)
+
+    @classmethod
+    def load(cls, filename, subdirectory='data', mmap=True):
+        """
+        Reads a columnar cache written by save.
+        :param mmap: whether to map the records into memory, so that only the pages which are used are read, and worker
+                     processes share them, rather than copying the file into memory
+        """
+        filepath = data_path(filename, subdirectory)
+        records = np.load(filepath, mmap_mode='r' if mmap else None, allow_pickle=False)
+        with open(filepath + '.trips.json') as trip_file:
+            trip_ids = json.load(trip_file)
+        return cls(records, trip_ids)
+
+    @classmethod
+    def cached(cls, filename, subdirectory='data', cache_subdirectory=None):
+        """
+        Reads a file of HERE probe data through its columnar cache. The first read converts the file and writes the
+        cache, and later reads load the cache, until the file is modified.
+        :param cache_subdirectory: the directory of the cache. Defaults to the directory columnar_cache within the
+                                   directory of the file, so that the cache is not mistaken for probe data.
+        :return: a TripBatch whose records are mapped from the cache
+        """
+        cache_subdirectory = cache_subdirectory or subdirectory + separator() + 'columnar_cache'
+        cache_name = os.path.basename(filename) + '.npy'
+        source, cache = data_path(filename, subdirectory), data_path(cache_name, cache_subdirectory)
+        if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(source):
+            print('converting', filename, 'to', cache_name)
+            cls.from_file(filename, subdirectory).save(cache_name, cache_subdirectory)
+        return cls.load(cache_name, cache_subdirectory)
+
+    def __len__(self):
+        return self.trip_count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.trip_count
+        if not 0 <= index < self.trip_count:
+            raise IndexError(index)
+        return Trip(self.records[self.offsets[index]:self.offsets[index + 1]], self.trip_ids[index])
+
+    def __iter__(self):
+        return (self[index] for index in range(self.trip_count))
+
+    def to_datapoints(self):
+        """
+        :return: A list of lists of DataPoints, one list per trip.
+        """
+        return [trip.to_datapoints() for trip in self]
@@ -0,0 +1,156 @@
+import argparse
+import csv
+import json
+import os, sys
+from itertools import islice
+
+import numpy as np
+import shapely
+import shapely.geometry as geom
+import shapely.wkt
+
+from util.Shapes import Trip, TripBatch
+
+WINDOWS_ENCODING = '\\'
+UNIX_ENCODING = '/'
+
+SYSTEM_TYPE = 'linux'
+
+
+def load_geometries(filepath):
+    """
+    Reads the polygons of a study area, such as the TAZ layer.
+    :param filepath: a shapefile (.shp, which requires the pyshp package), a GeoJSON file (.geojson or .json) holding a
+                     FeatureCollection, a Feature or a geometry, or a text file of WKT, one geometry per line
+    :return: a list of shapely geometries
+    """
+    if filepath.endswith('.shp'):
+        try:
+            import shapefile
+        except ImportError:
+            raise ImportError('reading ' + filepath + ' requires the pyshp package')
+        with shapefile.Reader(filepath) as reader:
+            return [geom.shape(shape.__geo_interface__) for shape in reader.shapes()]
+
+    with open(filepath) as boundary_file:
+        if filepath.endswith(('.geojson', '.json')):
+            document = json.load(boundary_file)
+            if document.get('type') == 'FeatureCollection':
+                return [geom.shape(feature['geometry']) for feature in document['features']]
+            if document.get('type') == 'Feature':
+                return [geom.shape(document['geometry'])]
+            return [geom.shape(document)]
+        return [shapely.wkt.loads(line) for line in boundary_file if line.strip()]
+
+
+class StudyArea:
+    """
+    The region which probe data is clipped to, as the union of a set of polygons. The union is prepared once, so that
+    testing many points against it costs a tree search per point rather than a test against every edge of every
+    polygon. Points are tested in arrays, without a Python object per point. A point on the boundary is inside the
+    area, as it is for the Clip tool of QGIS.
+    """
+
+    def __init__(self, geometries):
+        """
+        :param geometries: a list of shapely polygons or multipolygons
+        """
+        self.area = shapely.union_all(geometries)
+        shapely.prepare(self.area)
+
+    @classmethod
+    def from_file(cls, filepath):
+        """
+        :param filepath: a file of polygons, as read by load_geometries
+        """
+        return cls(load_geometries(filepath))
+
+    def contains(self, lons, lats):
+        """
+        :param lons: An array of longitudes.
+        :param lats: An array of latitudes.
+        :return: A boolean array, True for each point within the area.
+        """
+        return shapely.intersects_xy(self.area, np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+
+    def clip_trip(self, data):
+        """
+        :param data: A list of DataPoints, or a Trip.
+        :return: The data points of the trip within the area, in order, of the same type as data.
+        """
+        if isinstance(data, Trip):
+            return Trip(data.records[self.contains(data.records['lon'], data.records['lat'])], data.trip_id)
+        inside = self.contains([point.lon for point in data], [point.lat for point in data])
+        return [point for point, keep in zip(data, inside) if keep]
+
+    def clip_trips(self, trips):
+        """
+        Clips each trip of a stream of trips, one at a time.
+        :param trips: An iterable of lists of DataPoints, or a TripBatch.
+        :return: A TripBatch of the data points within the area if trips is a TripBatch, otherwise a generator of
+                 lists of DataPoints. A trip with no points within the area is empty rather than removed, so that trips
+                 keep their positions.
+        """
+        if isinstance(trips, TripBatch):
+            records = trips.records[self.contains(trips.records['lon'], trips.records['lat'])]
+            return TripBatch(records, trips.trip_ids)
+        return (self.clip_trip(data) for data in trips)
+
+
+def clip_file(subdir, file, area, chunk_rows=100000):
+    """
+    Clips a CSV of HERE probe data to a study area, and writes the rows within it to a file of the same name with
+    'clipped_' appended to the start. The file is read chunk_rows rows at a time, with the csv module, so that quoted
+    fields may hold commas.
+    :param area: a StudyArea
+    :return: The path of the clipped file.
+    """
+    directory = os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + subdir + separator()
+    clipped_file = directory + "clipped_" + file
+    with open(directory + file, newline='') as f, open(clipped_file, 'w', newline='') as text_file:
+        reader, writer = csv.reader(f), csv.writer(text_file, lineterminator='\n')
+        columns = next(reader)
+        writer.writerow(columns)
+        lat_column, lon_column = columns.index('LAT'), columns.index('LON')
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                break
+            rows = [row for row in rows if row]
+            inside = area.contains(np.array([row[lon_column] for row in rows], dtype=float),
+                                   np.array([row[lat_column] for row in rows], dtype=float))
+            writer.writerows(row for row, keep in zip(rows, inside) if keep)
+    return clipped_file
+
+
+def get_files(path):
+    """
+    Returns the names of the clustered files of a directory which have not been clipped.
+    """
+    directory = os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + path
+    return [file for file in os.listdir(directory) if file.startswith('clustered_')]
+
+
+def separator():
+    return WINDOWS_ENCODING if SYSTEM_TYPE == 'windows' else UNIX_ENCODING
+
+
+def clip_all(subdirectory, boundary, chunk_rows=100000):
+    """
+    Clips every clustered file of a directory to a study area.
+    :param boundary: the path of a file of polygons, as read by load_geometries
+    """
+    area = StudyArea.from_file(boundary)
+    for file in get_files(subdirectory):
+        print('\tClipping ' + file)
+        print('\tWrote clipped dataset to ' + clip_file(subdirectory, file, area, chunk_rows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clips the clustered probe data files of a directory, beside this '
+                                                 'script, to a study area.')
+    parser.add_argument('boundary', help='a shapefile, GeoJSON file or WKT file of the polygons of the study area')
+    parser.add_argument('subdirectory', nargs='?', default='to_cluster')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='the number of rows read at once')
+    args = parser.parse_args()
+    clip_all(args.subdirectory, args.boundary, args.chunk_rows)
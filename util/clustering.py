@@ -1,7 +1,14 @@
+import argparse
+import functools
 import math
+import multiprocessing
 import os, sys
-import datetime
-from util.utils import real_distance
+from itertools import islice
+
+import numpy as np
+
+from util.Shapes import MISSING_TIME, parse_timestamps
+from util.utils import EARTH_RADIUS_FEET
 
 WINDOWS_ENCODING = '\\'
 UNIX_ENCODING = '/'
@@ -9,59 +16,113 @@ UNIX_ENCODING = '/'
 SYSTEM_TYPE = 'linux'
 
 
-def cluster_compare(prev, cur, dist_thres=200, time_thres=45):
+def cluster_trip(lons, lats, times, dist_thres=200, time_thres=45):
     """
     Units: dist_thres in feet and time_thres in seconds
-    A helper function to determine whether or not the current point can be clustered, given the previous.
-    Returns True if we should keep both points, otherwise False.
+    Chooses the points of a trip to keep: the first point is kept, and each later point is kept if it is at least
+    time_thres seconds or dist_thres feet from the last point kept.
+    Whether a point is kept depends on the last point kept, so the points are compared in order. The radians and
+    cosines which the comparisons need are computed for the whole trip at once, and distances are compared as
+    haversines, without the arcsine of real_distance.
+    :param times: An array of seconds since the epoch, as returned by util.Shapes.parse_timestamps.
+    :return: A boolean array, True for each point to keep.
     """
-    cur_time = datetime.datetime.strptime(cur[1], "%Y-%m-%d %H:%M:%S")
-    prev_time = datetime.datetime.strptime(prev[1], "%Y-%m-%d %H:%M:%S")
-    time_delta = (cur_time - prev_time).seconds
-    dist_delta = real_distance((float(prev[3]), float(prev[2])), (float(cur[3]), float(cur[2])))
-    if (time_delta >= time_thres) or (dist_delta >= dist_thres):
-        # we should include cur
-        return True
-    else:
-        # we can cluster these together
-        return False
-    # return time_delta >= time_thres or dist_delta >= dist_thres
-
-
-def cluster_file(subdir, file):
+    keep = np.zeros(len(lons), dtype=bool)
+    if not len(keep):
+        return keep
+    lons, lats = np.radians(lons), np.radians(lats)
+    half_lons, half_lats = (lons / 2).tolist(), (lats / 2).tolist()
+    cos_lats = np.cos(lats).tolist()
+    """ Time deltas wrap to the previous day when negative, as timedelta.seconds does. A point with an unreadable
+    timestamp is always kept. """
+    times = np.where(times == MISSING_TIME, np.inf, times).tolist()
+    max_haversine = math.sin(min(dist_thres / EARTH_RADIUS_FEET, math.pi) / 2) ** 2
+
+    kept = [0]
+    anchor = 0
+    for index in range(1, len(half_lons)):
+        time_delta = times[index] - times[anchor]
+        if not math.isfinite(time_delta) or time_delta % 86400 >= time_thres or \
+                math.sin(half_lats[index] - half_lats[anchor]) ** 2 + cos_lats[anchor] * cos_lats[index] * \
+                math.sin(half_lons[index] - half_lons[anchor]) ** 2 >= max_haversine:
+            kept.append(index)
+            anchor = index
+    keep[kept] = True
+    return keep
+
+
+def cluster_chunk(lines, dist_thres=200, time_thres=45):
     """
-    Units: max_dist in feet and max_time in seconds
+    Clusters the lines of whole trips of a file of HERE probe data, in which the lines of each trip are consecutive.
+    The timestamp is the second column, latitude and longitude the third and fourth, and the trip id the last.
+    :param lines: A list of lines, without line endings.
+    :return: A list of the lines to keep.
     """
+    fields = [line.split(',') for line in lines]
+    times = parse_timestamps([row[1] for row in fields])
+    lats = np.array([row[2] for row in fields], dtype=float)
+    lons = np.array([row[3] for row in fields], dtype=float)
+    trips = np.array([row[-1] for row in fields])
+    boundaries = np.concatenate(([0], np.flatnonzero(trips[1:] != trips[:-1]) + 1, [len(trips)]))
+
+    kept = []
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        keep = cluster_trip(lons[start:stop], lats[start:stop], times[start:stop], dist_thres, time_thres)
+        kept.extend(lines[start + index] for index in np.flatnonzero(keep))
+    return kept
+
 
-    f = open(os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + subdir + separator() + file)
-    contents = f.read().splitlines()
-    header = contents[0]
-    clustered_contents = list()
-    clustered_contents.append(header + '\n')
-    
-    prev_line = contents[1]
-    prev = prev_line.split(',')
-    for line in contents[2:]:
-        cur = line.split(',')
-        if prev[-1] == cur[-1]:
-            # print("OLD TRIP Prev:", prev[-1], "OLD TRIP Cur:", cur[-1])
-            if cluster_compare(prev, cur):
-                clustered_contents.append(line + '\n')
-                prev = cur
-        else:
-            # new trip
-            # print("NEW TRIP Prev:", prev[-1], "NEW TRIP Cur:", cur[-1])
-            clustered_contents.append(line + '\n')
-            prev = cur
-
-    if len(clustered_contents) > 3:
-        clustered_file = os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + subdir + separator() + "clustered_" + file
-        with open (clustered_file, 'w') as text_file:
-            text_file.write("".join(clustered_contents))
+def cluster_file(subdir, file, dist_thres=200, time_thres=45, chunk_rows=100000):
+    """
+    Units: dist_thres in feet and time_thres in seconds
+    Clusters a file of HERE probe data, and writes the points kept to a file of the same name with 'clustered_'
+    appended to the start. The file is read chunk_rows lines at a time. The lines of each trip must be consecutive.
+    The first point of every trip is kept, including the first point of the file.
+    :return: The path of the clustered file, or None if fewer than three points were kept, in which case it is not
+             written.
+    """
+    directory = os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + subdir + separator()
+    clustered_file = directory + "clustered_" + file
+    written = 0
+    with open(directory + file) as f, open(clustered_file, 'w') as text_file:
+        text_file.write(f.readline())
+        carried = []
+        while True:
+            lines = carried + [line.rstrip('\r\n') for line in islice(f, chunk_rows)]
+            lines = [line for line in lines if line]
+            if len(lines) == len(carried):
+                break
+            """ The last trip of a chunk may continue in the next, so it is carried over rather than clustered. """
+            last_trip = lines[-1].rsplit(',', 1)[-1]
+            split = len(lines)
+            while split > 0 and lines[split - 1].rsplit(',', 1)[-1] == last_trip:
+                split -= 1
+            if split == 0:
+                carried = lines
+                continue
+            kept = cluster_chunk(lines[:split], dist_thres, time_thres)
+            text_file.write(''.join(line + '\n' for line in kept))
+            written += len(kept)
+            carried = lines[split:]
+        if carried:
+            kept = cluster_chunk(carried, dist_thres, time_thres)
+            text_file.write(''.join(line + '\n' for line in kept))
+            written += len(kept)
+
+    if written > 2:
         return clustered_file
+    os.remove(clustered_file)
     return None
 
 
+def _cluster_file(file, subdirectory, dist_thres, time_thres, chunk_rows):
+    """
+    Clusters a file in a worker process.
+    :return: A tuple of (the name of the file, the path of the clustered file or None)
+    """
+    return file, cluster_file(subdirectory, file, dist_thres, time_thres, chunk_rows)
+
+
 def get_files(path, absolute=False):
     """
     Returns a list of paths to uncorrected files in a directory.
@@ -82,13 +143,33 @@ def separator():
     return WINDOWS_ENCODING if SYSTEM_TYPE == 'windows' else UNIX_ENCODING
 
 
-def read_all(subdirectory):
-    for file in get_files(subdirectory):
-        print('\tClustering ' + file)
-        clustered_file = cluster_file(subdirectory, file)
-        if clustered_file:
-            print('\tWrote corrected dataset to ' + clustered_file)
-        else:
-            print('\tTrip too short. Not written.')
-
-read_all('to_cluster')
+def read_all(subdirectory, processes=None, dist_thres=200, time_thres=45, chunk_rows=100000):
+    """
+    Clusters every unclustered file of a directory, several files at once.
+    :param processes: the number of worker processes. Defaults to the number of CPUs.
+    """
+    files = get_files(subdirectory)
+    cluster = functools.partial(_cluster_file, subdirectory=subdirectory, dist_thres=dist_thres,
+                                time_thres=time_thres, chunk_rows=chunk_rows)
+    with multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), max(len(files), 1))) as pool:
+        for file, clustered_file in pool.imap_unordered(cluster, files):
+            print('\tClustered ' + file)
+            if clustered_file:
+                print('\tWrote corrected dataset to ' + clustered_file)
+            else:
+                print('\tTrip too short. Not written.')
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clusters the probe data files of a directory, beside this script.')
+    parser.add_argument('subdirectory', nargs='?', default='to_cluster')
+    parser.add_argument('--processes', type=int, help='the number of files clustered at once')
+    parser.add_argument('--distance', type=float, default=200,
+                        help='the distance in feet from the last point kept at which a point is kept')
+    parser.add_argument('--time', type=float, default=45,
+                        help='the number of seconds from the last point kept after which a point is kept')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='the number of lines read at once')
+    args = parser.parse_args()
+    read_all(args.subdirectory, args.processes, args.distance, args.time, args.chunk_rows)
@@ -0,0 +1,103 @@
+import math
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+class DistanceCache:
+    """
+    A bounded cache of shortest path results between pairs of vertices of a network, for use by TrafficNetwork. Each
+    entry maps (source, target) to (distance, predecessor), where predecessor is the vertex before target on the
+    shortest path from source, so that a path can be rebuilt one hop at a time from the entries along it.
+
+    A target which a search bounded by a maximum distance did not reach is stored with an infinite distance and the
+    bound, since it may be within reach of a search with a greater bound.
+
+    The cache belongs to a single snapshot of a network (see TrafficNetwork.snapshot), and can be saved to disk and
+    loaded on a later run of the same network. It holds at most max_size entries, and evicts the least recently used.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, snapshot, max_size=1000000):
+        """
+        :param snapshot: the snapshot of the network whose distances are cached
+        :param max_size: the number of entries held before the least recently used is evicted
+        """
+        self.snapshot = snapshot
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def distance(self, source, target, max_distance=None):
+        """
+        :param max_distance: optionally, the bound of the search which the cache answers for. A distance beyond it is
+                             infinite, as the search would report.
+        :return: The distance from source to target, which may be infinite, or None if the cache cannot tell.
+        """
+        with self.lock:
+            entry = self.entries.get((source, target))
+            if entry is not None:
+                distance, _, bound = entry
+                if not math.isinf(distance) or bound is None or (max_distance is not None and max_distance <= bound):
+                    self.entries.move_to_end((source, target))
+                    self.hits += 1
+                    return math.inf if max_distance is not None and distance > max_distance else distance
+            self.misses += 1
+            return None
+
+    def predecessor(self, source, target):
+        """
+        :return: The vertex before target on the shortest path from source, or None if it is not known.
+        """
+        with self.lock:
+            entry = self.entries.get((source, target))
+            return None if entry is None else entry[1]
+
+    def store(self, source, target, distance, predecessor, max_distance=None):
+        """
+        Stores the result of a search from source to target.
+        :param predecessor: the vertex before target on the shortest path, or None if target was not reached
+        :param max_distance: the bound of the search, or None if it was unbounded
+        """
+        with self.lock:
+            self.entries[(source, target)] = (distance, predecessor, max_distance if math.isinf(distance) else None)
+            self.entries.move_to_end((source, target))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self, filepath):
+        """
+        Writes the cache to a file, replacing it.
+        """
+        with self.lock:
+            state = {'snapshot': self.snapshot, 'max_size': self.max_size, 'entries': list(self.entries.items())}
+        with open(filepath + '.tmp', 'wb') as cache_file:
+            pickle.dump(state, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(filepath + '.tmp', filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        :return: The cache saved to a file by save.
+        """
+        with open(filepath, 'rb') as cache_file:
+            state = pickle.load(cache_file)
+        cache = cls(state['snapshot'], state['max_size'])
+        cache.entries = OrderedDict(state['entries'])
+        return cache
+
+    def __getstate__(self):
+        """ Locks cannot be pickled, so that a network with a cache can be sent to a worker process. """
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
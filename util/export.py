@@ -1,41 +1,507 @@
 import csv
+import decimal
+import gzip
+import math
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+from abc import ABC, abstractmethod
 
+import numpy as np
 import shapely.geometry as geom
+from itertools import chain
 from shapely.wkb import loads
 
 import util.parser as p
 
 
-def export(header, data, filename):
+def export(header, data, filename, compress=False, append=False):
     """
     Write a CSV as defined by the header, and the dictionaries holding data to the ~/exports/ directory.
     :param header: A sequence of strings of length k, where each item is a column name
-    :param data: A sequence of dictionaries each of length k, where each item in a row in the relation.
-    :return: True if successful, otherwise False
+    :param data: An iterable of dictionaries each of length k, where each item in a row in the relation, such as a
+                 list or a generator. Rows are written as they are read.
+    :param compress: whether to write a gzip-compressed CSV, filename.csv.gz
+    :param append: whether to add the rows to the end of an existing file, rather than replace it
+    :return: the number of rows written
     """
-    assert type(data) is list and len(data) > 0, "No path found"  # Data must be a list containing data.
     assert type(header) is list and len(header) > 0  # Header must be a list containing data.
+    rows = iter(data)
+    first = next(rows, None)
+    assert first is not None, "No path found"  # Data must contain data.
 
-    for row in data:
-        # Each row must be a dictionary, and the keys of the dictionary must be aligned with the header.
-        assert len(header) == len(row.keys()) and type(row) is dict
+    with ExportWriter(filename, header, compress=compress, append=append) as writer:
+        return writer.write_rows(chain([first], rows))
 
-    filepath = p.get_script_path('exports') + p.separator() + filename + '.csv'
-    with open(filepath, 'w', newline='\n') as csvfile:
-        f = csv.DictWriter(csvfile, fieldnames=header, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
 
-        f.writeheader()
-        for row in data:
-            f.writerow(row)
+def export_columns(header, columns, filename, compress=False, append=False):
+    """
+    Write a CSV as defined by the header, and the columns holding data to the ~/exports/ directory.
+    :param header: A sequence of strings of length k, where each item is a column name
+    :param columns: A dictionary of k sequences of equal length, such as lists or arrays, keyed by column name.
+    :param compress: whether to write a gzip-compressed CSV, filename.csv.gz
+    :param append: whether to add the rows to the end of an existing file, rather than replace it
+    :return: the number of rows written
+    """
+    assert type(header) is list and len(header) > 0  # Header must be a list containing data.
+    assert len(columns[header[0]]) > 0, "No path found"  # Columns must contain data.
+
+    with ExportWriter(filename, header, compress=compress, append=append) as writer:
+        return writer.write_columns(columns)
+
+
+def as_rows(header, columns):
+    """
+    :param header: A sequence of column names
+    :param columns: A dictionary of sequences of equal length, keyed by column name
+    :return: A list of dictionaries, one per row, as export writes.
+    """
+    return [dict(zip(header, row)) for row in zip(*(columns[column] for column in header))]
+
+
+def export_path(filename, compress=False):
+    """
+    :return: The path of the CSV which export writes for filename.
+    """
+    return p.get_script_path('exports') + p.separator() + filename + ('.csv.gz' if compress else '.csv')
+
+
+class ExportWriter:
+    """
+    Streams the rows of a table to a CSV in the ~/exports/ directory, as export writes it. Rows may be given as
+    dictionaries, one at a time from any iterable, or as columns of values, such as lists or arrays. The schema is
+    checked once per call, against the first row or the column names, rather than for every row. Rows are buffered and
+    written in blocks of buffer_rows rows.
+
+    A writer is a context manager, and must be closed for its last block to be written.
+    """
+
+    def __init__(self, filename, header, compress=False, append=False, buffer_rows=10000):
+        """
+        :param filename: the name of the CSV in the ~/exports/ directory, without an extension
+        :param header: A sequence of column names
+        :param compress: whether to write a gzip-compressed CSV, filename.csv.gz
+        :param append: whether to add rows to the end of an existing file, rather than replace it. The header is only
+                       written to a new or empty file.
+        :param buffer_rows: the number of rows to buffer before they are written
+        """
+        self.header = list(header)
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows_written = 0
+        self.filepath = export_path(filename, compress)
+
+        write_header = not append or not os.path.exists(self.filepath) or os.path.getsize(self.filepath) == 0
+        mode = 'at' if append else 'wt'
+        self.file = gzip.open(self.filepath, mode, newline='\n') if compress else \
+            open(self.filepath, mode, newline='\n')
+        self.writer = csv.writer(self.file, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        if write_header:
+            self.writer.writerow(self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_rows(self, rows):
+        """
+        Writes rows given as dictionaries whose keys are the columns of the header.
+        :param rows: an iterable of dictionaries, which is read one row at a time
+        :return: the number of rows written
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        assert type(first) is dict and len(first) == len(self.header) and all(column in first
+                                                                               for column in self.header), \
+            'the columns of a row do not match the header'
+        header = self.header
+        return self.write_values([row[column] for column in header] for row in chain([first], rows))
+
+    def write_columns(self, columns):
+        """
+        Writes rows given as columns.
+        :param columns: a dictionary mapping each column of the header to a sequence of its values, such as a list or
+                        an array. Every sequence has the same length.
+        :return: the number of rows written
+        """
+        assert set(columns) == set(self.header), 'the columns do not match the header'
+        values = [columns[column].tolist() if hasattr(columns[column], 'tolist') else columns[column]
+                  for column in self.header]
+        assert len(set(map(len, values))) <= 1, 'the columns have different lengths'
+        return self.write_values(zip(*values))
+
+    def write_values(self, rows):
+        """
+        Writes rows given as sequences of values in the order of the header.
+        :return: the number of rows written
+        """
+        count = 0
+        for row in rows:
+            self.buffer.append(row)
+            count += 1
+            if len(self.buffer) >= self.buffer_rows:
+                self.flush()
+        self.rows_written += count
+        return count
+
+    def flush(self):
+        """
+        Writes the buffered rows.
+        """
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+
+""" The headers of little-endian WKB: a byte order flag, a geometry type, and for a linestring, a number of points. """
+POINT_WKB_HEADER = struct.pack('<BI', 1, 1).hex().upper()
+LINESTRING_WKB_HEADER = struct.pack('<BII', 1, 2, 2).hex().upper()
+
+""" The records of bulk WKB, laid out byte for byte as the geometries, so that an array of them is a run of WKB. """
+POINT_WKB_DTYPE = np.dtype([('order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+LINESTRING_WKB_DTYPE = np.dtype([('order', 'u1'), ('type', '<u4'), ('count', '<u4'),
+                                 ('x1', '<f8'), ('y1', '<f8'), ('x2', '<f8'), ('y2', '<f8')])
+
+
+def point_wkb(lon, lat):
+    """
+    :return: The hex-encoded WKB of a point, as shapely's wkb_hex, without constructing a shapely geometry.
+    """
+    return POINT_WKB_HEADER + struct.pack('<2d', lon, lat).hex().upper()
+
+
+def linestring_wkb(lon1, lat1, lon2, lat2):
+    """
+    :return: The hex-encoded WKB of the linestring between two points.
+    """
+    return LINESTRING_WKB_HEADER + struct.pack('<4d', lon1, lat1, lon2, lat2).hex().upper()
+
+
+def split_hex(records):
+    """
+    :param records: An array of fixed size records.
+    :return: A list of the hex encoding of each record.
+    """
+    encoded = records.tobytes().hex().upper()
+    width = 2 * records.dtype.itemsize
+    return [encoded[start:start + width] for start in range(0, len(encoded), width)]
+
+
+def points_wkb(lons, lats):
+    """
+    Encodes many points at once.
+    :param lons: A sequence of longitudes.
+    :param lats: A sequence of latitudes.
+    :return: A list of the hex-encoded WKB of each point.
+    """
+    records = np.empty(len(lons), dtype=POINT_WKB_DTYPE)
+    records['order'], records['type'] = 1, 1
+    records['x'], records['y'] = lons, lats
+    return split_hex(records)
+
+
+def linestrings_wkb(lons1, lats1, lons2, lats2):
+    """
+    Encodes many two point linestrings at once.
+    :return: A list of the hex-encoded WKB of each linestring, from (lons1, lats1) to (lons2, lats2).
+    """
+    records = np.empty(len(lons1), dtype=LINESTRING_WKB_DTYPE)
+    records['order'], records['type'], records['count'] = 1, 2, 2
+    records['x1'], records['y1'], records['x2'], records['y2'] = lons1, lats1, lons2, lats2
+    return split_hex(records)
+
+
+WKT_PRECISION = decimal.Decimal('1e-16')  # The smallest decimal place of a coordinate written by shapely.
+
+
+def wkt_number(value):
+    """
+    :return: The text of value as shapely writes a coordinate. From 1e-4 and below 1e+17, the shortest digits which
+             read back as value are written in fixed notation, rounded to 16 decimal places, with no trailing zeros.
+             Otherwise they are written in exponent notation, with an unpadded exponent. Zero is written without its
+             sign.
+    """
+    value = float(value)
+    if value == 0:
+        return '0'
+    if value != value:
+        return 'NaN'
+    if value in (math.inf, -math.inf):
+        return 'Infinity' if value > 0 else '-Infinity'
+    text = repr(value)
+    if 1e-4 <= abs(value) < 1e17:
+        if 'e' not in text and len(text) - text.index('.') <= 17:  # Already fixed, within 16 decimal places.
+            return text[:-2] if text.endswith('.0') else text
+        digits = decimal.Decimal(text)
+        if digits.as_tuple().exponent < -16:
+            digits = digits.quantize(WKT_PRECISION, rounding=decimal.ROUND_HALF_EVEN)
+        text = '{0:f}'.format(digits)
+        return text.rstrip('0').rstrip('.') if '.' in text else text
+    mantissa, exponent = text.split('e')
+    return mantissa + 'e' + exponent[0] + exponent[1:].lstrip('0')
+
+
+def point_wkt(lon, lat):
+    """
+    :return: The WKT of a point, as shapely writes it.
+    """
+    return 'POINT ({0} {1})'.format(wkt_number(lon), wkt_number(lat))
+
+
+def linestring_wkt(lon1, lat1, lon2, lat2):
+    """
+    :return: The WKT of the linestring between two points.
+    """
+    return 'LINESTRING ({0} {1}, {2} {3})'.format(*map(wkt_number, (lon1, lat1, lon2, lat2)))
+
+
+def points_wkt(lons, lats):
+    """
+    :return: A list of the WKT of each point.
+    """
+    return [point_wkt(lon, lat)
+            for lon, lat in zip(np.asarray(lons, dtype=float).tolist(), np.asarray(lats, dtype=float).tolist())]
+
+
+def linestrings_wkt(lons1, lats1, lons2, lats2):
+    """
+    :return: A list of the WKT of each linestring, from (lons1, lats1) to (lons2, lats2).
+    """
+    columns = [np.asarray(values, dtype=float).tolist() for values in (lons1, lats1, lons2, lats2)]
+    return [linestring_wkt(*coordinates) for coordinates in zip(*columns)]
 
 
 def build_linestring(p1, p2):
     """
-    Constructs a hex-encoded linestring given two hex-encoded points
+    Constructs a hex-encoded linestring given two hex-encoded points. The coordinates of points written by point_wkb,
+    or shapely, are copied without decoding them.
     :param p1:
     :param p2:
     :return:
     """
+    if p1.upper().startswith(POINT_WKB_HEADER) and p2.upper().startswith(POINT_WKB_HEADER) and \
+            len(p1) == len(p2) == 42:
+        return LINESTRING_WKB_HEADER + p1[10:].upper() + p2[10:].upper()
     p1 = loads(p1, hex=True)
     p2 = loads(p2, hex=True)
     return geom.LineString([p1, p2]).wkb_hex
+
+
+class BatchWriter(ABC):
+    """
+    Writes the tables of every trip of a batch to a single output, rather than a pair of CSVs per trip. Each row is
+    labelled with its trip in a 'trip' column. Rows are buffered, and written in blocks of at least buffer_rows rows.
+
+    A writer may be shared by threads, and by forked processes, each of which writes its own blocks. A process must call
+    close once it has written its last trip, or its buffered rows are lost. Subclasses implement clear, write_block,
+    close_output and forget_output.
+    """
+
+    def __init__(self, filename, buffer_rows=100000):
+        """
+        :param filename: the name of the output in the ~/exports/ directory, without an extension
+        :param buffer_rows: the number of rows to buffer before they are written
+        """
+        self.filename = filename
+        self.buffer_rows = buffer_rows
+        self.buffers = {}
+        self.headers = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def start(self):
+        """
+        Removes the output of any earlier batch with the same filename. Call before the first trip of a batch, and
+        before any worker processes are forked.
+        """
+        with self.lock:
+            self.buffers, self.buffered = {}, 0
+            self.close_output()
+            self.clear()
+
+    def write_columns(self, table, header, columns, trip):
+        """
+        Buffers the rows of a table of a trip, as returned by export_matches or export_path with as_columns.
+        :param table: the name of the table, such as 'matches'
+        :param header: A sequence of column names
+        :param columns: A dictionary of sequences of equal length, such as lists or arrays, keyed by column name
+        :param trip: the id of the trip
+        """
+        values = [columns[column].tolist() if hasattr(columns[column], 'tolist') else columns[column]
+                  for column in header]
+        assert len(set(map(len, values))) <= 1, 'the columns have different lengths'
+        with self.lock:
+            self.check_process()
+            if table not in self.headers:
+                self.headers[table] = ['trip'] + list(header)
+            rows = self.buffers.setdefault(table, [])
+            count = len(rows)
+            rows.extend([trip] + list(row) for row in zip(*values))
+            self.buffered += len(rows) - count
+            if self.buffered >= self.buffer_rows:
+                self.write_buffers()
+
+    def flush(self):
+        """
+        Writes every buffered row.
+        """
+        with self.lock:
+            self.check_process()
+            self.write_buffers()
+
+    def close(self):
+        """
+        Writes every buffered row, and closes the output of this process.
+        """
+        with self.lock:
+            self.check_process()
+            self.write_buffers()
+            self.close_output()
+
+    def check_process(self):
+        """
+        Discards the open output of the parent after a fork, since it belongs to the parent.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.forget_output()
+
+    def write_buffers(self):
+        """ Writes the buffered rows of each table as a block. The caller holds the lock. """
+        for table, rows in self.buffers.items():
+            if rows:
+                self.write_block(table, self.headers[table], rows)
+        self.buffers, self.buffered = {}, 0
+
+    @abstractmethod
+    def clear(self):
+        """ Removes the output of an earlier batch. """
+
+    @abstractmethod
+    def write_block(self, table, header, rows):
+        """
+        :param rows: a list of lists, aligned with header
+        """
+
+    @abstractmethod
+    def close_output(self):
+        """ Closes the output of this process, which is reopened if more rows are written. """
+
+    @abstractmethod
+    def forget_output(self):
+        """ Drops the open output inherited from the parent process without closing it. """
+
+
+class SQLiteBatchWriter(BatchWriter):
+    """
+    Writes each table of a batch to a table of the same name in the SQLite file ~/exports/<filename>.sqlite.
+    """
+
+    def __init__(self, filename, buffer_rows=100000):
+        BatchWriter.__init__(self, filename, buffer_rows)
+        self.filepath = p.get_script_path('exports') + p.separator() + filename + '.sqlite'
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filepath, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        return self.connection
+
+    def clear(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def write_block(self, table, header, rows):
+        """ Every block is inserted in a single transaction. Columns are untyped, as in the CSV exports. """
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS "{0}" ({1})'.format(
+                table, ', '.join('"{0}"'.format(column) for column in header)))
+            connection.executemany('INSERT INTO "{0}" VALUES ({1})'.format(table, ', '.join('?' * len(header))), rows)
+
+    def close_output(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def forget_output(self):
+        self.connection = None
+
+
+""" The type of each column of each table which batch_process writes, as the name of a pyarrow type. """
+PARQUET_COLUMN_TYPES = {
+    'matches': {'trip': 'int64', 'gps_lon': 'float64', 'gps_lat': 'float64', 'gps_heading': 'float64',
+                'match_lon': 'float64', 'match_lat': 'float64', 'match_heading': 'float64', 'timestamp': 'string',
+                'score': 'float64', 'segment': 'int64', 'gps_point': 'string', 'match_point': 'string',
+                'line_geom': 'string'},
+    'path': {'trip': 'int64', 'lon1': 'float64', 'lat1': 'float64', 'id1': 'string', 'lon2': 'float64',
+             'lat2': 'float64', 'id2': 'string', 'segment': 'int64', 'line_geom': 'string'}}
+
+
+class ParquetBatchWriter(BatchWriter):
+    """
+    Writes each table of a batch to a Parquet dataset in the directory ~/exports/<filename>/<table>/. Each process
+    writes its own part file, and each block becomes a row group. Every block of a table is converted to the types of
+    PARQUET_COLUMN_TYPES, so that the part files of every process share a schema, whatever values their blocks hold.
+    Requires pyarrow.
+    """
+
+    def __init__(self, filename, buffer_rows=100000):
+        import pyarrow.parquet  # Fail on construction, rather than after the first trip.
+        BatchWriter.__init__(self, filename, buffer_rows)
+        self.directory = p.get_script_path('exports') + p.separator() + filename
+        self.schemas = {}
+        self.writers = {}
+        self.parts = 0
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        self.schemas = {}
+
+    def write_block(self, table, header, rows):
+        import pyarrow
+        import pyarrow.parquet
+
+        if table not in self.schemas:
+            types = PARQUET_COLUMN_TYPES.get(table, {})
+            undeclared = [column for column in header if column not in types]
+            if undeclared:
+                raise ValueError('no Parquet types are declared for the columns {0} of {1}'.format(undeclared, table))
+            self.schemas[table] = pyarrow.schema([pyarrow.field(column, getattr(pyarrow, types[column])())
+                                                  for column in header])
+        columns = dict(zip(header, zip(*rows)))
+        block = pyarrow.Table.from_pydict({column: pyarrow.array(columns[column]).cast(field.type)
+                                           for column, field in zip(header, self.schemas[table])},
+                                          schema=self.schemas[table])
+
+        if table not in self.writers:
+            directory = self.directory + p.separator() + table
+            os.makedirs(directory, exist_ok=True)
+            self.parts += 1
+            filepath = directory + p.separator() + 'part-{0}-{1}.parquet'.format(os.getpid(), self.parts)
+            self.writers[table] = pyarrow.parquet.ParquetWriter(filepath, self.schemas[table])
+        self.writers[table].write_table(block)
+
+    def close_output(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def forget_output(self):
+        self.writers = {}
+
+
+BATCH_WRITERS = {'sqlite': SQLiteBatchWriter, 'parquet': ParquetBatchWriter}
@@ -0,0 +1,200 @@
+import csv
+import json
+import threading
+import time
+
+import util.parser as p
+
+""" The stages which MapMatch times. Each stage includes the time of any stage that it calls. """
+STAGES = ['knn', 'scoring', 'decoding', 'transitions', 'path_expansion', 'export']
+
+
+class Metrics:
+    """
+    Records the wall time and number of calls of each stage, and a set of named counters, such as cache hits and
+    shortest path searches, for a single trip or a whole batch. Safe to update from several threads.
+
+    Example usage:
+        with metrics.time('knn'):
+            ...
+        metrics.count('dijkstra_calls')
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def time(self, stage):
+        """
+        :return: A context manager which records the time spent inside it against stage.
+        """
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def merge(self, other):
+        """
+        Adds the times and counts of other to these metrics.
+        """
+        with self.lock:
+            for stage, seconds in other.seconds.items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+                self.calls[stage] = self.calls.get(stage, 0) + other.calls[stage]
+            for counter, amount in other.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def as_dict(self):
+        return {'stages': {stage: {'calls': self.calls[stage], 'seconds': self.seconds[stage]}
+                           for stage in sorted(self.seconds, key=_stage_order)},
+                'counters': dict(sorted(self.counters.items()))}
+
+    def __bool__(self):
+        return True
+
+    def __getstate__(self):
+        """ Locks cannot be pickled, so that metrics can be returned by worker processes. """
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class NullMetrics:
+    """
+    Metrics which record nothing, used when instrumentation is disabled. Each call does no work beyond the call itself.
+    """
+
+    def time(self, stage):
+        return _NULL_TIMER
+
+    def record(self, stage, seconds):
+        pass
+
+    def count(self, counter, amount=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def __bool__(self):
+        return False
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+NULL_METRICS = NullMetrics()
+
+
+def _stage_order(stage):
+    return (STAGES.index(stage), stage) if stage in STAGES else (len(STAGES), stage)
+
+
+class Instrumentation:
+    """
+    Collects the Metrics of each trip of a batch, and reports them per trip and in total.
+    """
+
+    def __init__(self):
+        self.trips = {}
+        self.lock = threading.Lock()
+
+    def trip(self, trip):
+        """
+        :param trip: the id of a trip
+        :return: New Metrics which are recorded as the metrics of the trip.
+        """
+        metrics = Metrics()
+        self.add(trip, metrics)
+        return metrics
+
+    def add(self, trip, metrics):
+        """
+        Records the metrics of a trip, such as metrics returned by a worker process.
+        """
+        with self.lock:
+            self.trips[trip] = metrics
+
+    def total(self):
+        """
+        :return: The Metrics of every trip combined.
+        """
+        total = Metrics()
+        for metrics in list(self.trips.values()):
+            total.merge(metrics)
+        return total
+
+    def report(self):
+        """
+        :return: A dictionary of the batch total, and of each trip.
+        """
+        return {'batch': self.total().as_dict(),
+                'trips': {str(trip): metrics.as_dict() for trip, metrics in sorted(self.trips.items())}}
+
+    def print_report(self):
+        total = self.total()
+        print('stage\tcalls\tseconds')
+        for stage, values in total.as_dict()['stages'].items():
+            print('{0}\t{1}\t{2:.3f}'.format(stage, values['calls'], values['seconds']))
+        for counter, amount in sorted(total.counters.items()):
+            print('{0}\t{1}'.format(counter, amount))
+
+    def export_json(self, filename):
+        """
+        Writes the report to ~/exports/<filename>.json.
+        """
+        with open(p.get_script_path('exports') + p.separator() + filename + '.json', 'w') as json_file:
+            json.dump(self.report(), json_file, indent=2)
+
+    def export_csv(self, filename):
+        """
+        Writes one row per trip, and a final row for the batch with the trip 'batch', to ~/exports/<filename>.csv.
+        Each stage has a calls and a seconds column, and each counter has a column.
+        """
+        rows = [(trip, metrics.as_dict()) for trip, metrics in sorted(self.trips.items())]
+        rows.append(('batch', self.total().as_dict()))
+        stages = sorted({stage for _, row in rows for stage in row['stages']}, key=_stage_order)
+        counters = sorted({counter for _, row in rows for counter in row['counters']})
+
+        header = ['trip'] + [stage + suffix for stage in stages for suffix in ('_calls', '_seconds')] + counters
+        with open(p.get_script_path('exports') + p.separator() + filename + '.csv', 'w', newline='\n') as csv_file:
+            f = csv.writer(csv_file)
+            f.writerow(header)
+            for trip, row in rows:
+                f.writerow([trip] +
+                           [row['stages'].get(stage, {}).get(column, 0)
+                            for stage in stages for column in ('calls', 'seconds')] +
+                           [row['counters'].get(counter, 0) for counter in counters])
@@ -1,6 +1,11 @@
 import os
 import sys
 import csv
+import gzip
+import heapq
+import io
+import tempfile
+from itertools import islice
 
 
 def separator():
@@ -26,16 +31,95 @@ def read_file(filename, dir='data'):
     return file.read()
 
 
+def data_path(filename, dir='data'):
+    return os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + dir + separator() + filename
+
+
+def open_text(filepath):
+    """
+    Opens a text file for reading, decompressing it if its name ends in .gz, or in .zst or .zstd, which requires the
+    zstandard package.
+    """
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'rt', newline='')
+    if filepath.endswith(('.zst', '.zstd')):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading ' + filepath + ' requires the zstandard package')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True),
+                                newline='')
+    return open(filepath, newline='')
+
+
 def read_csv(filename, dir='data'):
-    with open(os.path.dirname(os.path.realpath(sys.argv[0])) + separator() + dir + separator() + filename) as csv_file:
+    with open_text(data_path(filename, dir)) as csv_file:
         reader = csv.DictReader(csv_file)
         for row in reader:
             yield row
 
 
+def read_csv_columns(filename, dir='data', columns=None):
+    """
+    Reads the columns of a CSV into lists, without building a dictionary per row.
+    :param columns: optionally, the names of the columns to read. Columns which the file does not have are skipped.
+    :return: a dictionary mapping the name of each column read to a list of its values, as strings
+    """
+    with open_text(data_path(filename, dir)) as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, [])
+        wanted = [(name, index) for index, name in enumerate(header) if columns is None or name in columns]
+        values = {name: [] for name, _ in wanted}
+        appends = [(values[name].append, index) for name, index in wanted]
+        for row in reader:
+            for append, index in appends:
+                append(row[index])
+    return values
+
+
 def get_JSON_strings():
     """
     Maps the file name without the extension to the associated JSON string.
     """
     return {file.rsplit(".", 1)[0]: read_file(file) for file in get_JSON_files()}
 
+
+def read_csv_sorted(filename, dir='data', key='TRIP_ID', chunk_rows=1000000):
+    """
+    Reads the rows of a CSV sorted by a column, keeping the order of rows with the same value, without holding the
+    whole file in memory. Runs of chunk_rows rows are sorted in memory and spilled to temporary files, which are then
+    merged. A file of at most chunk_rows rows is sorted in memory.
+    :param key: the column to sort by. Values are compared as strings.
+    :param chunk_rows: the number of rows sorted in memory at once
+    :return: a generator of dictionaries, one per row
+    """
+    rows = read_csv(filename, dir)
+    first_chunk = list(islice(rows, chunk_rows))
+    if len(first_chunk) < chunk_rows:
+        yield from sorted(first_chunk, key=lambda row: row.get(key) or '')
+        return
+
+    with tempfile.TemporaryDirectory() as spill_directory:
+        spills = []
+        chunk, start = first_chunk, 0
+        while chunk:
+            """ Each spilled row carries its position in the file, so that the merge keeps rows of equal keys in
+            order. """
+            path = os.path.join(spill_directory, 'chunk_{0}.csv'.format(len(spills)))
+            with open(path, 'w', newline='') as spill:
+                writer = csv.writer(spill)
+                for position, row in sorted(enumerate(chunk, start), key=lambda item: item[1].get(key) or ''):
+                    writer.writerow([row.get(key) or '', position] + [row[column] for column in row])
+            spills.append(path)
+            start += len(chunk)
+            header = list(chunk[0])
+            chunk = list(islice(rows, chunk_rows))
+
+        files = [open(path, newline='') for path in spills]
+        try:
+            readers = [((line[0], int(line[1]), line[2:]) for line in csv.reader(spill)) for spill in files]
+            for _, _, values in heapq.merge(*readers):
+                yield dict(zip(header, values))
+        finally:
+            for spill in files:
+                spill.close()
@@ -0,0 +1,129 @@
+import math
+
+import numpy as np
+
+from util.utils import EARTH_RADIUS_FEET
+
+
+class LocalProjection:
+    """
+    A stereographic projection of the world, as the sphere which real_distance measures, onto a plane which touches it
+    at an origin. Coordinates on the plane are x feet east and y feet north of the origin, so that distances, headings
+    and offsets near the origin can be computed with planar arithmetic rather than trigonometry.
+
+    The projection is conformal, so it preserves angles, and its scale at a point c radians from the origin is
+    1 / cos(c / 2) ** 2, which is never less than 1. A planar distance between two points within r feet of the origin
+    is therefore longer than the real distance by a relative error of at most
+
+        (r / (2 * EARTH_RADIUS_FEET)) ** 2 + O(r ** 4)
+
+    which is 4.0e-7 within 5 miles of the origin, 1.0e-5 within 25 miles, and 4.0e-5 within 50 miles. The I-210 study
+    area lies within 25 miles of its center, so distances across it are within an eighth of an inch per thousand feet.
+    Grid north differs from true north away from the central meridian, and headings correct for it (see convergence).
+    """
+
+    def __init__(self, origin_lon, origin_lat):
+        """
+        :param origin_lon: the longitude in degrees of the point where the plane touches the world
+        :param origin_lat: the latitude in degrees of that point
+        """
+        self.origin_lon = origin_lon
+        self.origin_lat = origin_lat
+        self.lon_as_rad = math.radians(origin_lon)
+        self.sin_lat = math.sin(math.radians(origin_lat))
+        self.cos_lat = math.cos(math.radians(origin_lat))
+
+    @classmethod
+    def centered_on(cls, lons, lats):
+        """
+        :return: A projection whose origin is the center of the bounding box of the points, which minimizes its
+                 error over them.
+        """
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        return cls(float(lons.min() + lons.max()) / 2, float(lats.min() + lats.max()) / 2)
+
+    def __repr__(self):
+        return 'LocalProjection({0!r}, {1!r})'.format(self.origin_lon, self.origin_lat)
+
+    def max_error(self, radius):
+        """
+        :param radius: a distance in feet from the origin
+        :return: The greatest relative error of a planar distance between points within radius of the origin.
+        """
+        return 1 / math.cos(radius / EARTH_RADIUS_FEET / 2) ** 2 - 1
+
+    def project(self, lon, lat):
+        """
+        Projects a single location, without the overhead of arrays.
+        :return: A tuple of (x, y) in feet.
+        """
+        lat = math.radians(lat)
+        delta_lon = math.radians(lon) - self.lon_as_rad
+        sin_lat, cos_lat, cos_delta = math.sin(lat), math.cos(lat), math.cos(delta_lon)
+        k = 2 * EARTH_RADIUS_FEET / (1 + self.sin_lat * sin_lat + self.cos_lat * cos_lat * cos_delta)
+        return k * cos_lat * math.sin(delta_lon), k * (self.cos_lat * sin_lat - self.sin_lat * cos_lat * cos_delta)
+
+    def forward(self, lons, lats):
+        """
+        Projects arrays of locations of any shapes which broadcast together.
+        :param lons: longitudes in degrees
+        :param lats: latitudes in degrees
+        :return: A tuple of (an array of x, an array of y) in feet.
+        """
+        lats = np.radians(np.asarray(lats, dtype=float))
+        delta_lon = np.radians(np.asarray(lons, dtype=float)) - self.lon_as_rad
+        sin_lat, cos_lat, cos_delta = np.sin(lats), np.cos(lats), np.cos(delta_lon)
+        k = 2 * EARTH_RADIUS_FEET / (1 + self.sin_lat * sin_lat + self.cos_lat * cos_lat * cos_delta)
+        return k * cos_lat * np.sin(delta_lon), k * (self.cos_lat * sin_lat - self.sin_lat * cos_lat * cos_delta)
+
+    def inverse(self, x, y):
+        """
+        :param x: feet east of the origin
+        :param y: feet north of the origin
+        :return: A tuple of (an array of longitudes, an array of latitudes) in degrees.
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        rho = np.hypot(x, y)
+        c = 2 * np.arctan2(rho, 2 * EARTH_RADIUS_FEET)
+        sin_c, cos_c = np.sin(c), np.cos(c)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            north = np.where(rho > 0, y * sin_c * self.cos_lat / rho, 0)
+        lats = np.arcsin(np.clip(cos_c * self.sin_lat + north, -1, 1))
+        lons = self.lon_as_rad + np.arctan2(x * sin_c, rho * self.cos_lat * cos_c - y * self.sin_lat * sin_c)
+        return np.degrees((lons + math.pi) % (2 * math.pi) - math.pi), np.degrees(lats)
+
+    def convergence(self, x, y):
+        """
+        :return: The angle in degrees, clockwise, from grid north (the y axis) to true north at each location.
+        """
+        lons, lats = self.inverse(x, y)
+        lats = np.radians(lats)
+        delta_lon = np.radians(lons) - self.lon_as_rad
+        return -np.degrees(np.arctan2(np.sin(delta_lon) * (self.sin_lat + np.sin(lats)),
+                                      self.cos_lat * np.cos(lats) + (1 + self.sin_lat * np.sin(lats)) *
+                                      np.cos(delta_lon)))
+
+    @staticmethod
+    def distance(x1, y1, x2, y2):
+        """
+        :return: The planar distance in feet between projected locations. Arrays broadcast.
+        """
+        return np.hypot(np.subtract(x2, x1), np.subtract(y2, y1))
+
+    def heading(self, x1, y1, x2, y2):
+        """
+        Computes the heading from each origin to each destination, as get_heading does, from projected locations.
+        :return: Headings in [0, 360) degrees, clockwise from true north at the origin of each heading.
+        """
+        grid_heading = np.degrees(np.arctan2(np.subtract(x2, x1), np.subtract(y2, y1)))
+        return (grid_heading - self.convergence(x1, y1)) % 360
+
+    def offset(self, x, y, distance, bearing):
+        """
+        Finds the locations which are each distance feet from a projected location in the direction of a bearing, as
+        offset_point does.
+        :param bearing: bearings in degrees, clockwise from true north
+        :return: A tuple of (an array of x, an array of y) in feet.
+        """
+        grid_bearing = np.radians(np.asarray(bearing, dtype=float) + self.convergence(x, y))
+        return x + distance * np.sin(grid_bearing), y + distance * np.cos(grid_bearing)
@@ -2,8 +2,11 @@ import datetime
 import json
 import math
 import sys
+import threading
 import time
 
+import numpy as np
+
 import util.Shapes
 from util.parser import get_JSON_strings
 
@@ -23,6 +26,11 @@ def time_fn(fn, iterations, args):
     return int(t)
 
 
+EARTH_RADIUS_KM = 6378.1
+KM_TO_FEET_CONST = 3280.84  # The number of feet in a KM
+EARTH_RADIUS_FEET = EARTH_RADIUS_KM * KM_TO_FEET_CONST
+
+
 def real_distance(cp1, cp2):
     """
     >>> 995.0 <= real_distance([-118.121438, 34.179766], [-118.118132, 34.179786]) <= 1000.0
@@ -33,19 +41,61 @@ def real_distance(cp1, cp2):
     :param cp2: A list in the form [lon2, lat2].
     :return: The distance in feet between two coordinates.
     """
-    earth_radius = 6378.1
-    KM_TO_FEET_CONST = 3280.84
+    lat1 = math.radians(cp1[1])
+    lat2 = math.radians(cp2[1])
 
-    cp1 = list(map(math.radians, cp1))
-    cp2 = list(map(math.radians, cp2))
+    delta_lon = math.radians(cp2[0]) - math.radians(cp1[0])
+    delta_lat = lat2 - lat1
 
-    delta_lon = cp2[0] - cp1[0]
-    delta_lat = cp2[1] - cp1[1]
-
-    a = math.sin(delta_lat / 2) ** 2 + math.cos(cp1[1]) * math.cos(cp2[1]) * math.sin(delta_lon / 2) ** 2
+    a = math.sin(delta_lat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(delta_lon / 2) ** 2
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
-    return earth_radius * c * KM_TO_FEET_CONST
+    return EARTH_RADIUS_KM * c * KM_TO_FEET_CONST
+
+
+def real_distances(lons1, lats1, lons2, lats2, radians=False, approximate=False):
+    """
+    Computes the distance in feet between pairs of points, as real_distance does, for arrays of any shapes which
+    broadcast together. A scalar may be passed for either point, to find the distances from one point to many.
+    The results agree with real_distance to within a relative error of 1e-12.
+    :param radians: whether the coordinates are already in radians, such as Point.lon_as_rad, rather than degrees
+    :param approximate: whether to treat the area between each pair of points as flat (an equirectangular
+                        projection at their mean latitude) rather than use the Haversine Formula. Between points less
+                        than 100,000 feet apart, away from the poles, the relative error is below 1e-6.
+    :return: An array of distances in feet, of the broadcast shape.
+    """
+    lons1, lats1, lons2, lats2 = (np.asarray(values, dtype=float) for values in (lons1, lats1, lons2, lats2))
+    if not radians:
+        lons1, lats1, lons2, lats2 = np.radians(lons1), np.radians(lats1), np.radians(lons2), np.radians(lats2)
+
+    delta_lon = lons2 - lons1
+    delta_lat = lats2 - lats1
+    if approximate:
+        return EARTH_RADIUS_FEET * np.hypot(delta_lon * np.cos((lats1 + lats2) / 2), delta_lat)
+
+    a = np.sin(delta_lat / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin(delta_lon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_FEET * c
+
+
+def project_to_segment(point, start, end):
+    """
+    Finds the position on the straight segment from start to end which is nearest to a point. The area around the
+    segment is treated as flat, which is accurate for segments of a few thousand feet.
+    :param point: A list in the form [lon, lat].
+    :param start: A list in the form [lon, lat].
+    :param end: A list in the form [lon, lat].
+    :return: A tuple of (the fraction of the way from start to end, the distance in feet from point to the position).
+    """
+    scale = math.cos(math.radians(start[1]))  # The length of a degree of longitude, relative to a degree of latitude.
+    segment_x, segment_y = (end[0] - start[0]) * scale, end[1] - start[1]
+    point_x, point_y = (point[0] - start[0]) * scale, point[1] - start[1]
+
+    length = segment_x ** 2 + segment_y ** 2
+    fraction = 0 if length == 0 else min(1, max(0, (point_x * segment_x + point_y * segment_y) / length))
+    distance = math.hypot(point_x - fraction * segment_x, point_y - fraction * segment_y)
+
+    return fraction, math.radians(distance) * EARTH_RADIUS_KM * KM_TO_FEET_CONST
 
 
 def get_heading(origin, destination):
@@ -67,6 +117,23 @@ def get_heading(origin, destination):
     return (prenormalized + 360) % 360  # map result to [0, 360) degrees
 
 
+def get_headings(origin_lons, origin_lats, destination_lons, destination_lats, radians=False):
+    """
+    Computes the heading from each origin to each destination in degrees, as get_heading does, for arrays of any
+    shapes which broadcast together. The results agree with get_heading to within 1e-9 degrees.
+    :param radians: whether the coordinates are already in radians rather than degrees
+    :return: An array of headings in [0, 360) degrees, of the broadcast shape.
+    """
+    o_lon, o_lat, d_lon, d_lat = (np.asarray(values, dtype=float)
+                                  for values in (origin_lons, origin_lats, destination_lons, destination_lats))
+    if not radians:
+        o_lon, o_lat, d_lon, d_lat = np.radians(o_lon), np.radians(o_lat), np.radians(d_lon), np.radians(d_lat)
+
+    y = np.sin(d_lon - o_lon) * np.cos(d_lat)
+    x = np.cos(o_lat) * np.sin(d_lat) - np.sin(o_lat) * np.cos(d_lat) * np.cos(d_lon - o_lon)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
+
+
 def decode_json():
     """
     Returns a mapping of sections and junctions from a JSON string.
@@ -87,20 +154,43 @@ def offset_point(point, distance, bearing):
 
     bearing = math.radians(bearing)
 
-    R = 6378.1  # The radius of the world, in km.
-    KM_TO_FEET_CONST = 3280.84  # The number of feet in a KM
-
-    distance = distance / KM_TO_FEET_CONST
+    angle = distance / KM_TO_FEET_CONST / EARTH_RADIUS_KM  # The angle subtended at the centre of the world.
 
-    lat2 = math.asin(math.sin(point.lat_as_rad) * math.cos(distance / R) +
-                     math.cos(point.lat_as_rad) * math.sin(distance / R) * math.cos(bearing))
+    lat2 = math.asin(math.sin(point.lat_as_rad) * math.cos(angle) +
+                     math.cos(point.lat_as_rad) * math.sin(angle) * math.cos(bearing))
 
-    lon2 = point.lon_as_rad + math.atan2(math.sin(bearing) * math.sin(distance / R) * math.cos(point.lat_as_rad),
-                                         math.cos(distance / R) - math.sin(point.lat_as_rad) * math.sin(lat2))
+    lon2 = point.lon_as_rad + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(point.lat_as_rad),
+                                         math.cos(angle) - math.sin(point.lat_as_rad) * math.sin(lat2))
 
     return util.Shapes.Point(math.degrees(lon2), math.degrees(lat2), math.degrees(bearing))
 
 
+def offset_points(lons, lats, distances, bearings, radians=False):
+    """
+    Finds the points which are each distance away from each point in the direction of each bearing, as offset_point
+    does, for arrays of any shapes which broadcast together. The results agree with offset_point to within 1e-9
+    degrees, except that longitudes are wrapped to [-180, 180).
+    :param distances: distances in feet
+    :param bearings: bearings in degrees, clockwise from true north
+    :param radians: whether the coordinates and bearings are in radians rather than degrees. If so, the results are
+                    in radians too.
+    :return: A tuple of (an array of longitudes, an array of latitudes), of the broadcast shape.
+    """
+    lons, lats, distances, bearings = (np.asarray(values, dtype=float)
+                                       for values in (lons, lats, distances, bearings))
+    if not radians:
+        lons, lats, bearings = np.radians(lons), np.radians(lats), np.radians(bearings)
+
+    angles = distances / KM_TO_FEET_CONST / EARTH_RADIUS_KM
+    lats2 = np.arcsin(np.sin(lats) * np.cos(angles) + np.cos(lats) * np.sin(angles) * np.cos(bearings))
+    lons2 = lons + np.arctan2(np.sin(bearings) * np.sin(angles) * np.cos(lats),
+                              np.cos(angles) - np.sin(lats) * np.sin(lats2))
+    lons2 = (lons2 + math.pi) % (2 * math.pi) - math.pi
+    if radians:
+        return lons2, lats2
+    return np.degrees(lons2), np.degrees(lats2)
+
+
 def angle_delta(a1, a2):
     """
     Computes the difference between two angles, accounting for overflow. A positive result indicates
@@ -113,6 +203,22 @@ def angle_delta(a1, a2):
     return (a2 - a1) % 360 if (a2 - a1) % 360 <= 180 else -((a1 - a2) % 360)
 
 
+def angle_deltas(a1, a2):
+    """
+    Computes the difference between pairs of angles, as angle_delta does, for arrays of any shapes which broadcast
+    together. The results are exactly those of angle_delta.
+    :return: An array of changes in degrees, in (-180, 180], of the broadcast shape.
+    """
+    a1, a2 = np.asarray(a1, dtype=float), np.asarray(a2, dtype=float)
+    assert np.all(a1 <= 360) and np.all(a2 <= 360)
+    clockwise = (a2 - a1) % 360
+    return np.where(clockwise <= 180, clockwise, -((a1 - a2) % 360))
+
+
+_progress_lock = threading.Lock()  # Calls from different threads take turns to write.
+_progress = threading.local()  # Each thread counts its own iterations, so concurrent loops do not share a count.
+
+
 # Print iterations progress
 def print_progress(total, prefix='', decimals=1, bar_length=25):
     """
@@ -124,23 +230,35 @@ def print_progress(total, prefix='', decimals=1, bar_length=25):
         decimals    - Optional  : positive number of decimals in percent complete (Int)
         bar_length  - Optional  : character length of bar (Int)
     """
-    if not getattr(print_progress, 'iteration', None):
-        print_progress.iteration = 1
-        print_progress.start = datetime.datetime.now()
+    with _progress_lock:
+        _print_progress(total, prefix, decimals, bar_length)
+
+
+def reset_progress():
+    """
+    Discards the count of the current thread, so that the next call to print_progress starts a new bar. Call when a
+    loop which prints its progress stops before its last iteration.
+    """
+    _progress.__dict__.clear()
+
+
+def _print_progress(total, prefix, decimals, bar_length):
+    if not getattr(_progress, 'iteration', None):
+        _progress.iteration = 1
+        _progress.start = datetime.datetime.now()
 
     str_format = "{0:." + str(decimals) + "f}"
-    percents = str_format.format(100 * (print_progress.iteration / float(total)))
-    filled_length = int(round(bar_length * print_progress.iteration / float(total)))
+    percents = str_format.format(100 * (_progress.iteration / float(total)))
+    filled_length = int(round(bar_length * _progress.iteration / float(total)))
     bar = '█' * filled_length + '-' * (bar_length - filled_length)
 
-    timestamp = str(datetime.datetime.now() - print_progress.start)
+    timestamp = str(datetime.datetime.now() - _progress.start)
     sys.stdout.write('\r%s |%s| %s%s %s' % (prefix, bar, percents, '%', timestamp)),
 
-    if print_progress.iteration >= total:
+    if _progress.iteration >= total:
         sys.stdout.write('\n')
-        delattr(print_progress, 'iteration')  # Remove the counter
-        delattr(print_progress, 'start')  # Remove the start time
+        reset_progress()  # Remove the counter and the start time
     else:
-        print_progress.iteration += 1
+        _progress.iteration += 1
 
     sys.stdout.flush()